@@ -0,0 +1,232 @@
+import re
+import json
+import asyncio
+from pipeline import Pipeline
+from judging import parse_score_dict, parse_score_value
+from structured_output import StructuredOutputError, complete_structured, json_schema_format, parse_json_reply
+
+#%% Prompt optimization and evaluation steps shared by the Streamlit apps and headless tools
+
+REPHRASER_SYSTEM_PROMPT = """
+            You are a professional paragraph rephraser. Your task is to take a given paragraph, and produce a new paragraph that is easier for language models to understand.
+            Rephrase the paragraph to enhance the language model's performance.
+            The paragraph must be kept in English.
+            """
+
+COT_SYSTEM_PROMPT = REPHRASER_SYSTEM_PROMPT
+
+QUESTIONER_SYSTEM_PROMPT = """
+            In role of Student/Child in the provided context.
+            Prepare the answers that you will respond to the LLM (Pika) to interact with it, the answers will be based on the provided context.
+            Answers are in Vietnamese.
+            Return a JSON object whose "questions" list holds five answers, in the order you will send them,
+            and don't return any other information.
+            The following is the provided context:
+            """
+
+JUDGER_SYSTEM_PROMPT = """
+            You are the LLM evaluator/judger. Based on the context below, which is the requirements to access the performance of the LLM.
+            I will provide you the dialogues that contains the responses from LLM, in which LLM is not User.
+            Please evaluate the dialogues to check if the LLM follow the requirements during the conversation or not.
+            Please also decide the metrics to evaluate and output the score of each metric. The scale of score is 5.
+            Return a JSON object whose "scores" list holds one {"metric", "score"} entry per metric, and don't return any other information.
+            """
+
+IMPROVER_SYSTEM_PROMPT = """
+            You are a prompt engineer. You will receive the system prompt of a chatbot, followed by the scores that an evaluator gave to conversations that used it.
+            Rewrite the prompt so that the chatbot scores higher on the weakest metrics, while keeping its intent, persona and language requirements.
+            Only return the rewritten prompt, and don't return any other information.
+            """
+
+QUESTIONS_SCHEMA = {
+    "type": "object",
+    "properties": {"questions": {"type": "array", "items": {"type": "string"}}},
+    "required": ["questions"],
+    "additionalProperties": False,
+}
+
+SCORES_SCHEMA = {
+    "type": "object",
+    "properties": {"scores": {"type": "array", "items": {
+        "type": "object",
+        "properties": {"metric": {"type": "string"}, "score": {"type": "number"}},
+        "required": ["metric", "score"],
+        "additionalProperties": False,
+    }}},
+    "required": ["scores"],
+    "additionalProperties": False,
+}
+
+QUESTIONS_FORMAT = json_schema_format("questions", QUESTIONS_SCHEMA)
+SCORES_FORMAT = json_schema_format("scores", SCORES_SCHEMA)
+
+# A list item at the start of a line: "- ", "* ", "• ", "1. " or "1) "
+LIST_ITEM_PATTERN = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+(.*\S)", re.M)
+
+#%% Helper Functions
+
+def build_messages(system_prompt, content):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
+
+def quote_prompt(prompt):
+    return '""' + prompt + '""'
+
+def parse_questions(questions_reply):
+    """The questions of a Questioner reply: the JSON {"questions": [...]} object, or else a bulleted list.
+
+    Only markers at the start of a line count as list items, so hyphens inside an answer are kept.
+    Raises StructuredOutputError if the reply holds no question.
+    """
+    try:
+        questions = parse_json_reply(questions_reply, QUESTIONS_SCHEMA)["questions"]
+    except StructuredOutputError as e:
+        questions = LIST_ITEM_PATTERN.findall(questions_reply or "")
+        if not questions:
+            raise e
+    questions = [question.strip() for question in questions if question.strip()]
+    if not questions:
+        raise StructuredOutputError("the reply holds no question")
+    return questions
+
+def parse_judge_scores(judge_reply):
+    """The {metric: score} of a Judger reply (the JSON {"scores": [...]} object, or else any score dict in the text).
+
+    Raises StructuredOutputError if no score on the 0-5 scale can be read.
+    """
+    try:
+        entries = parse_json_reply(judge_reply, SCORES_SCHEMA)["scores"]
+        scores = {entry["metric"].strip(): parse_score_value(entry["score"]) for entry in entries}
+        scores = {metric: score for metric, score in scores.items() if metric and score is not None}
+    except StructuredOutputError:
+        scores = parse_score_dict(judge_reply)
+    if not scores:
+        raise StructuredOutputError("the reply holds no score between 0 and 5")
+    return scores
+
+def format_transcripts(transcripts):
+    """Conversation logs of several simulated dialogues, one after the other."""
+    return "\n---\n\n".join(transcript.to_text() for transcript in transcripts)
+
+def build_judger_context(requirements, conversation_result):
+    return (
+        "The following is the requirements for the LLM:\n"
+        + requirements + "\n\n"
+        + "The following is the content of the conversation between LLM and the user:\n"
+        + conversation_result
+    )
+
+def build_improver_context(prompt, metric_means=None):
+    if metric_means:
+        feedback = "\n".join(f"- {name}: {score:.2f}" for name, score in sorted(metric_means.items(), key=lambda item: item[1]))
+    else:
+        feedback = "No evaluations yet."
+    return (
+        "The following is the prompt to improve:\n"
+        + prompt + "\n\n"
+        + "The following are its evaluation scores out of 5, weakest first:\n"
+        + feedback
+    )
+
+async def _complete(client, system_prompt, content, model, on_stream=None, **params):
+    # Steps are pure functions of their input (and params), so repeated runs are served from the response cache
+    messages = build_messages(system_prompt, content)
+    if on_stream is None:
+        return await client.achat(messages, model=model, use_cache=True, **params)
+
+    stream = client.astream_chat(messages, model=model, use_cache=True, **params)
+    async for _ in stream:
+        on_stream(stream.text, stream.time_to_first_token)
+    return stream.text
+
+#%% Pipeline Steps (coroutines on a shared llm_client.LLMClient)
+# on_stream(text_so_far, time_to_first_token) switches a step to streaming and is called on every chunk
+
+async def rephraser_model(content, client, model="gpt-4o-mini", on_stream=None):
+    return await _complete(client, REPHRASER_SYSTEM_PROMPT, content, model, on_stream)
+
+async def CoT_model(content, client, model="gpt-4o-mini", on_stream=None):
+    return await _complete(client, COT_SYSTEM_PROMPT, content, model, on_stream)
+
+# Questioner and Judger replies are read by the next step: they request JSON-schema output and re-ask once with
+# the parse error instead of failing the run (see structured_output.complete_structured)
+
+async def Questioner(content, client, model="gpt-4o", on_stream=None, **params):
+    """Returns the list of user answers to play in a simulated dialogue."""
+    return await complete_structured(client, build_messages(QUESTIONER_SYSTEM_PROMPT, content), model, "questioner",
+                                     QUESTIONS_FORMAT, parse_questions, on_stream=on_stream, **params)
+
+async def Judger(content, client, model="gpt-4o-mini", on_stream=None, **params):
+    """Returns the scores as a JSON {metric: score} string, the format judging.ScoreSummary reads."""
+    # params such as seed and temperature let JudgingEngine draw several distinct samples
+    scores = await complete_structured(client, build_messages(JUDGER_SYSTEM_PROMPT, content), model, "judger",
+                                       SCORES_FORMAT, parse_judge_scores, on_stream=on_stream, **params)
+    return json.dumps(scores, ensure_ascii=False)
+
+async def Improver(content, client, model="gpt-4o-mini", on_stream=None, **params):
+    return await _complete(client, IMPROVER_SYSTEM_PROMPT, content, model, on_stream, **params)
+
+#%% Pipeline Construction
+
+def build_optimization_pipeline(input_prompt, client, max_concurrency=4, evaluate=True, on_stream=None, judging_engine=None,
+                                num_dialogues=1, max_requests=None):
+    """Builds the rephrase -> CoT step DAG for an already quoted prompt.
+
+    With evaluate=True it adds Questioner -> simulated chat branches for both the original and the new
+    prompt, and a "judge" step that compares the two sets of conversations with a judging.JudgingEngine.
+    Each branch generates `num_dialogues` question sets and plays them as concurrent dialogues, so the
+    questions steps return a list of question lists and the chat steps a list of Transcripts.
+    The original-prompt branch does not wait for the rephrase/CoT steps.
+    With on_stream(step_name, text_so_far, time_to_first_token) the rephrase, CoT and chat steps stream.
+    max_concurrency bounds the steps in flight and max_requests, if set, the LLM requests (see Pipeline).
+    """
+    from judging import JudgingEngine
+    from conversation_simulator import ConversationSimulator
+
+    pipeline = Pipeline(max_concurrency=max_concurrency, max_requests=max_requests)
+    judging_engine = judging_engine or JudgingEngine(client)
+    # A single dialogue keeps the unseeded (and already cached) Questioner request
+    seeds = list(range(num_dialogues)) if num_dialogues > 1 else [None]
+
+    def stream_to(step_name):
+        if on_stream is None:
+            return None
+        return lambda text, time_to_first_token: on_stream(step_name, text, time_to_first_token)
+
+    async def generate_questions(content):
+        return list(await asyncio.gather(*(Questioner(content, client, **({} if seed is None else {"seed": seed}))
+                                           for seed in seeds)))
+
+    async def simulate_conversations(step_name, question_sets, custom_prompt):
+        # Every dialogue owns its history, so the two branches (and the dialogues within them) never share state
+        simulator = ConversationSimulator(client, custom_prompt)
+        transcripts = [None] * len(question_sets)
+
+        def on_update(i, transcript):
+            transcripts[i] = transcript
+            first_turn = transcript.turns[0] if transcript.turns else None
+            on_stream(step_name, format_transcripts(t for t in transcripts if t is not None),
+                      first_turn.time_to_first_token if first_turn else None)
+
+        return await simulator.run_many(question_sets, seeds, on_update if on_stream is not None else None)
+
+    async def judge(original_transcripts, new_transcripts):
+        return await judging_engine.compare([build_judger_context(input_prompt, t.to_text()) for t in original_transcripts],
+                                            [build_judger_context(input_prompt, t.to_text()) for t in new_transcripts])
+
+    pipeline.add_step("rephrase", lambda: rephraser_model(input_prompt, client, on_stream=stream_to("rephrase")))
+    pipeline.add_step("cot", lambda rephrased: CoT_model(rephrased, client, on_stream=stream_to("cot")), deps=["rephrase"])
+    if not evaluate:
+        return pipeline
+
+    pipeline.add_step("original_questions", lambda: generate_questions(input_prompt))
+    pipeline.add_step("original_chat", lambda questions: simulate_conversations("original_chat", questions, input_prompt),
+                      deps=["original_questions"])
+
+    pipeline.add_step("new_questions", generate_questions, deps=["cot"])
+    pipeline.add_step("new_chat", lambda questions, final_result: simulate_conversations("new_chat", questions, final_result),
+                      deps=["new_questions", "cot"])
+    pipeline.add_step("judge", judge, deps=["original_chat", "new_chat"])
+    return pipeline
@@ -0,0 +1,301 @@
+"""Iterative automatic prompt optimization.
+
+Each round rewrites the best prompts so far into new candidates (guided by their weakest judge metrics),
+evaluates the candidates in parallel on simulated dialogues, and spends the evaluation budget on the
+promising ones with successive halving or a UCB bandit. All candidates are tested on the same question
+sets and seeds, so their scores are directly comparable, and the whole search is deterministic for a
+given seed and a deterministic client.
+
+Usage:
+    python apo_search.py "You are Pika, a friendly tutor..." --rounds 3 --candidates 4 --budget-calls 400
+"""
+import math
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from typing import List, Optional
+import prompt_utils
+import tracing
+from apo_models import Questioner, Improver, Judger, build_judger_context, build_improver_context, quote_prompt
+from conversation_simulator import ConversationSimulator
+from judging import ScoreSummary
+
+#%% Budget accounting
+
+class SearchBudget:
+    """Soft limit on LLM calls and tokens. The search checks it between batches, so a batch may overshoot it."""
+
+    def __init__(self, max_calls=None, max_tokens=None):
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.num_calls = 0
+        self.num_tokens = 0
+
+    @property
+    def exhausted(self):
+        return ((self.max_calls is not None and self.num_calls >= self.max_calls)
+                or (self.max_tokens is not None and self.num_tokens >= self.max_tokens))
+
+    def record(self, messages, reply):
+        self.num_calls += 1
+        self.num_tokens += prompt_utils.count_tokens_from_conversation_seq(messages) + prompt_utils.count_tokens_from_string(reply or "")
+
+
+class _BudgetedStream:
+    def __init__(self, stream, budget, messages):
+        self.stream = stream
+        self.budget = budget
+        self.messages = messages
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                yield chunk
+        finally:
+            self.budget.record(self.messages, self.stream.text)
+
+
+class BudgetedClient:
+    """Wraps an LLM client, counting every chat call and its (estimated) tokens against a SearchBudget."""
+
+    def __init__(self, client, budget):
+        self.client = client
+        self.budget = budget
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def achat(self, messages, *args, **kwargs):
+        reply = None
+        try:
+            reply = await self.client.achat(messages, *args, **kwargs)
+            return reply
+        finally:
+            self.budget.record(messages, reply)
+
+    def astream_chat(self, messages, *args, **kwargs):
+        return _BudgetedStream(self.client.astream_chat(messages, *args, **kwargs), self.budget, messages)
+
+#%% Candidates
+
+@dataclass
+class Candidate:
+    id: int
+    prompt: str
+    round: int
+    parent_id: Optional[int] = None
+    summary: ScoreSummary = field(default_factory=ScoreSummary)
+    num_pulls: int = 0      # evaluations started; a pull that fails to produce a score still counts
+
+    @property
+    def mean(self):
+        return self.summary.mean if self.summary.n else 0.0
+
+    @property
+    def num_evaluated(self):
+        """Pulls that finished, scored or not."""
+        return self.summary.n + self.summary.num_failed
+
+    def ucb(self, total_pulls, exploration):
+        # A failed pull counts as reward 0, so a candidate that keeps failing loses its exploration bonus
+        if self.num_evaluated == 0:
+            return math.inf
+        mean = sum(self.summary.samples) / self.num_evaluated
+        return mean + exploration * math.sqrt(math.log(max(total_pulls, 1)) / self.num_evaluated)
+
+    def to_dict(self):
+        return {"id": self.id, "prompt": self.prompt, "round": self.round, "parent_id": self.parent_id,
+                "num_pulls": self.num_pulls, **self.summary.to_dict()}
+
+
+@dataclass
+class SearchResult:
+    best: Candidate
+    candidates: List[Candidate]
+    num_calls: int
+    num_tokens: int
+    stop_reason: str
+
+    def to_dict(self):
+        return {"best": self.best.to_dict(), "candidates": [c.to_dict() for c in self.candidates],
+                "num_calls": self.num_calls, "num_tokens": self.num_tokens, "stop_reason": self.stop_reason}
+
+#%% Search engine
+
+class APOSearch:
+    """Beam search over prompt rewrites with bandit allocation of the evaluation budget.
+
+    One evaluation ("pull") of a candidate plays one simulated dialogue with the candidate as custom prompt
+    and asks the judge for one score sample. Pull k of every candidate uses question set k mod
+    `num_question_sets` and seed k, so candidates are compared under the same conditions.
+    strategy="halving" runs successive halving over each round's pool (beam + new candidates), doubling
+    the pulls per survivor at every rung; strategy="ucb" spends `pulls_per_candidate` pulls per pool member
+    on the candidates with the highest upper confidence bound.
+    on_event(kind, payload) reports progress ("candidate", "pull", "round", "done").
+    """
+
+    def __init__(self, client, num_rounds=3, candidates_per_round=4, beam_width=2, strategy="halving",
+                 max_calls=None, max_tokens=None, num_question_sets=3, pulls_per_candidate=2, ucb_exploration=1.0,
+                 max_concurrency=8, seed=0, judge_temperature=1.0):
+        if strategy not in ("halving", "ucb"):
+            raise ValueError(f"Unknown search strategy '{strategy}', expected 'halving' or 'ucb'")
+        self.budget = SearchBudget(max_calls, max_tokens)
+        self.client = BudgetedClient(client, self.budget)
+        self.num_rounds = num_rounds
+        self.candidates_per_round = candidates_per_round
+        self.beam_width = beam_width
+        self.strategy = strategy
+        self.num_question_sets = num_question_sets
+        self.pulls_per_candidate = pulls_per_candidate
+        self.ucb_exploration = ucb_exploration
+        self.max_concurrency = max_concurrency
+        self.seed = seed
+        self.judge_temperature = judge_temperature
+
+    async def run(self, input_prompt, on_event=None):
+        """Optimizes an (unquoted) prompt and returns a SearchResult. The original prompt is candidate 0."""
+        on_event = on_event or (lambda kind, payload: None)
+        self._rng = random.Random(self.seed)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._requirements = quote_prompt(input_prompt)
+        self._question_sets = await self._generate_question_sets(self._requirements)
+
+        candidates = [Candidate(0, input_prompt, round=0)]
+        beam, stop_reason = list(candidates), "rounds completed"
+        for round_index in range(1, self.num_rounds + 1):
+            if self.budget.exhausted:
+                stop_reason = "budget exhausted"
+                break
+            with tracing.span("apo_round", round=round_index):
+                new_candidates = await self._generate_candidates(beam, round_index, candidates)
+                for candidate in new_candidates:
+                    on_event("candidate", candidate)
+                candidates.extend(new_candidates)
+
+                pool = beam + new_candidates
+                if self.strategy == "halving":
+                    await self._successive_halving(pool, on_event)
+                else:
+                    await self._ucb(pool, on_event)
+                beam = self._rank(pool)[:self.beam_width]
+            on_event("round", {"round": round_index, "beam": beam})
+        else:
+            if self.budget.exhausted:
+                stop_reason = "budget exhausted"
+
+        result = SearchResult(self._rank(candidates)[0], candidates, self.budget.num_calls, self.budget.num_tokens, stop_reason)
+        on_event("done", result)
+        return result
+
+    async def _generate_question_sets(self, requirements):
+        seeds = range(self.num_question_sets) if self.num_question_sets > 1 else [None]
+        return list(await asyncio.gather(*(Questioner(requirements, self.client, **({} if seed is None else {"seed": seed}))
+                                           for seed in seeds)))
+
+    async def _generate_candidates(self, beam, round_index, existing):
+        parents = [beam[i % len(beam)] for i in range(self.candidates_per_round)]
+        seeds = [self._rng.randrange(2 ** 31) for _ in parents]
+        rewrites = await asyncio.gather(*(
+            self._improve(parent, seed) for parent, seed in zip(parents, seeds)))
+
+        known_prompts = {candidate.prompt for candidate in existing}
+        new_candidates = []
+        for parent, rewrite in zip(parents, rewrites):
+            if rewrite and rewrite not in known_prompts:
+                known_prompts.add(rewrite)
+                new_candidates.append(Candidate(len(existing) + len(new_candidates), rewrite, round_index, parent.id))
+        return new_candidates
+
+    async def _improve(self, parent, seed):
+        try:
+            async with self._semaphore:
+                return await Improver(build_improver_context(parent.prompt, parent.summary.metric_means), self.client, seed=seed)
+        except Exception as e:
+            print(f"Candidate generation failed. ({e})")
+            return None
+
+    async def _pull(self, candidate, on_event):
+        pull_index = candidate.num_pulls
+        candidate.num_pulls += 1
+        questions = self._question_sets[pull_index % len(self._question_sets)]
+        reply = None
+        try:
+            async with self._semaphore, tracing.span("candidate_eval", candidate=candidate.id, pull=pull_index):
+                transcript = await ConversationSimulator(self.client, candidate.prompt).run(questions, seed=pull_index)
+                reply = await Judger(build_judger_context(self._requirements, transcript.to_text()), self.client,
+                                     seed=pull_index, temperature=self.judge_temperature)
+        except Exception as e:
+            print(f"Candidate evaluation failed. ({e})")
+        return candidate, reply
+
+    async def _pull_batch(self, candidates, on_event):
+        # Scores are recorded in dispatch order after the whole batch, so results do not depend on timing
+        for candidate, reply in await asyncio.gather(*(self._pull(candidate, on_event) for candidate in candidates)):
+            candidate.summary.add(reply)
+            on_event("pull", candidate)
+
+    async def _successive_halving(self, pool, on_event):
+        survivors, rung = list(pool), 0
+        while len(survivors) > 1 and not self.budget.exhausted:
+            target_pulls = self.pulls_per_candidate * 2 ** rung
+            batch = [candidate for candidate in survivors for _ in range(max(target_pulls - candidate.num_pulls, 0))]
+            await self._pull_batch(batch, on_event)
+            if len(survivors) <= self.beam_width:
+                break
+            survivors = self._rank(survivors)[:max(self.beam_width, math.ceil(len(survivors) / 2))]
+            rung += 1
+
+    async def _ucb(self, pool, on_event):
+        # Every candidate gets one pull, then each batch goes to the highest upper confidence bounds
+        await self._pull_batch([candidate for candidate in pool if candidate.num_pulls == 0], on_event)
+        remaining = self.pulls_per_candidate * len(pool) - len(pool)
+        while remaining > 0 and not self.budget.exhausted:
+            total_pulls = sum(candidate.num_evaluated for candidate in pool)
+            ranked = sorted(pool, key=lambda c: (-c.ucb(total_pulls, self.ucb_exploration), c.id))
+            batch = ranked[:min(remaining, self.max_concurrency, len(pool))]
+            await self._pull_batch(batch, on_event)
+            remaining -= len(batch)
+
+    @staticmethod
+    def _rank(candidates):
+        # Highest mean first; ties go to the better-evaluated, then the older candidate
+        return sorted(candidates, key=lambda c: (-c.mean, -c.summary.n, c.id))
+
+
+def main():
+    import json
+    from config import get_llm_client
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("prompt", help="prompt to optimize")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--candidates", type=int, default=4, help="new candidates per round")
+    parser.add_argument("--beam", type=int, default=2, help="candidates kept between rounds")
+    parser.add_argument("--strategy", choices=["halving", "ucb"], default="halving")
+    parser.add_argument("--budget-calls", type=int, default=None)
+    parser.add_argument("--budget-tokens", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the full search result to this JSON file")
+    args = parser.parse_args()
+
+    def report(kind, payload):
+        if kind == "round":
+            best = payload["beam"][0]
+            print(f"Round {payload['round']}: best candidate {best.id} scores {best.mean:.2f} over {best.summary.n} evaluations")
+
+    search = APOSearch(get_llm_client(), args.rounds, args.candidates, args.beam, args.strategy,
+                       args.budget_calls, args.budget_tokens, seed=args.seed)
+    result = asyncio.run(search.run(args.prompt, on_event=report))
+    print(f"Best prompt (candidate {result.best.id}, {result.best.mean:.2f}), "
+          f"{result.num_calls} calls, ~{result.num_tokens} tokens, {result.stop_reason}:\n\n{result.best.prompt}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,11 @@
-import os
-import time
 import streamlit as st
-from openai import OpenAI
-import json
+from config import get_llm_client
 
-api_key = st.secrets["auth_token"]
+# Built on the first run, then reused across reruns and sessions
+llm_client = st.cache_resource(get_llm_client)()
 
 # Function to rephrase the sentence
-def rephraser_model(content, model="gpt-4o-mini"):
-    openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", api_key))
-
+def rephraser_model(content, model="gpt-4o-mini", stream=False):
     messages = [
         {
             "role": "system",
@@ -19,19 +15,14 @@ def rephraser_model(content, model="gpt-4o-mini"):
         {"role": "user", "content": content}
     ]
 
-    response = openai_client.chat.completions.create(
-        model=model,
-        messages=messages,
-    )
-    content = response.choices[0].message.content
-    time.sleep(5)  # Add delay between requests
-    return content
+    # Pacing and retries are handled by the shared client's rate limiter; reruns hit its response cache
+    if stream:
+        return llm_client.stream_chat(messages, model=model, use_cache=True)
+    return llm_client.chat(messages, model=model, use_cache=True)
 
 
 # Function to apply the chain-of-thought
-def CoT_model(content, model="gpt-4o-mini"):
-    openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", api_key))
-
+def CoT_model(content, model="gpt-4o-mini", stream=False):
     messages = [
         {
             "role": "system",
@@ -42,13 +33,10 @@ def CoT_model(content, model="gpt-4o-mini"):
         {"role": "user", "content": content}
     ]
 
-    response = openai_client.chat.completions.create(
-        model=model,
-        messages=messages,
-    )
-    content = response.choices[0].message.content
-    time.sleep(5)  # Add delay between requests
-    return content
+    # Pacing and retries are handled by the shared client's rate limiter; reruns hit its response cache
+    if stream:
+        return llm_client.stream_chat(messages, model=model, use_cache=True)
+    return llm_client.chat(messages, model=model, use_cache=True)
 
 
 # Streamlit UI code
@@ -59,20 +47,21 @@ input_sentence = st.text_area("Enter a prompt for processing:")
 
 if st.button("Start"):
     if input_sentence:
-        # Rephrase the input sentence
-        with st.spinner("Processing first step..."):
-            rephrased_sentence = rephraser_model(input_sentence)
-
-        # Apply chain-of-thought to the rephrased sentence
-        with st.spinner("Processing second step..."):
-            final_result = CoT_model(rephrased_sentence)
-
         # Display results in tabs
         tab1, tab2 = st.tabs(["APO Result", ""])
 
         with tab1:
+            # Rephrase the input sentence, streaming the draft as it is generated
+            with st.expander("First step: rephrased prompt", expanded=True):
+                rephrase_stream = rephraser_model(input_sentence, stream=True)
+                rephrased_sentence = st.write_stream(rephrase_stream)
+                st.caption(f"First token after {rephrase_stream.time_to_first_token or 0:.2f}s")
+
+            # Apply chain-of-thought to the rephrased sentence
             st.subheader("APO Result")
-            st.write(final_result)
+            cot_stream = CoT_model(rephrased_sentence, stream=True)
+            final_result = st.write_stream(cot_stream)
+            st.caption(f"First token after {cot_stream.time_to_first_token or 0:.2f}s")
 
         # Option to save the final result
         # if st.button("Save to File"):
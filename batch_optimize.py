@@ -0,0 +1,137 @@
+"""Headless batch prompt optimization.
+
+Reads prompts from a JSONL file (one {"id": ..., "prompt": ...} object per line, "id" optional),
+runs rephrase -> CoT (and optionally the Questioner/chat/Judger evaluation) over a bounded pool of
+async workers, and appends one result per line to an output JSONL file. Records already completed
+in the output file are skipped, so an interrupted run can simply be restarted.
+
+Usage:
+    python batch_optimize.py prompts.jsonl results.jsonl --workers 8 [--evaluate [--dialogues 5]]
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from llm_client import get_shared_client
+from apo_models import quote_prompt, build_optimization_pipeline
+
+
+def load_prompt_records(input_path):
+    records = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Warning: Skipping invalid JSON on line {line_number} ({e})")
+                continue
+            if not isinstance(record, dict) or not record.get("prompt"):
+                print(f"Warning: Skipping line {line_number} without a prompt")
+                continue
+            record.setdefault("id", hashlib.sha1(record["prompt"].encode("utf-8")).hexdigest()[:16])
+            records.append(record)
+    return records
+
+
+def load_completed_ids(output_path):
+    """Returns the ids whose latest result line in the output file is a success."""
+    latest_status = {}
+    if os.path.exists(output_path):
+        with open(output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    latest_status[result["id"]] = result["status"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    continue  # torn write from an interrupted run
+    return {record_id for record_id, status in latest_status.items() if status == "done"}
+
+
+async def optimize_record(record, client, evaluate, max_concurrency, num_dialogues=1):
+    started = time.perf_counter()
+    pipeline = build_optimization_pipeline(quote_prompt(record["prompt"]), client, max_concurrency, evaluate,
+                                           num_dialogues=num_dialogues)
+    step_results = await pipeline.run()
+
+    failed = [r for r in step_results.values() if r.status == "failed"]
+    result = {
+        "id": record["id"],
+        "prompt": record["prompt"],
+        "status": "failed" if failed else "done",
+        "rephrased": step_results["rephrase"].value,
+        "final_result": step_results["cot"].value,
+    }
+    if evaluate:
+        result["evaluation"] = {name: r.value for name, r in step_results.items() if name.endswith("_questions")}
+        for name in ("original_chat", "new_chat"):
+            if step_results[name].status == "done":
+                result["evaluation"][name] = [transcript.to_dict() for transcript in step_results[name].value]
+        if step_results["judge"].status == "done":
+            result["evaluation"]["judge"] = step_results["judge"].value.to_dict()
+    if failed:
+        result["errors"] = {r.name: str(r.error) for r in failed}
+    result["elapsed"] = round(time.perf_counter() - started, 3)
+    result["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return result
+
+
+async def run_batch(records, output_path, client, num_workers=4, evaluate=False, max_concurrency_per_record=4, num_dialogues=1):
+    """Processes records with `num_workers` concurrent workers, appending each result as soon as it is ready."""
+    queue = asyncio.Queue()
+    for record in records:
+        queue.put_nowait(record)
+    counts = {"done": 0, "failed": 0}
+
+    with open(output_path, "a", encoding="utf-8") as output_file:
+        async def worker():
+            while True:
+                try:
+                    record = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    result = await optimize_record(record, client, evaluate, max_concurrency_per_record, num_dialogues)
+                except Exception as e:
+                    result = {"id": record["id"], "prompt": record["prompt"], "status": "failed", "errors": {"record": str(e)}}
+                output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output_file.flush()
+                counts[result["status"]] += 1
+                print(f"[{counts['done'] + counts['failed']}/{len(records)}] {record['id']}: {result['status']}")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, num_workers))))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input_path", help="JSONL file of prompts")
+    parser.add_argument("output_path", help="append-only JSONL file of results")
+    parser.add_argument("--workers", type=int, default=4, help="number of prompts processed concurrently")
+    parser.add_argument("--evaluate", action="store_true", help="also evaluate the original and the new prompt")
+    parser.add_argument("--dialogues", type=int, default=1, help="simulated dialogues per prompt when evaluating")
+    args = parser.parse_args()
+
+    records = load_prompt_records(args.input_path)
+    completed_ids = load_completed_ids(args.output_path)
+    pending, seen_ids = [], set(completed_ids)
+    for record in records:
+        if record["id"] not in seen_ids:
+            seen_ids.add(record["id"])
+            pending.append(record)
+    print(f"{len(records)} prompts, {len(records) - len(pending)} already completed or duplicated, {len(pending)} to run.")
+    if not pending:
+        return
+
+    client = get_shared_client(os.environ.get("OPENAI_API_KEY"))
+    started = time.perf_counter()
+    counts = asyncio.run(run_batch(pending, args.output_path, client, args.workers, args.evaluate,
+                                   num_dialogues=args.dialogues))
+    print(f"Finished in {time.perf_counter() - started:.1f}s: {counts['done']} done, {counts['failed']} failed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Recall@k / latency benchmark comparing the exact and IVF memory search backends.
+
+Usage:
+    python benchmark_recall.py --num-memories 100000 --nprobe 4 8 16 32
+    python benchmark_recall.py --memories-folder memories_20250215
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from memory_index import MemoryIndex
+from memory_store import MemoryStore
+from long_term_memory_manager import LongTermMemoryManager
+from vector_search import ExactSearch, IVFSearch, normalize_embeddings
+
+
+def make_clustered_embeddings(num_vectors, embedding_dim, num_clusters, rng, noise=0.35):
+    """Synthetic unit vectors grouped around random topics, roughly mimicking conversation embeddings."""
+    topics = normalize_embeddings(rng.standard_normal((num_clusters, embedding_dim)).astype(np.float32))
+    labels = rng.integers(num_clusters, size=num_vectors)
+    noise_vectors = rng.standard_normal((num_vectors, embedding_dim)).astype(np.float32) / np.sqrt(embedding_dim)
+    return normalize_embeddings(topics[labels] + np.float32(noise) * noise_vectors)
+
+
+def build_index(folder_path, embeddings, search_backend, batch_size=10000):
+    index = MemoryIndex(folder_path, embeddings.shape[1], ExactSearch())
+    for start in range(0, len(embeddings), batch_size):
+        batch = embeddings[start:start + batch_size]
+        index.add_many(batch, [{"row": start + i} for i in range(len(batch))])
+    # Reopen with the requested backend so that training is measured separately from ingestion
+    started = time.perf_counter()
+    index = MemoryIndex(folder_path, embeddings.shape[1], search_backend)
+    return index, time.perf_counter() - started
+
+
+def run_queries(index, queries, k):
+    results, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        indices, _ = index.search(query, k)
+        latencies.append(time.perf_counter() - started)
+        results.append(set(int(i) for i in indices))
+    return results, np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--memories-folder", help="benchmark an existing memory folder instead of synthetic data")
+    parser.add_argument("--num-memories", type=int, default=50000)
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.memories_folder:
+        source = MemoryStore(os.path.join(args.memories_folder, LongTermMemoryManager.STORE_FOLDER_NAME))
+        embeddings = np.asarray(source.embeddings, dtype=np.float32)
+    else:
+        embeddings = make_clustered_embeddings(args.num_memories, args.embedding_dim, max(args.num_memories // 200, 8), rng)
+    queries = embeddings[rng.choice(len(embeddings), size=min(args.num_queries, len(embeddings)), replace=False)]
+    queries = normalize_embeddings(queries + rng.standard_normal(queries.shape).astype(np.float32) * 0.01)
+
+    work_dir = tempfile.mkdtemp(prefix="memory_recall_")
+    try:
+        exact_index, _ = build_index(os.path.join(work_dir, "exact"), embeddings, ExactSearch())
+        ground_truth, exact_latencies = run_queries(exact_index, queries, args.k)
+        print(f"{len(embeddings)} memories, {len(queries)} queries, k={args.k}")
+        print(f"{'backend':<16}{'recall@k':>10}{'mean ms':>10}{'p95 ms':>10}{'build s':>10}")
+        print(f"{'exact':<16}{1.0:>10.3f}{exact_latencies.mean():>10.3f}{np.percentile(exact_latencies, 95):>10.3f}{0.0:>10.2f}")
+
+        ivf_folder = os.path.join(work_dir, "ivf")
+        for nprobe in args.nprobe:
+            backend = IVFSearch(nlist=args.nlist, nprobe=nprobe, min_train_size=1, seed=args.seed)
+            if os.path.exists(ivf_folder):
+                # Reuse the trained quantizer, only the probe width changes
+                ivf_index, build_seconds = MemoryIndex(ivf_folder, embeddings.shape[1], backend), 0.0
+            else:
+                ivf_index, build_seconds = build_index(ivf_folder, embeddings, backend)
+            results, latencies = run_queries(ivf_index, queries, args.k)
+            recall = np.mean([len(r & t) / max(len(t), 1) for r, t in zip(results, ground_truth)])
+            print(f"{'ivf nprobe=' + str(nprobe):<16}{recall:>10.3f}{latencies.mean():>10.3f}"
+                  f"{np.percentile(latencies, 95):>10.3f}{build_seconds:>10.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""End-to-end offline benchmark of the optimize, simulate, judge and memory-retrieval pipelines.
+
+Every scenario runs against llm_providers.FakeProvider through the real LLMClient (rate limiting, retries),
+so the numbers measure our own orchestration under a configurable latency / error / token profile.
+Results are written to benchmark_results/<timestamp>_<commit>.json; pass --compare with an earlier
+result file to print the change per scenario.
+
+Usage:
+    python benchmark_suite.py --iterations 20 --concurrency 4
+    python benchmark_suite.py --scenarios judge memory --error-rate 0.05 --compare benchmark_results/<file>.json
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from llm_client import LLMClient
+from llm_providers import FakeProvider
+from apo_models import quote_prompt, build_optimization_pipeline, build_judger_context
+from conversation_simulator import ConversationSimulator
+from judging import JudgingEngine
+
+RESULTS_FOLDER = "benchmark_results"
+SCENARIOS = ["optimize", "simulate", "judge", "memory"]
+
+SAMPLE_PROMPT = ("You are Pika, a friendly tutor for primary school students. Answer in Vietnamese, keep every reply "
+                 "short, ask a follow-up question and never give the final answer to homework directly.")
+SAMPLE_QUESTIONS = ["Xin chào Pika!", "2 + 3 bằng mấy?", "Tại sao bầu trời màu xanh?", "Kể cho em một câu chuyện.", "Cảm ơn Pika!"]
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+#%% Scenarios
+# Each scenario returns an async callable running iteration i; they all share one client and provider
+
+def make_optimize_scenario(client, args):
+    async def run(i):
+        results = await build_optimization_pipeline(quote_prompt(f"{SAMPLE_PROMPT} (variant {i})"), client, evaluate=False).run()
+        failed = [r for r in results.values() if r.status != "done"]
+        if failed:
+            raise RuntimeError(f"{failed[0].name}: {failed[0].error}")
+    return run
+
+def make_simulate_scenario(client, args):
+    async def run(i):
+        simulator = ConversationSimulator(client, f"{SAMPLE_PROMPT} (variant {i})")
+        await simulator.run_many([SAMPLE_QUESTIONS] * args.dialogues, seeds=list(range(args.dialogues)))
+    return run
+
+def make_judge_scenario(client, args):
+    transcript = "".join(f"User: {question}\n\nPika: Câu trả lời mẫu.\n\n" for question in SAMPLE_QUESTIONS)
+    engine = JudgingEngine(client)
+
+    async def run(i):
+        await engine.compare(build_judger_context(quote_prompt(SAMPLE_PROMPT), transcript + f"(run {i}, original)"),
+                             build_judger_context(quote_prompt(SAMPLE_PROMPT), transcript + f"(run {i}, new)"))
+    return run
+
+def make_memory_scenario(client, args, work_dir):
+    import prompt_utils
+    from embedding_cache import EmbeddingCache
+    from long_term_memory_manager import LongTermMemoryManager
+
+    manager = LongTermMemoryManager(os.path.join(work_dir, "memories"), prompt_utils.get_current_time(), llm_client=client,
+                                    embedding_cache=EmbeddingCache(os.path.join(work_dir, "embeddings.sqlite3")))
+    rng = np.random.default_rng(args.seed)
+    vocabulary = SAMPLE_PROMPT.split() + " ".join(SAMPLE_QUESTIONS).split()
+    conversations = [[{"role": "user", "content": " ".join(rng.choice(vocabulary, size=30))},
+                      {"role": "assistant", "content": " ".join(rng.choice(vocabulary, size=60))}]
+                     for _ in range(args.num_memories)]
+    started = time.perf_counter()
+    manager.store_many(conversations)
+    print(f"memory: stored {args.num_memories} memories in {time.perf_counter() - started:.2f}s")
+
+    async def run(i):
+        query = [{"role": "user", "content": " ".join(rng.choice(vocabulary, size=20))}]
+        await asyncio.to_thread(manager.fetch_memory_related_to_conversation_seq, query, num_neighbors=3)
+    return run
+
+#%% Runner
+
+async def run_scenario(run_iteration, iterations, concurrency):
+    """Runs `iterations` iterations with at most `concurrency` in flight. Returns (latencies in s, errors, wall time)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def timed(i):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await run_iteration(i)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(repr(e))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(iterations)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def summarize(latencies, errors, wall_seconds, iterations, usage):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "iterations": iterations,
+        "failed_iterations": len(errors),
+        "p50_ms": float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else None,
+        "p95_ms": float(np.percentile(latencies_ms, 95)) if len(latencies_ms) else None,
+        "mean_ms": float(latencies_ms.mean()) if len(latencies_ms) else None,
+        "throughput_per_s": len(latencies) / wall_seconds if wall_seconds else None,
+        "llm_calls": usage["chat_calls"] + usage["embedding_calls"],
+        "provider_errors": usage["errors"],
+        "tokens": usage["total_tokens"],
+        "tokens_per_iteration": usage["total_tokens"] / iterations if iterations else None,
+        "first_error": errors[0] if errors else None,
+    }
+
+
+def print_report(results, baseline=None):
+    print(f"{'scenario':<12}{'p50 ms':>10}{'p95 ms':>10}{'iter/s':>9}{'calls':>8}{'tokens':>10}{'failed':>8}")
+    for name, stats in results["scenarios"].items():
+        p50, p95 = stats["p50_ms"] or 0.0, stats["p95_ms"] or 0.0
+        line = (f"{name:<12}{p50:>10.1f}{p95:>10.1f}{stats['throughput_per_s'] or 0.0:>9.2f}"
+                f"{stats['llm_calls']:>8}{stats['tokens']:>10}{stats['failed_iterations']:>8}")
+        base = (baseline or {}).get("scenarios", {}).get(name)
+        if base and base.get("p50_ms") and base.get("p95_ms") and stats["p50_ms"]:
+            line += (f"   p50 {100 * (stats['p50_ms'] / base['p50_ms'] - 1):+.1f}%"
+                     f"  p95 {100 * (stats['p95_ms'] / base['p95_ms'] - 1):+.1f}%"
+                     f"  tokens {stats['tokens'] - base['tokens']:+d}")
+        print(line)
+    if baseline:
+        print(f"(compared with {baseline.get('commit')} from {baseline.get('timestamp')})")
+
+
+async def run_suite(args):
+    provider = FakeProvider(latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+                            seconds_per_token=args.seconds_per_token, completion_tokens_mean=args.completion_tokens,
+                            error_rate=args.error_rate, time_scale=args.time_scale, seed=args.seed)
+    client = LLMClient(provider=provider, requests_per_minute=args.requests_per_minute, base_delay=0.05, max_delay=1.0)
+
+    work_dir = tempfile.mkdtemp(prefix="apo_benchmark_")
+    try:
+        scenarios = {}
+        for name in args.scenarios:
+            if name == "memory":
+                run_iteration = make_memory_scenario(client, args, work_dir)
+            else:
+                run_iteration = {"optimize": make_optimize_scenario, "simulate": make_simulate_scenario,
+                                 "judge": make_judge_scenario}[name](client, args)
+            provider.reset_stats()
+            latencies, errors, wall_seconds = await run_scenario(run_iteration, args.iterations, args.concurrency)
+            scenarios[name] = summarize(latencies, errors, wall_seconds, args.iterations, provider.stats())
+        return scenarios
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4, help="iterations in flight at once")
+    parser.add_argument("--dialogues", type=int, default=5, help="dialogues per simulate iteration")
+    parser.add_argument("--num-memories", type=int, default=2000)
+    parser.add_argument("--latency-median", type=float, default=0.3, help="median time to first token in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--seconds-per-token", type=float, default=0.004)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--requests-per-minute", type=int, default=3000)
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiplies every simulated delay")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    scenarios = asyncio.run(run_suite(args))
+    results = {"commit": get_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": vars(args),
+               "scenarios": scenarios}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        output_path = os.path.join(RESULTS_FOLDER, f"{time.strftime('%Y%m%d_%H%M%S')}_{results['commit']}.json")
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,108 @@
-import os
-import time
-from openai import OpenAI
 import prompt_utils
-from long_term_memory_manager import LongTermMemoryManager
-import streamlit as st
+import message_assembly
+from config import AppConfig, get_llm_client, get_memory_manager as get_memory_manager_for_folder
 
-api_key = st.secrets["auth_token"]
-openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", api_key))
+# Importing this module is side-effect free: the API key, client and memory manager are built on first use
+config = AppConfig()
 
-# Display current date and time
-curr_date, day_of_week, curr_time = prompt_utils.get_current_time()
-print(f'-------------------------------\n{curr_date}\n{day_of_week}\n{curr_time}\n-------------------------------')
-
-user_name = '20250215'
-chatbot_name = 'Pika'       # default is Assistant
-memory_folderename = 'memories_' + user_name
+user_name = config.user_name
+chatbot_name = config.chatbot_name
+memory_folderename = config.memory_folder_path
 
 # Memory related params
-pre_fetch_from_memory = True
-post_fetch_from_memory = False
-num_neighbors = 2
-min_similarity = 0.2
+pre_fetch_from_memory = config.pre_fetch_from_memory
+post_fetch_from_memory = config.post_fetch_from_memory
+num_neighbors = config.num_neighbors
+min_similarity = config.min_similarity
+retrieved_memory_tokens_budget = config.retrieved_memory_tokens_budget
 
 # Model related params
-temperature = 0.7
+temperature = config.temperature
 
 # Token management
-max_num_tries = 4
-max_tokens_to_generate_per_message = 320
-context_length_hard_limit = 4096
-context_length_limit = context_length_hard_limit - max_tokens_to_generate_per_message
-system_prompt_tokens_budget = context_length_hard_limit - 768
-
-# Instantiate long term memory manager
-os.makedirs(memory_folderename, exist_ok=True)
-memory_manager = LongTermMemoryManager(memory_folderename, prompt_utils.get_current_time())
+max_tokens_to_generate_per_message = config.max_tokens_to_generate_per_message
+context_length_hard_limit = config.context_length_hard_limit
+context_length_limit = config.context_length_limit
+system_prompt_tokens_budget = config.system_prompt_tokens_budget
+summarize_evicted_turns = config.summarize_evicted_turns     # one extra call each time turns are evicted
+
+def get_memory_manager():
+    # Single-user memory of config.user_name; serve several users with config.get_memory_pool() instead
+    return get_memory_manager_for_folder(memory_folderename)
+
+def __getattr__(name):
+    # Backwards-compatible lazy module attributes
+    if name == "llm_client":
+        return get_llm_client()
+    if name == "memory_manager":
+        return get_memory_manager()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+#%% Conversation history
+
+def summarize_conversation_turns(evicted_messages, previous_summary=None):
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in evicted_messages)
+    if previous_summary:
+        transcript = previous_summary + "\n" + transcript
+    summary = send_query_to_chatgpt(prompt_utils.wrap_prompt(
+        "Summarize the following conversation in a few sentences, keeping names, preferences and open questions:\n\n" + transcript))
+    return f"Summary of the earlier conversation: {summary}" if summary else previous_summary
+
+def new_conversation_history(prefix_messages=(), system_prompt=None):
+    # Requests are kept under context_length_limit, leaving room for the generated reply.
+    # A system_prompt is placed after prefix_messages as a stable system message (see message_assembly)
+    summarizer = summarize_conversation_turns if summarize_evicted_turns else None
+    return message_assembly.extend_prefix(prefix_messages, system_prompt).new_window(context_length_limit, summarizer)
 
 # Initialize conversation history
-curr_conversation_history = []
+curr_conversation_history = new_conversation_history()
+
+#%% Memory retrieval
+
+def fetch_memory_reminder(memory_manager, user_input):
+    """The reminder exchange of the past conversations most related to user_input, packed into
+    retrieved_memory_tokens_budget: memories that do not fit whole keep only their turns that match user_input."""
+    query = [{"role": "user", "content": user_input}]
+    memories, aux = memory_manager.fetch_memory_related_to_conversation_seq(query, num_neighbors=num_neighbors,
+                                                                            min_similarity=min_similarity)
+    if not memories:
+        return []
+    # Ranking scores are numeric in every retrieval mode, unlike similarities (None for lexical retrieval)
+    return prompt_utils.wrap_retrieved_memories(memories, retrieved_memory_tokens_budget,
+                                                similarities=aux["memory_scores"], query_string=user_input)
 
 #%% Function to call ChatGPT
 
-def send_query_to_chatgpt(chatgpt_query, max_num_tries=3):
-    for i in range(max_num_tries):
-        try:
-            
-            # Ensure that chatgpt_query is correctly formatted
-            if not isinstance(chatgpt_query, list) or not all(isinstance(msg, dict) for msg in chatgpt_query):
-                raise ValueError("chatgpt_query must be a list of dictionaries")
-
-            completion = openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=chatgpt_query, 
-                temperature=temperature, 
-                max_tokens=max_tokens_to_generate_per_message
-            )
-
-            # Corrected response parsing
-            response_string = completion.choices[0].message.content  # Correct access
-            return response_string  # Return only the response string
-
-        except ValueError as ve:
-            print(f"Invalid input format: {ve}")
-            return None
-        except Exception as e:
-            print(f"ChatGPT failed. Retrying... ({e})")
-            time.sleep(3 * (i + 1))
-
-    return None  # Return None if all attempts fail
+def send_query_to_chatgpt(chatgpt_query):
+    # Ensure that chatgpt_query is correctly formatted
+    if not isinstance(chatgpt_query, list) or not all(isinstance(msg, dict) for msg in chatgpt_query):
+        print("Invalid input format: chatgpt_query must be a list of dictionaries")
+        return None
+
+    try:
+        # Rate limiting and retries with backoff on retriable errors happen in the shared client
+        return get_llm_client().chat(
+            chatgpt_query,
+            model=config.chat_model,
+            temperature=temperature,
+            max_tokens=max_tokens_to_generate_per_message
+        )
+    except Exception as e:
+        print(f"ChatGPT failed. ({e})")
+        return None  # Return None if all attempts fail
+
+def stream_query_to_chatgpt(chatgpt_query):
+    # Returns a ChatStream to iterate for the reply chunks, or None if the query is malformed
+    if not isinstance(chatgpt_query, list) or not all(isinstance(msg, dict) for msg in chatgpt_query):
+        print("Invalid input format: chatgpt_query must be a list of dictionaries")
+        return None
+
+    return get_llm_client().stream_chat(
+        chatgpt_query,
+        model=config.chat_model,
+        temperature=temperature,
+        max_tokens=max_tokens_to_generate_per_message
+    )
 
 def load_questions_from_txt(txt_path):
     questions_list = []
@@ -92,7 +127,7 @@ def chat_loop(question_list, output_file="conversation.txt"):
                 break
 
             user_prompt = {"role": "user", "content": user_input}
-            chatgpt_query = curr_conversation_history + [user_prompt]  
+            chatgpt_query = curr_conversation_history.build_query(user_prompt)
 
             response_string = send_query_to_chatgpt(chatgpt_query)
 
@@ -119,7 +154,7 @@ def chat_loop_v1(question_list):
             break
 
         user_prompt = {"role": "user", "content": user_input}
-        chatgpt_query = curr_conversation_history + [user_prompt]  
+        chatgpt_query = curr_conversation_history.build_query(user_prompt)
 
         response_string = send_query_to_chatgpt(chatgpt_query)
 
@@ -139,9 +174,22 @@ def chat_loop_v1(question_list):
 
     return "".join(conversation_log) 
 
-def chat_loop_v2(question_list, custom_prompt=None):
-    global curr_conversation_history
-    conversation_log = []  # Store conversation as a list of strings
+def chat_loop_v2(question_list, custom_prompt=None, conversation_history=None, memory_manager=None):
+    # Pass a dedicated conversation_history (see new_conversation_history) to run several dialogues side by side
+    return "".join(chat_loop_v2_stream(question_list, custom_prompt, conversation_history, memory_manager=memory_manager))
+
+def chat_loop_v2_stream(question_list, custom_prompt=None, conversation_history=None, on_turn_done=None,
+                        memory_manager=None):
+    # Same dialogue as chat_loop_v2, but yields the conversation log chunk by chunk as replies stream in.
+    # on_turn_done(user_input, stream) is called after each turn, e.g. to report stream.time_to_first_token.
+    # With a memory_manager (e.g. get_memory_manager()) and pre_fetch_from_memory, each turn is sent with a
+    # reminder of the related past conversations (see fetch_memory_reminder); the reminder is not kept in the history
+    if conversation_history is None:
+        conversation_history = curr_conversation_history
+    if custom_prompt:
+        # The custom prompt is sent once, as a stable system message after the history's prefix, rather than with
+        # every user message. The dialogue runs on a copy of the history, so the prompt does not outlive this call
+        conversation_history = message_assembly.derive_history(conversation_history, custom_prompt)
 
     for question in question_list:
         user_input = question
@@ -149,34 +197,38 @@ def chat_loop_v2(question_list, custom_prompt=None):
         if user_input.lower() in ["exit", "quit"]:
             break
 
-        # Use the custom prompt if provided, otherwise use default conversation history
-        if custom_prompt:
-            user_prompt = {"role": "user", "content": custom_prompt + " " + user_input}
-        else:
-            user_prompt = {"role": "user", "content": user_input}
-
-        chatgpt_query = curr_conversation_history + [user_prompt]
-
-        response_string = send_query_to_chatgpt(chatgpt_query)
-
-        if response_string:
-            # Format conversation entry
-            entry = f"User: {user_input}\n\n{chatbot_name}: {response_string}\n\n"
-
-            # Store conversation in memory
-            conversation_log.append(entry)
+        user_prompt = {"role": "user", "content": user_input}
+        memory_reminder = []
+        if memory_manager is not None and pre_fetch_from_memory:
+            memory_reminder = fetch_memory_reminder(memory_manager, user_input)
+
+        chatgpt_query = conversation_history.build_query(user_prompt, memory_reminder)
+        stream = stream_query_to_chatgpt(chatgpt_query)
+
+        completed = False
+        if stream is not None:
+            try:
+                for i, chunk in enumerate(stream):
+                    if i == 0:
+                        yield f"User: {user_input}\n\n{chatbot_name}: "
+                    yield chunk
+                completed = bool(stream.text)
+            except Exception as e:
+                print(f"ChatGPT failed. ({e})")
+
+        if completed:
+            yield "\n\n"
 
             # Update conversation history
-            curr_conversation_history.append(user_prompt)
-            curr_conversation_history.append({"role": "assistant", "content": response_string})
+            conversation_history.append(user_prompt)
+            conversation_history.append({"role": "assistant", "content": stream.text})
+        elif stream is not None and stream.text:
+            yield "\nError: Response interrupted.\n\n"
         else:
-            error_entry = f"User: {user_input}\nError: Unable to retrieve response.\n\n"
-            conversation_log.append(error_entry)
-
-        # Wait for 1 second before processing the next question
-        time.sleep(1)
+            yield f"User: {user_input}\nError: Unable to retrieve response.\n\n"
 
-    return "".join(conversation_log)
+        if on_turn_done and stream is not None:
+            on_turn_done(user_input, stream)
 
 
 
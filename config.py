@@ -0,0 +1,77 @@
+import os
+import functools
+from dataclasses import dataclass
+
+#%% Configuration
+
+@dataclass(frozen=True)
+class AppConfig:
+    """Settings for the chat simulation and memory. Building one has no side effects."""
+
+    user_name: str = '20250215'
+    chatbot_name: str = 'Pika'       # default is Assistant
+    chat_model: str = 'gpt-3.5-turbo'
+
+    # Memory related params
+    pre_fetch_from_memory: bool = True
+    post_fetch_from_memory: bool = False
+    num_neighbors: int = 2
+    min_similarity: float = 0.2
+    retrieved_memory_tokens_budget: int = 1024     # tokens of retrieved memories sent with each turn
+    memory_pool_budget_mb: int = 1024      # resident memory stores kept loaded when serving many users
+
+    # Model related params
+    temperature: float = 0.7
+
+    # Token management
+    max_tokens_to_generate_per_message: int = 320
+    context_length_hard_limit: int = 4096
+    summarize_evicted_turns: bool = False     # fold turns that leave the context window into a summary
+
+    @property
+    def memory_folder_path(self):
+        return 'memories_' + self.user_name
+
+    @property
+    def context_length_limit(self):
+        return self.context_length_hard_limit - self.max_tokens_to_generate_per_message
+
+    @property
+    def system_prompt_tokens_budget(self):
+        return self.context_length_hard_limit - 768
+
+
+def get_api_key():
+    """OPENAI_API_KEY from the environment, falling back to the Streamlit secret `auth_token`."""
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if api_key:
+        return api_key
+    import streamlit as st
+    return st.secrets["auth_token"]
+
+#%% Lazily built, process-wide resources
+
+def get_llm_client():
+    """Returns the shared LLMClient, creating it (and importing openai) on first use."""
+    from llm_client import get_shared_client
+    if os.environ.get("APO_LLM_PROVIDER", "").lower() == "fake":
+        return get_shared_client()     # offline, no API key needed
+    return get_shared_client(get_api_key())
+
+@functools.lru_cache(maxsize=None)
+def get_memory_manager(memory_folder_path):
+    """Returns the LongTermMemoryManager for a folder, created once per process. The folder is loaded on first query."""
+    import prompt_utils
+    from long_term_memory_manager import LongTermMemoryManager
+
+    # Display session start date and time
+    curr_date, day_of_week, curr_time = session_start = prompt_utils.get_current_time()
+    print(f'-------------------------------\n{curr_date}\n{day_of_week}\n{curr_time}\n-------------------------------')
+
+    return LongTermMemoryManager(memory_folder_path, session_start, llm_client=get_llm_client())
+
+@functools.lru_cache(maxsize=None)
+def get_memory_pool():
+    """Returns the process-wide MemoryManagerPool holding one memory per user id (memories_<user id> folders)."""
+    from memory_pool import MemoryManagerPool
+    return MemoryManagerPool(memory_budget_bytes=AppConfig().memory_pool_budget_mb << 20, llm_client=get_llm_client())
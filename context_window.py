@@ -0,0 +1,126 @@
+from collections import deque
+import prompt_utils
+
+# Tokens the chat format adds around each message (role and separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+class ContextWindow:
+    """Sliding window over a conversation that keeps each request under a token budget.
+
+    Every message is tokenized once when it is appended and the window keeps a running total,
+    so building a request costs O(window) and never re-tokenizes the history. When a request
+    would exceed `token_budget`, the oldest turns are evicted; with a `summarizer` they are folded
+    into a running summary message instead of being dropped.
+    `summarizer(evicted_messages, previous_summary)` must return the new summary string.
+    Pass `prefix_tokens` when the prefix's size is already known (see message_assembly.PromptPrefix).
+    """
+
+    def __init__(self, token_budget, prefix_messages=(), summarizer=None, model=prompt_utils.DEFAULT_TOKENIZER_MODEL,
+                 prefix_tokens=None):
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.model = model
+        self.prefix_messages = list(prefix_messages)
+        self.prefix_tokens = sum(self.count_message_tokens(message) for message in self.prefix_messages) \
+            if prefix_tokens is None else prefix_tokens
+        self.summary_message = None
+        self.summary_tokens = 0
+        self.turns = deque()      # (message, num_tokens)
+        self.window_tokens = 0
+        self.num_evicted = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    @property
+    def messages(self):
+        summary = [self.summary_message] if self.summary_message else []
+        return self.prefix_messages + summary + [message for message, _ in self.turns]
+
+    @property
+    def total_tokens(self):
+        return self.prefix_tokens + self.summary_tokens + self.window_tokens
+
+    def with_prefix(self, prefix_messages, prefix_tokens=None):
+        """A copy of this window (summary and turns) whose requests start with prefix_messages instead.
+
+        Turns appended to the copy are not added to this window.
+        """
+        window = ContextWindow(self.token_budget, prefix_messages, self.summarizer, self.model, prefix_tokens)
+        window.summary_message, window.summary_tokens = self.summary_message, self.summary_tokens
+        window.turns, window.window_tokens = deque(self.turns), self.window_tokens
+        return window
+
+    def count_message_tokens(self, message):
+        return prompt_utils.count_tokens_from_string(message["content"], self.model) + MESSAGE_TOKEN_OVERHEAD
+
+    def append(self, message):
+        num_tokens = self.count_message_tokens(message)
+        self.turns.append((message, num_tokens))
+        self.window_tokens += num_tokens
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def build_query(self, user_prompt, context_messages=()):
+        """Returns prefix + summary + window + context_messages + user_prompt, evicting old turns so that it fits.
+
+        context_messages (e.g. retrieved memories) are sent with this request only and never kept in the window.
+        """
+        context_messages = list(context_messages)
+        self.fit(self.token_budget - sum(self.count_message_tokens(message) for message in context_messages + [user_prompt]))
+        return self.messages + context_messages + [user_prompt]
+
+    def fit(self, token_budget):
+        """Evicts the oldest turns until the window fits `token_budget`. Never leaves a leading assistant reply.
+
+        A summary that does not fit on its own once every turn is evicted is truncated, or dropped.
+        """
+        while True:
+            evicted = []
+            while self.turns and (self.total_tokens > token_budget or (evicted and self.turns[0][0]["role"] == "assistant")):
+                message, num_tokens = self.turns.popleft()
+                self.window_tokens -= num_tokens
+                evicted.append(message)
+
+            if not evicted:
+                break
+            self.num_evicted += len(evicted)
+            if self.summarizer is None:
+                break
+            # The updated summary takes up room too, so keep evicting until both fit
+            self._update_summary(evicted)
+            if self.total_tokens <= token_budget or not self.turns:
+                break
+
+        if self.summary_message and self.total_tokens > token_budget:
+            self._truncate_summary(token_budget - self.prefix_tokens - self.window_tokens)
+
+    def clear(self):
+        self.turns.clear()
+        self.window_tokens = 0
+        self.summary_message = None
+        self.summary_tokens = 0
+
+    def _update_summary(self, evicted):
+        previous_summary = self.summary_message["content"] if self.summary_message else None
+        summary = self.summarizer(evicted, previous_summary)
+        if not summary:
+            return
+        self.summary_message = {"role": "system", "content": summary}
+        self.summary_tokens = self.count_message_tokens(self.summary_message)
+
+    def _truncate_summary(self, max_tokens):
+        content = prompt_utils.truncate_to_tokens(self.summary_message["content"], max_tokens - MESSAGE_TOKEN_OVERHEAD,
+                                                  self.model)
+        summary_message = {"role": "system", "content": content}
+        num_tokens = self.count_message_tokens(summary_message)
+        if content and num_tokens <= max_tokens:
+            self.summary_message, self.summary_tokens = summary_message, num_tokens
+        else:
+            self.summary_message, self.summary_tokens = None, 0
@@ -0,0 +1,122 @@
+import time
+import asyncio
+from dataclasses import dataclass, field
+from typing import List, Optional
+import tracing
+import message_assembly
+from config import AppConfig
+
+
+@dataclass
+class Turn:
+    user: str
+    assistant: str = ""
+    error: Optional[str] = None
+    time_to_first_token: Optional[float] = None
+    elapsed: float = 0.0
+
+
+@dataclass
+class Transcript:
+    """One simulated dialogue. Turns are appended (and their replies filled in) while the dialogue runs."""
+
+    questions: List[str]
+    custom_prompt: Optional[str] = None
+    seed: Optional[int] = None
+    turns: List[Turn] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def num_failed_turns(self):
+        return sum(1 for turn in self.turns if turn.error)
+
+    def to_text(self, chatbot_name=AppConfig.chatbot_name):
+        """The conversation log in the format of chat_memgpt.chat_loop_v2."""
+        lines = []
+        for turn in self.turns:
+            if turn.error and not turn.assistant:
+                lines.append(f"User: {turn.user}\nError: {turn.error}\n\n")
+            elif turn.error:
+                lines.append(f"User: {turn.user}\n\n{chatbot_name}: {turn.assistant}\nError: {turn.error}\n\n")
+            else:
+                lines.append(f"User: {turn.user}\n\n{chatbot_name}: {turn.assistant}\n\n")
+        return "".join(lines)
+
+    def to_dict(self):
+        return {"questions": self.questions, "seed": self.seed, "elapsed": self.elapsed,
+                "turns": [vars(turn).copy() for turn in self.turns]}
+
+
+class ConversationSimulator:
+    """Plays scripted user questions against the chat model, each dialogue with its own history.
+
+    The simulator holds no per-dialogue state, so one instance can run any number of dialogues at once:
+    `run_many` plays K question sets concurrently over the shared async client, so K dialogues take
+    about as long as the longest one (within the client's rate limits).
+    `on_update(transcript)` is called whenever a dialogue's transcript changes, e.g. to stream it to the UI.
+    The custom prompt is sent as the leading system message of every request, so the request prefix stays identical
+    across turns and dialogues and the provider's prompt cache can serve it.
+    """
+
+    def __init__(self, client, custom_prompt=None, config=None):
+        self.client = client
+        self.custom_prompt = custom_prompt
+        self.config = config or AppConfig()
+
+    def new_history(self):
+        # Requests are kept under context_length_limit, leaving room for the generated reply
+        return message_assembly.new_history(self.config.context_length_limit, self.custom_prompt)
+
+    async def run(self, questions, seed=None, on_update=None):
+        """Plays one dialogue and returns its Transcript. Failed turns are recorded and skipped from the history."""
+        transcript = Transcript(list(questions), self.custom_prompt, seed)
+        history = self.new_history()
+        params = {"temperature": self.config.temperature, "max_tokens": self.config.max_tokens_to_generate_per_message}
+        if seed is not None:
+            params["seed"] = seed
+        started = time.perf_counter()
+        with tracing.span("dialogue", seed=seed):
+            for question in transcript.questions:
+                if question.lower() in ["exit", "quit"]:
+                    break
+                with tracing.span("chat_turn", turn=len(transcript.turns)):
+                    await self._play_turn(transcript, history, question, params, on_update)
+
+        transcript.elapsed = time.perf_counter() - started
+        return transcript
+
+    async def _play_turn(self, transcript, history, question, params, on_update):
+        user_prompt = {"role": "user", "content": question}
+        turn = Turn(question)
+        transcript.turns.append(turn)
+        turn_started = time.perf_counter()
+        stream = self.client.astream_chat(history.build_query(user_prompt), model=self.config.chat_model, **params)
+        try:
+            async for _ in stream:
+                turn.assistant = stream.text
+                turn.time_to_first_token = stream.time_to_first_token
+                if on_update:
+                    on_update(transcript)
+        except Exception as e:
+            print(f"ChatGPT failed. ({e})")
+            turn.error = "Response interrupted." if stream.text else "Unable to retrieve response."
+        else:
+            if not stream.text:
+                turn.error = "Unable to retrieve response."
+        turn.elapsed = time.perf_counter() - turn_started
+
+        if not turn.error:
+            history.append(user_prompt)
+            history.append({"role": "assistant", "content": stream.text})
+        if on_update:
+            on_update(transcript)
+
+    async def run_many(self, question_sets, seeds=None, on_update=None):
+        """Plays one dialogue per question set concurrently and returns their Transcripts in order.
+
+        `seeds`, if given, holds one sampling seed per dialogue. on_update(index, transcript) identifies the dialogue.
+        """
+        seeds = seeds or [None] * len(question_sets)
+        return list(await asyncio.gather(*(
+            self.run(questions, seed, on_update=(lambda transcript, i=i: on_update(i, transcript)) if on_update else None)
+            for i, (questions, seed) in enumerate(zip(question_sets, seeds)))))
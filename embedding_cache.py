@@ -0,0 +1,82 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+
+DEFAULT_EMBEDDING_CACHE_PATH = os.path.join(".apo_cache", "embeddings.sqlite3")
+
+
+def normalize_text(input_string):
+    """Canonical form used for cache keys: NFC, trimmed, whitespace runs collapsed."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", input_string)).strip()
+
+
+class EmbeddingCache:
+    """Persistent SQLite cache of embeddings keyed by a hash of the model and the normalized text.
+
+    Vectors are stored as raw float32 blobs (6 KB for a 1536-d embedding).
+    """
+
+    def __init__(self, db_path=DEFAULT_EMBEDDING_CACHE_PATH):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)")
+
+    @staticmethod
+    def make_key(input_string, model):
+        return hashlib.sha256(f"{model}\n{normalize_text(input_string)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """Returns a float32 vector or None for each key."""
+        if not keys:
+            return []
+        found = {}
+        with self._lock:
+            unique_keys = list(set(keys))
+            # Stay below SQLite's host parameter limit
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+            vectors = [found.get(key) for key in keys]
+            self.hits += sum(vector is not None for vector in vectors)
+            self.misses += sum(vector is None for vector in vectors)
+        return vectors
+
+    def set_many(self, keys, vectors):
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in zip(keys, vectors)]
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)", rows)
+            self._connection.execute("COMMIT")
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+_shared_embedding_cache = None
+_shared_embedding_cache_lock = threading.Lock()
+
+def get_shared_embedding_cache():
+    """Returns the process-wide embedding cache."""
+    global _shared_embedding_cache
+    with _shared_embedding_cache_lock:
+        if _shared_embedding_cache is None:
+            _shared_embedding_cache = EmbeddingCache()
+        return _shared_embedding_cache
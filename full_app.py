@@ -1,193 +1,177 @@
-import os
-import time
+import asyncio
 import streamlit as st
-from openai import OpenAI
-from chat_memgpt import load_questions_from_txt, chat_loop_v1, chat_loop_v2
-
-# Load API key securely
-api_key = st.secrets["auth_token"]
-openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY", api_key))
-
-# Function to rephrase the sentence
-def rephraser_model(content, model="gpt-4o-mini"):
-    try:
-        messages = [
-            {"role": "system", "content": """
-            You are a professional paragraph rephraser. Your task is to take a given paragraph, and produce a new paragraph that is easier for language models to understand.
-            Rephrase the paragraph to enhance the language model's performance.
-            The paragraph must be kept in English.
-            """},
-            {"role": "user", "content": content}
-        ]
-
-        response = openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error in rephrasing: {str(e)}")
-        return None
-
-# Function to apply chain-of-thought
-def CoT_model(content, model="gpt-4o-mini"):
-    try:
-        messages = [
-            {"role": "system", "content": """
-            You are a professional paragraph rephraser. Your task is to take a given paragraph, and produce a new paragraph that is easier for language models to understand.
-            Rephrase the paragraph to enhance the language model's performance.
-            The paragraph must be kept in English.
-            """},
-            {"role": "user", "content": content}
-        ]
-
-        response = openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error in CoT processing: {str(e)}")
-        return None
-
-# Function to generate questions based on the prompt
-def Questioner(content, model="gpt-4o"):
-    try:
-        messages = [
-            {"role": "system", "content": """
-            In role of Student/Child in the provided context.
-            Prepare the answers that you will respond to the LLM (Pika) to interact with it, the answers will be based on the provided context.
-            Answers are in Vietnamese.
-            The output must be in list format only, it not be the string, and don't contain any other information or special characters.
-            You must follow the output format below:
-                - <put "..." here>
-                - <put first answer here>
-                - <put second answer here>
-                - <put third answer here>
-                - <put fourth answer here>
-                - <put fifth answer here>
-            The following is the provided context:
-            """},
-            {"role": "user", "content": content}
-        ]
-
-        response = openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error in question generation: {str(e)}")
-        return None
-
-# Function to evaluate the chat conversation
-def Judger(content, model="gpt-4o-mini"):
-    try:
-        messages = [
-            {"role": "system", "content": """
-            You are the LLM evaluator/judger. Based on the context below, which is the requirements to access the performance of the LLM. 
-            I will provide you the dialogues that contains the responses from LLM, in which LLM is not User. 
-            Please evaluate the dialogues to check if the LLM follow the requirements during the conversation or not. 
-            Please also decide the metrics to evaluate and output the score in dict format. The scale of score is 5. 
-            Only return the dictionary of score, and don't return any other information.
-            """},
-            {"role": "user", "content": content}
-        ]
-
-        response = openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error in evaluation: {str(e)}")
-        return None
+import tracing
+import structured_output
+from config import get_llm_client
+from apo_models import quote_prompt, format_transcripts, build_optimization_pipeline
+
+# Maximum number of pipeline steps, and of LLM requests across them (each dialogue and judge sample is one), in flight
+MAX_CONCURRENCY = 4
+MAX_REQUESTS_IN_FLIGHT = 4
+
+# Built on the first run, then reused across reruns and sessions
+llm_client = st.cache_resource(get_llm_client)()
+
+STEP_ERROR_MESSAGES = {
+    "rephrase": "Error in rephrasing",
+    "cot": "Error in CoT processing",
+    "original_questions": "Error in question generation",
+    "new_questions": "Error in question generation",
+    "original_chat": "Error in conversation simulation",
+    "new_chat": "Error in conversation simulation",
+    "judge": "Error in evaluation",
+}
 
 # Streamlit UI
 st.title('Prompt Enhancer & Evaluator')
 
 # User input
 input_sentence = st.text_area("Enter a prompt for processing:")
+num_dialogues = st.number_input("Simulated dialogues per prompt", min_value=1, max_value=20, value=1)
+show_trace = st.checkbox("Show run trace")
 
 if st.button("Start"):
     if input_sentence:
 
-        input_sentence_with_quotes = '""' + input_sentence + '""'
-        
-        # Create two tabs
-        tab1, tab2, tab3 = st.tabs(["APO Result", "Original Prompt","New Prompt"])
-
-        with tab1:
-            st.subheader("Enhanced Prompt")
-
-            with st.spinner("Processing step 1: Optimizing Long Prompt..."):
-                rephrased_sentence = rephraser_model(input_sentence_with_quotes)
-
-            if rephrased_sentence:
-                with st.spinner("Processing step 2: Applying Chain-of-Thought..."):
-                    final_result = CoT_model(rephrased_sentence)
-
-                if final_result:
-                    st.write(final_result)
-        with tab2:
-            st.subheader("Original Prompt Evaluation Score")
-            with st.spinner("Generating test questions..."):
-                questions_list_str = Questioner(input_sentence_with_quotes)
-
-            if questions_list_str:
-                questions_list = [q.strip() for q in questions_list_str.split("- ") if q.strip()]
-
-                st.subheader("Generated Questions for Evaluation")
-                st.write(questions_list)
-
-                with st.spinner("Simulating conversation..."):
-                    conversation_result = chat_loop_v2(questions_list, input_sentence_with_quotes)
-
-                st.subheader("Conversation Log")
-                st.write(conversation_result)
+        input_sentence_with_quotes = quote_prompt(input_sentence)
 
-                full_context_for_Judger = (
-                    "The following is the requirements for the LLM:\n"
-                    + input_sentence_with_quotes + "\n\n"
-                    + "The following is the content of the conversation between LLM and the user:\n"
-                    + conversation_result
-                )
-
-                with st.spinner("Evaluating performance..."):
-                    eval_score = Judger(full_context_for_Judger)
-
-                if eval_score:
-                    st.subheader("Evaluation Score")
-                    st.write(f"**Score:** {eval_score}")
-        with tab3:
-            st.subheader("New Prompt Evaluation Score")
-            with st.spinner("Generating test questions..."):
-                questions_list_str = Questioner(final_result)
-
-            if questions_list_str:
-                questions_list = [q.strip() for q in questions_list_str.split("- ") if q.strip()]
-
-                st.subheader("Generated Questions for Evaluation")
-                st.write(questions_list)
-
-                with st.spinner("Simulating conversation..."):
-                    conversation_result = chat_loop_v2(questions_list, final_result)
-
-                st.subheader("Conversation Log")
-                st.write(conversation_result)
-
-                full_context_for_Judger = (
-                    "The following is the requirements for the LLM:\n"
-                    + input_sentence_with_quotes + "\n\n"
-                    + "The following is the content of the conversation between LLM and the user:\n"
-                    + conversation_result
-                )
-
-                with st.spinner("Evaluating performance..."):
-                    eval_score = Judger(full_context_for_Judger)
+        # Create the tabs up front; every step renders into its own slot as soon as it finishes
+        tab1, tab2, tab3 = st.tabs(["APO Result", "Original Prompt","New Prompt"])
 
-                if eval_score:
-                    st.subheader("Evaluation Score")
-                    st.write(f"**Score:** {eval_score}")
+        tab1.subheader("Enhanced Prompt")
+        slots = {"rephrase": tab1.empty(), "cot": tab1.empty()}
+        tab2.subheader("Original Prompt Evaluation Score")
+        tab3.subheader("New Prompt Evaluation Score")
+        for prefix, tab in [("original", tab2), ("new", tab3)]:
+            for step in ["questions", "chat", "judge"]:
+                slots[f"{prefix}_{step}"] = tab.empty()
+
+        slots["rephrase"].info("Processing step 1: Optimizing Long Prompt...")
+        slots["cot"].info("Processing step 2: Applying Chain-of-Thought...")
+        for prefix in ["original", "new"]:
+            slots[f"{prefix}_questions"].info("Generating test questions...")
+            slots[f"{prefix}_chat"].info("Simulating conversation...")
+            slots[f"{prefix}_judge"].info("Evaluating performance...")
+
+        first_token_times = {}
+
+        def render_stream(step_name, text, time_to_first_token):
+            first_token_times[step_name] = time_to_first_token
+            slot = slots[step_name]
+            if step_name.endswith("_chat"):
+                with slot.container():
+                    st.subheader("Conversation Log")
+                    st.write(text)
+            else:
+                slot.write(text)
+
+        def render_timing(result):
+            if result.name in first_token_times:
+                st.caption(f"First token after {first_token_times[result.name]:.2f}s, done in {result.elapsed:.2f}s")
+
+        def render_scores(slot, summary):
+            with slot.container():
+                st.subheader("Evaluation Score")
+                if summary.n > 1:
+                    st.write(f"**Score:** {summary.mean:.2f} ± {summary.ci_half_width:.2f} (95% CI, {summary.n} judge samples)")
+                else:
+                    st.write(f"**Score:** {summary.mean:.2f} (1 judge sample)")
+                st.write({name: round(mean, 2) for name, mean in summary.metric_means.items()})
+                if summary.num_failed:
+                    st.caption(f"{summary.num_failed} judge replies could not be parsed")
+
+        def render_judging(result):
+            if result.status == "failed":
+                for prefix in ["original", "new"]:
+                    slots[f"{prefix}_judge"].error(f"{STEP_ERROR_MESSAGES['judge']}: {str(result.error)}")
+                return
+            if result.status == "skipped":
+                for prefix in ["original", "new"]:
+                    slots[f"{prefix}_judge"].empty()
+                return
+            judging = result.value
+            render_scores(slots["original_judge"], judging.original)
+            render_scores(slots["new_judge"], judging.new)
+            if judging.difference is None:
+                tab3.info(f"Not enough parseable judge samples to compare the prompts ({judging.num_calls} judge calls).")
+                return
+            verdict = {"new": "The new prompt scores higher", "original": "The original prompt scores higher",
+                       "tie": "No significant difference"}[judging.winner]
+            tab3.info(f"{verdict}: {judging.difference:+.2f} ± {judging.difference_half_width:.2f} "
+                      f"after {judging.num_calls} judge calls ({judging.stop_reason}).")
+
+        def render_step(result):
+            if result.name == "judge":
+                render_judging(result)
+                return
+            slot = slots[result.name]
+            if result.status == "failed":
+                slot.error(f"{STEP_ERROR_MESSAGES[result.name]}: {str(result.error)}")
+            elif result.status == "skipped":
+                slot.empty()
+            elif result.name == "rephrase":
+                slot.empty()
+            elif result.name == "cot":
+                with slot.container():
+                    st.write(result.value)
+                    render_timing(result)
+            elif result.name.endswith("_questions"):
+                with slot.container():
+                    st.subheader("Generated Questions for Evaluation")
+                    for questions in result.value:
+                        st.write(questions)
+            elif result.name.endswith("_chat"):
+                with slot.container():
+                    st.subheader("Conversation Log")
+                    st.write(format_transcripts(result.value))
+                    render_timing(result)
+
+        pipeline = build_optimization_pipeline(input_sentence_with_quotes, llm_client, MAX_CONCURRENCY,
+                                               on_stream=render_stream, num_dialogues=int(num_dialogues),
+                                               max_requests=MAX_REQUESTS_IN_FLIGHT)
+        # The client and the parse metrics are shared by every run in the process, so captions show this run's share
+        cache_stats_before = llm_client.response_cache.stats() if llm_client.response_cache is not None else None
+        calls_saved_before = llm_client.coalescing_stats()["calls_saved"]
+        parse_stats_before = structured_output.parse_metrics.stats()
+        with tracing.span("full_app run", num_dialogues=int(num_dialogues)) as run_span:
+            asyncio.run(pipeline.run(on_step_done=render_step))
+
+        if cache_stats_before is not None:
+            cache_stats = llm_client.response_cache.stats()
+            st.caption(f"Response cache: {cache_stats['hits'] - cache_stats_before['hits']} hits, "
+                       f"{cache_stats['misses'] - cache_stats_before['misses']} misses, {cache_stats['entries']} entries")
+        calls_saved = llm_client.coalescing_stats()["calls_saved"] - calls_saved_before
+        if calls_saved or pipeline.repeated_requests:
+            repeats = ", ".join(f"{step} repeats {dep}" for step, dep in pipeline.repeated_requests.items())
+            st.caption(f"{calls_saved} duplicate in-flight LLM calls shared"
+                       + (f"; repeated requests: {repeats}" if repeats else ""))
+        parse_stats = structured_output.parse_metrics.stats_since(parse_stats_before)
+        if structured_output.parse_metrics.num_failures(parse_stats):
+            st.caption("Unparseable structured replies: " + ", ".join(
+                f"{step} {counts['repaired']} repaired, {counts['failed']} failed"
+                for step, counts in parse_stats.items()))
+
+        if show_trace:
+            spans = tracing.tracer.get_trace(run_span.trace_id)
+            totals = tracing.summarize_trace(spans)
+            with st.expander("Run trace", expanded=True):
+                st.caption(f"{totals['calls']} LLM calls ({totals['cached_calls']} cached, {totals['retries']} retries, "
+                           f"{totals['errors']} failed), {totals['prompt_tokens']} prompt + "
+                           f"{totals['completion_tokens']} completion tokens, ~${totals['cost_usd']:.4f}, "
+                           f"{run_span.duration:.1f}s")
+                rows = tracing.waterfall_rows(spans)
+                st.vega_lite_chart({
+                    "data": {"values": rows},
+                    "mark": "bar",
+                    "height": {"step": 14},
+                    "encoding": {
+                        "y": {"field": "row", "type": "nominal", "sort": None, "title": None},
+                        "x": {"field": "start_ms", "type": "quantitative", "title": "ms since start"},
+                        "x2": {"field": "end_ms"},
+                        "color": {"field": "kind", "type": "nominal"},
+                        "tooltip": [{"field": "name"}, {"field": "duration_ms", "format": ".0f"}, {"field": "model"},
+                                    {"field": "tokens"}, {"field": "cached"}, {"field": "retries"}, {"field": "error"}],
+                    },
+                }, use_container_width=True)
     else:
         st.warning("Please enter a prompt to process.")
@@ -0,0 +1,260 @@
+import re
+import ast
+import json
+import math
+import asyncio
+from dataclasses import dataclass, field
+import tracing
+
+#%% Score parsing
+
+SCORE_SCALE = 5.0
+
+# Keys that summarize the other metrics rather than being metrics themselves
+AGGREGATE_KEYS = {"overall", "overall_score", "average", "average_score", "avg", "total", "total_score", "final_score"}
+
+SCORE_VALUE_PATTERN = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?))?")
+SCORE_PAIR_PATTERN = re.compile(r"[\"']?([A-Za-z][\w \-]*?)[\"']?\s*[:=]\s*[\"']?(-?\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?))?")
+
+# Two-sided 95% Student t critical values for 1..30 degrees of freedom
+T_CRITICAL_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def parse_score_value(value, scale=SCORE_SCALE):
+    """Converts 4, "4", "4/5" or "8/10" to a score on `scale`. Returns None if it is not a usable score."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        score = float(value)
+    elif isinstance(value, str) and (match := SCORE_VALUE_PATTERN.match(value)):
+        score = float(match.group(1))
+        if match.group(2) and float(match.group(2)) > 0:
+            score = score / float(match.group(2)) * scale
+    else:
+        return None
+    return score if 0 <= score <= scale and not math.isnan(score) else None
+
+
+def _flatten_scores(data, prefix=""):
+    scores = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            if "score" in value and parse_score_value(value["score"]) is not None:
+                scores[name] = parse_score_value(value["score"])
+            else:
+                scores.update(_flatten_scores(value, prefix=f"{name}."))
+        elif (score := parse_score_value(value)) is not None:
+            scores[name] = score
+    return scores
+
+
+def parse_score_dict(text):
+    """Extracts {metric: score} from a judge reply.
+
+    Accepts JSON or Python dict literals (optionally inside a code fence or surrounded by prose),
+    nested {"score": ...} objects and "4/5" style values, and falls back to "metric: score" pairs.
+    Returns an empty dict if no score can be found.
+    """
+    if not text:
+        return {}
+    match = re.search(r"\{.*\}", text, re.S)
+    if match:
+        for loader in (json.loads, ast.literal_eval):
+            try:
+                data = loader(match.group(0))
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                continue
+            if isinstance(data, dict) and (scores := _flatten_scores(data)):
+                return scores
+            break
+
+    scores = {}
+    for name, value, denominator in SCORE_PAIR_PATTERN.findall(text):
+        score = parse_score_value(f"{value}/{denominator}" if denominator else value)
+        if score is not None:
+            scores[name.strip()] = score
+    return scores
+
+
+def overall_score(scores):
+    """Mean of the individual metrics, or of the judge's own aggregate if that is all it returned."""
+    metrics = [score for name, score in scores.items() if name.lower() not in AGGREGATE_KEYS]
+    values = metrics or list(scores.values())
+    return sum(values) / len(values) if values else None
+
+#%% Aggregation
+
+def t_critical_95(degrees_of_freedom):
+    if degrees_of_freedom < 1:
+        return math.inf
+    if degrees_of_freedom > len(T_CRITICAL_95):
+        return 1.96
+    return T_CRITICAL_95[int(degrees_of_freedom) - 1]
+
+
+@dataclass
+class ScoreSummary:
+    """Judge samples for one prompt: overall score per sample, per-metric scores and failed samples."""
+
+    samples: list = field(default_factory=list)
+    metric_samples: dict = field(default_factory=dict)
+    raw_replies: list = field(default_factory=list)
+    num_failed: int = 0
+
+    @property
+    def n(self):
+        return len(self.samples)
+
+    @property
+    def mean(self):
+        return sum(self.samples) / self.n if self.n else None
+
+    @property
+    def variance(self):
+        if self.n < 2:
+            return None
+        mean = self.mean
+        return sum((x - mean) ** 2 for x in self.samples) / (self.n - 1)
+
+    @property
+    def ci_half_width(self):
+        """Half width of the 95% confidence interval of the mean."""
+        if self.n < 2:
+            return math.inf
+        return t_critical_95(self.n - 1) * math.sqrt(self.variance / self.n)
+
+    @property
+    def metric_means(self):
+        return {name: sum(values) / len(values) for name, values in self.metric_samples.items()}
+
+    def add(self, reply):
+        self.raw_replies.append(reply)
+        scores = parse_score_dict(reply)
+        score = overall_score(scores)
+        if score is None:
+            self.num_failed += 1
+            return
+        self.samples.append(score)
+        for name, value in scores.items():
+            self.metric_samples.setdefault(name, []).append(value)
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "variance": self.variance,
+                "ci_half_width": None if self.n < 2 else self.ci_half_width,
+                "metric_means": self.metric_means, "num_failed": self.num_failed}
+
+
+def difference_interval(original, new):
+    """Welch 95% confidence interval of new.mean - original.mean, as (difference, half width)."""
+    if original.n < 2 or new.n < 2:
+        return None, math.inf
+    var_original, var_new = original.variance / original.n, new.variance / new.n
+    standard_error = math.sqrt(var_original + var_new)
+    if standard_error == 0:
+        return new.mean - original.mean, 0.0
+    # Welch-Satterthwaite degrees of freedom
+    degrees_of_freedom = (var_original + var_new) ** 2 / (
+        (var_original ** 2 / (original.n - 1) if var_original else 0) + (var_new ** 2 / (new.n - 1) if var_new else 0))
+    return new.mean - original.mean, t_critical_95(degrees_of_freedom) * standard_error
+
+
+@dataclass
+class JudgingResult:
+    original: ScoreSummary
+    new: ScoreSummary
+    difference: float = None
+    difference_half_width: float = math.inf
+    num_calls: int = 0
+    stop_reason: str = ""
+
+    @property
+    def winner(self):
+        """"new" or "original" if the interval excludes zero, else "tie"."""
+        if self.difference is None or abs(self.difference) <= self.difference_half_width:
+            return "tie"
+        return "new" if self.difference > 0 else "original"
+
+    def to_dict(self):
+        return {"original": self.original.to_dict(), "new": self.new.to_dict(), "difference": self.difference,
+                "difference_half_width": None if math.isinf(self.difference_half_width) else self.difference_half_width,
+                "winner": self.winner, "num_calls": self.num_calls, "stop_reason": self.stop_reason}
+
+#%% Judging engine
+
+class JudgingEngine:
+    """Compares two conversations with repeated, concurrent judge samples and stops as soon as the answer is clear.
+
+    Each round samples both conversations `samples_per_round` times (`min_samples` in the first round)
+    and stops once the 95% interval of the score difference excludes zero or is narrower than
+    +/- `tolerance`, or after `max_samples` per side. Sample i is requested with seed=i, so samples differ
+    from each other but a re-run with the same inputs is served from the response cache.
+    Either side may be a list of contexts (e.g. one per simulated dialogue); sample i then judges context i mod K.
+    With K contexts (the lcm of both sides), every round size and the sample budget are rounded up to multiples of K, so each context is
+    judged equally often and none is left unscored.
+    """
+
+    def __init__(self, client, model="gpt-4o-mini", min_samples=3, samples_per_round=2, max_samples=9,
+                 tolerance=0.25, temperature=1.0):
+        self.client = client
+        self.model = model
+        self.min_samples = min_samples
+        self.samples_per_round = samples_per_round
+        self.max_samples = max_samples
+        self.tolerance = tolerance
+        self.temperature = temperature
+
+    async def sample(self, judger_contexts, sample_indices):
+        """Fires one judge call per sample index concurrently. Failed calls come back as None."""
+        from apo_models import Judger
+
+        if isinstance(judger_contexts, str):
+            judger_contexts = [judger_contexts]
+
+        async def judge_once(sample_index):
+            try:
+                return await Judger(judger_contexts[sample_index % len(judger_contexts)], self.client, self.model,
+                                    seed=sample_index, temperature=self.temperature)
+            except Exception as e:
+                print(f"Judge sample {sample_index} failed. ({e})")
+                return None
+
+        return await asyncio.gather(*(judge_once(i) for i in sample_indices))
+
+    async def compare(self, original_context, new_context, on_round=None):
+        """Judges both sides until the comparison is decided. on_round(JudgingResult) is called after each round."""
+        result = JudgingResult(ScoreSummary(), ScoreSummary())
+        num_contexts = max(1, math.lcm(*(len(context) if isinstance(context, list) else 1
+                                         for context in (original_context, new_context))))
+        min_samples, samples_per_round, max_samples = (
+            -(-num // num_contexts) * num_contexts for num in (self.min_samples, self.samples_per_round, self.max_samples))
+        num_attempts = 0
+        while num_attempts < max_samples:
+            round_size = min(min_samples if num_attempts == 0 else samples_per_round, max_samples - num_attempts)
+            indices = range(num_attempts, num_attempts + round_size)
+            with tracing.span("judge_round", samples=round_size):
+                original_replies, new_replies = await asyncio.gather(
+                    self.sample(original_context, indices), self.sample(new_context, indices))
+            num_attempts += round_size
+            result.num_calls += 2 * round_size
+            for summary, replies in [(result.original, original_replies), (result.new, new_replies)]:
+                for reply in replies:
+                    summary.add(reply)
+
+            result.difference, result.difference_half_width = difference_interval(result.original, result.new)
+            if on_round:
+                on_round(result)
+            if result.difference is not None and abs(result.difference) > result.difference_half_width:
+                result.stop_reason = "significant difference"
+                break
+            if result.difference_half_width <= self.tolerance:
+                result.stop_reason = "interval within tolerance"
+                break
+        else:
+            result.stop_reason = "sample budget exhausted"
+
+        if result.original.n == 0 or result.new.n == 0:
+            raise ValueError("The judge did not return any parseable scores")
+        return result
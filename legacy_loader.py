@@ -0,0 +1,170 @@
+"""Parallel loader and integrity checker for legacy memory folders (one .pkl file per memory).
+
+The pickles are sharded across a process pool. Workers write embeddings straight into one preallocated
+shared-memory matrix, so only the small text records travel back through pickling. Every problem is
+recorded in an integrity report instead of being printed and skipped. A report lists corrupt files,
+wrong-dimension embeddings, all-zero fallback vectors (which match nothing), non-finite vectors and
+duplicate titles.
+Only run it on folders you created yourself, since unpickling untrusted files can execute code.
+
+Usage:
+    python legacy_loader.py memories_20250215 --workers 8 --report integrity.json
+"""
+import os
+import json
+import time
+import pickle
+import argparse
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Optional
+import numpy as np
+
+SHARDS_PER_WORKER = 4
+
+
+@dataclass
+class IntegrityReport:
+    num_files: int = 0
+    num_loaded: int = 0
+    corrupt: List[dict] = field(default_factory=list)             # {"file", "error"}
+    wrong_dimension: List[dict] = field(default_factory=list)     # {"file", "dimension"}
+    zero_vectors: List[str] = field(default_factory=list)
+    non_finite_vectors: List[str] = field(default_factory=list)
+    duplicate_titles: dict = field(default_factory=dict)          # title -> files, for titles used more than once
+
+    @property
+    def num_problems(self):
+        return len(self.corrupt) + len(self.wrong_dimension) + len(self.zero_vectors) + len(self.non_finite_vectors)
+
+    def to_dict(self):
+        return asdict(self)
+
+    def summary(self):
+        return (f"{self.num_loaded}/{self.num_files} memories loaded: {len(self.corrupt)} corrupt, "
+                f"{len(self.wrong_dimension)} wrong dimension, {len(self.zero_vectors)} zero vectors, "
+                f"{len(self.non_finite_vectors)} non-finite vectors, {len(self.duplicate_titles)} duplicated titles")
+
+
+@dataclass
+class LegacyFolder:
+    """Loaded memories in file order. records[i] is None and valid[i] False for the files that failed checks."""
+    paths: List[str]
+    records: List[Optional[dict]]
+    embeddings: np.ndarray
+    valid: np.ndarray
+    report: IntegrityReport
+
+
+def list_legacy_files(memories_folder_path):
+    """The folder's .pkl files, oldest first."""
+    entries = [entry for entry in os.scandir(memories_folder_path) if entry.is_file() and entry.name.endswith(".pkl")]
+    return [entry.path for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime)]
+
+
+def _load_shard(shared_memory_name, shape, first_row, paths):
+    """Worker: unpickles paths[i] into row first_row + i of the shared matrix. Returns (row, record, problem) tuples."""
+    # Pool workers share the parent's resource tracker, so attaching does not hand the block over to this process
+    block = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        embeddings = np.ndarray(shape, dtype=np.float32, buffer=block.buf)
+        results = []
+        for row, path in enumerate(paths, first_row):
+            try:
+                with open(path, "rb") as f:
+                    memory = pickle.load(f)
+                record = {
+                    "memory_title": memory["memory_title"],
+                    "memory_string": memory["memory_string"],
+                    "datetime": list(memory["datetime"]),
+                    "conversation_sequence": memory.get("conversation_sequence", []),
+                }
+                embedding = np.asarray(memory["embedding"], dtype=np.float32).ravel()
+            except Exception as e:      # any unpickling error means the file is corrupt
+                results.append((row, None, ("corrupt", f"{type(e).__name__}: {e}")))
+                continue
+            if len(embedding) != shape[1]:
+                results.append((row, None, ("wrong_dimension", len(embedding))))
+            elif not np.isfinite(embedding).all():
+                results.append((row, None, ("non_finite_vectors", None)))
+            elif not embedding.any():
+                results.append((row, None, ("zero_vectors", None)))
+            else:
+                embeddings[row] = embedding
+                results.append((row, record, None))
+        return results
+    finally:
+        block.close()
+
+
+def load_legacy_folder(memories_folder_path=None, embedding_dim=1536, num_workers=None, paths=None):
+    """Loads legacy pickles (those of a folder, or the given paths) in parallel and checks their integrity.
+
+    Returns a LegacyFolder whose embeddings are one float32 matrix with a row per file (zeros for failed files).
+    """
+    paths = list_legacy_files(memories_folder_path) if paths is None else list(paths)
+    report = IntegrityReport(num_files=len(paths))
+    shape = (len(paths), embedding_dim)
+    records = [None] * len(paths)
+    if not paths:
+        return LegacyFolder(paths, records, np.zeros(shape, dtype=np.float32), np.zeros(0, dtype=bool), report)
+
+    num_workers = max(1, min(num_workers or os.cpu_count() or 1, len(paths)))
+    shard_size = -(-len(paths) // (num_workers * SHARDS_PER_WORKER))
+    block = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1] * 4)
+    shared = None
+    try:
+        shared = np.ndarray(shape, dtype=np.float32, buffer=block.buf)
+        shared[:] = 0
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(_load_shard, block.name, shape, start, paths[start:start + shard_size])
+                       for start in range(0, len(paths), shard_size)]
+            for future in futures:
+                for row, record, problem in future.result():
+                    records[row] = record
+                    if problem is None:
+                        continue
+                    kind, detail = problem
+                    name = os.path.basename(paths[row])
+                    if kind == "corrupt":
+                        report.corrupt.append({"file": name, "error": detail})
+                    elif kind == "wrong_dimension":
+                        report.wrong_dimension.append({"file": name, "dimension": detail})
+                    else:
+                        getattr(report, kind).append(name)
+        # One copy out of the block, which is released right after
+        embeddings = shared.copy()
+    finally:
+        shared = None       # the block cannot be closed while an array still uses its buffer
+        block.close()
+        block.unlink()
+
+    valid = np.array([record is not None for record in records], dtype=bool)
+    report.num_loaded = int(valid.sum())
+    files_by_title = {}
+    for path, record in zip(paths, records):
+        if record is not None:
+            files_by_title.setdefault(record["memory_title"], []).append(os.path.basename(path))
+    report.duplicate_titles = {title: files for title, files in files_by_title.items() if len(files) > 1}
+    return LegacyFolder(paths, records, embeddings, valid, report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("memories_folder", help="memory folder containing .pkl files")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--report", help="write the integrity report to this JSON file")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    folder = load_legacy_folder(args.memories_folder, args.embedding_dim, args.workers)
+    print(f"{folder.report.summary()} ({time.perf_counter() - started:.1f}s)")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(folder.report.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import re
+import json
+from collections import Counter
+import numpy as np
+from vector_search import top_k
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Lowercased word tokens; Vietnamese and other non-ASCII words are kept whole."""
+    return TOKEN_PATTERN.findall((text or "").lower())
+
+
+class BM25Index:
+    """Okapi BM25 inverted index over memory texts, persisted next to the embedding matrix.
+
+    Each row's term frequencies are appended to a JSONL sidecar, so reopening the index re-reads counts instead
+    of re-tokenizing the record log, and new rows are indexed incrementally. Rows missing from the sidecar
+    (e.g. after a torn write) are re-tokenized from their text on load.
+    """
+
+    TERMS_FILENAME = "terms.jsonl"
+
+    def __init__(self, folder_path, k1=1.5, b=0.75):
+        self.terms_path = os.path.join(folder_path, self.TERMS_FILENAME)
+        self.k1 = k1
+        self.b = b
+        self.postings = {}          # term -> ([rows], [term frequencies])
+        self.doc_lengths = []
+        self._posting_arrays = {}   # term -> (rows, tfs) as numpy arrays, rebuilt after each add
+        self._num_tokens = 0
+        self._num_postings = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @property
+    def num_postings(self):
+        return self._num_postings
+
+    def load(self, num_rows, read_text):
+        """Reads the sidecar for the first num_rows rows, indexing any missing row from read_text(row)."""
+        self.postings, self.doc_lengths, self._posting_arrays, self._num_tokens, self._num_postings = {}, [], {}, 0, 0
+        term_counts, num_lines = [], 0
+        if os.path.exists(self.terms_path):
+            with open(self.terms_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    num_lines += 1
+                    if len(term_counts) == num_rows or len(term_counts) < num_lines - 1 or not line.endswith("\n"):
+                        continue
+                    try:
+                        term_counts.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        pass
+        if num_lines != len(term_counts):
+            # Drop torn or uncommitted lines so that line i stays row i
+            with open(self.terms_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(counts, ensure_ascii=False) + "\n" for counts in term_counts)
+        self._index(range(len(term_counts)), term_counts)
+        if len(term_counts) < num_rows:
+            self.add_many(range(len(term_counts), num_rows), [read_text(row) for row in range(len(term_counts), num_rows)])
+
+    def add_many(self, rows, texts):
+        term_counts = [dict(Counter(tokenize(text))) for text in texts]
+        with open(self.terms_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(counts, ensure_ascii=False) + "\n" for counts in term_counts)
+        self._index(rows, term_counts)
+
+    def search(self, query_text, num_neighbors, excluded_rows=()):
+        """Returns (rows, BM25 scores) of the top-k rows sharing a term with the query, best first."""
+        scores = self.score(query_text)
+        if excluded_rows:
+            scores[list(excluded_rows)] = 0.0
+        rows, values = top_k(scores, num_neighbors)
+        keep = values > 0
+        return rows[keep], values[keep]
+
+    def score(self, query_text):
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        if not self.doc_lengths:
+            return scores
+        doc_lengths = np.asarray(self.doc_lengths, dtype=np.float32)
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(self._num_tokens / len(doc_lengths), 1e-9))
+        for term, query_tf in Counter(tokenize(query_text)).items():
+            arrays = self._get_posting_arrays(term)
+            if arrays is None:
+                continue
+            rows, tfs = arrays
+            idf = np.log(1 + (len(doc_lengths) - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += query_tf * idf * tfs * (self.k1 + 1) / (tfs + length_norm[rows])
+        return scores
+
+    def _index(self, rows, term_counts):
+        for row, counts in zip(rows, term_counts):
+            for term, tf in counts.items():
+                postings = self.postings.setdefault(term, ([], []))
+                postings[0].append(row)
+                postings[1].append(tf)
+                self._posting_arrays.pop(term, None)
+            self._num_postings += len(counts)
+            length = sum(counts.values())
+            self.doc_lengths.append(length)
+            self._num_tokens += length
+
+    def _get_posting_arrays(self, term):
+        arrays = self._posting_arrays.get(term)
+        if arrays is None and term in self.postings:
+            rows, tfs = self.postings[term]
+            arrays = self._posting_arrays[term] = (np.asarray(rows, dtype=np.int64), np.asarray(tfs, dtype=np.float32))
+        return arrays
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuses several best-first lists of rows into one (rows, scores) ranking, scoring each row sum(1 / (k + rank))."""
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, 1):
+            scores[int(row)] = scores.get(int(row), 0.0) + 1.0 / (k + rank)
+    rows = sorted(scores, key=lambda row: (-scores[row], row))
+    return rows, [scores[row] for row in rows]
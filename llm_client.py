@@ -0,0 +1,619 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+import threading
+import contextlib
+import contextvars
+import email.utils
+import openai
+import prompt_utils
+import tracing
+from response_cache import ResponseCache
+from llm_providers import OpenAIProvider, ProviderError, get_provider_from_env
+
+#%% Rate Limiting Defaults
+
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200000
+DEFAULT_COMPLETION_TOKENS_ESTIMATE = 512     # used when a call does not set max_tokens
+RETRIABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Callers reserve capacity up front and sleep for the returned delay."""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Takes `amount` from the bucket (possibly going negative) and returns how long to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+            self.updated_at = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.refill_per_second
+
+    def refund(self, amount):
+        """Returns over-reserved capacity (or takes more when `amount` is negative)."""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Tracks requests/min and tokens/min with one token bucket each."""
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+
+    def reserve(self, num_tokens):
+        return max(self.requests.reserve(1), self.tokens.reserve(num_tokens))
+
+    def acquire(self, num_tokens):
+        delay = self.reserve(num_tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, num_tokens):
+        delay = self.reserve(num_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Corrects the token bucket once the real usage of a call is known."""
+        if actual_tokens is not None:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+
+
+#%% Retry Policy
+
+def is_retriable_error(e):
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(e, (openai.APIStatusError, ProviderError)) and e.status_code in RETRIABLE_STATUS_CODES
+
+def get_retry_after(e):
+    """Returns the server-requested delay in seconds from Retry-After(-ms) headers, if any."""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+    except ValueError:
+        pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def compute_backoff(attempt, base_delay=1.0, max_delay=60.0, retry_after=None):
+    """Exponential backoff with full jitter, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_delay))
+    return delay
+
+#%% Requests in flight
+
+_request_slots = contextvars.ContextVar("request_slots", default=None)
+
+@contextlib.contextmanager
+def limit_requests(max_in_flight):
+    """Allows at most max_in_flight async chat requests at once in the enclosed block (and the tasks it starts).
+
+    Only requests sent to the provider take a slot: cache hits and coalesced followers do not. None means no limit.
+    """
+    token = _request_slots.set(asyncio.Semaphore(max_in_flight) if max_in_flight else None)
+    try:
+        yield
+    finally:
+        _request_slots.reset(token)
+
+@contextlib.asynccontextmanager
+async def _request_slot():
+    slots = _request_slots.get()
+    if slots is None:
+        yield
+        return
+    async with slots:
+        yield
+
+
+#%% Request coalescing
+
+class _FlightAbandoned(Exception):
+    """The leader went away (cancelled or closed) without a reply; its followers retry the request themselves."""
+
+
+class _Flight:
+    """One in-flight request shared by identical concurrent calls: the text received so far and its outcome."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.abandoned = False
+        self.leader_thread = threading.get_ident()
+        self._condition = threading.Condition()
+        self._async_waiters = []        # (loop, asyncio.Event) of async followers waiting for news
+
+    def publish(self, chunk=None, done=False, error=None, abandoned=False):
+        with self._condition:
+            if self.done:
+                return
+            if chunk:
+                self.chunks.append(chunk)
+            if done or error is not None or abandoned:
+                self.done, self.error, self.abandoned = True, error, abandoned
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass    # the follower's loop is closed
+
+    def _result(self):
+        if self.abandoned:
+            raise _FlightAbandoned()
+        if self.error is not None:
+            raise self.error
+        return "".join(self.chunks)
+
+    def wait(self):
+        """Blocks until the leader is done. Returns its reply, or raises its API error or _FlightAbandoned."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.done)
+        return self._result()
+
+    async def await_done(self):
+        """Async variant of wait; waiting never blocks the event loop."""
+        while True:
+            with self._condition:
+                if self.done:
+                    break
+                event = asyncio.Event()
+                self._async_waiters.append((asyncio.get_running_loop(), event))
+            await event.wait()
+        return self._result()
+
+
+class SingleFlight:
+    """Registry of in-flight requests: a request identical to one in flight joins it instead of calling the API.
+
+    The first caller leads and publishes what it receives; followers (any thread or event loop) wait for its reply.
+    Only API errors are passed on to followers. A leader that is cancelled or whose stream is closed early abandons
+    the flight instead: it is removed and its followers retry, one of them becoming the new leader.
+    Followers do not stream, since a stream that has shown part of a reply could not switch to another one;
+    streams only lead. `num_calls_saved` counts the followers that got the leader's reply. A blocking follower
+    never joins a leader running on its own thread, since it would wait on itself.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.num_calls_saved = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, blocking, follow=True):
+        """Returns (flight, is_leader). The leader must call `leave` once its flight is published as done.
+
+        With follow=False the caller always leads; it registers its flight only if no identical request is in flight.
+        """
+        if not self.enabled:
+            return _Flight(), True
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and follow and not (blocking and flight.leader_thread == threading.get_ident()):
+                return flight, False
+            flight = _Flight()
+            self._flights.setdefault(key, flight)
+            return flight, True
+
+    def leave(self, key, flight):
+        """Unregisters the flight, abandoning it if it was not published as done."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        # After unregistering, so that retrying followers start a new flight
+        flight.publish(abandoned=True)
+
+    def follow(self, key, blocking, lead):
+        """Returns the reply of the identical request in flight, or calls lead(flight) when this caller must send it.
+
+        lead(flight) must publish the reply (or the API error) on the flight; it is left afterwards in any case.
+        """
+        while True:
+            flight, is_leader = self.join(key, blocking)
+            if is_leader:
+                try:
+                    return lead(flight)
+                finally:
+                    self.leave(key, flight)
+            try:
+                reply = flight.wait()
+            except _FlightAbandoned:
+                continue
+            with self._lock:
+                self.num_calls_saved += 1
+            return reply
+
+    async def afollow(self, key, lead):
+        """Async variant of follow; lead(flight) is a coroutine function."""
+        while True:
+            flight, is_leader = self.join(key, blocking=False)
+            if is_leader:
+                try:
+                    return await lead(flight)
+                finally:
+                    self.leave(key, flight)
+            try:
+                reply = await flight.await_done()
+            except _FlightAbandoned:
+                continue
+            with self._lock:
+                self.num_calls_saved += 1
+            return reply
+
+
+#%% Client
+
+class LLMClient:
+    """Shared entry point for chat and embedding calls: rate limiting plus retries on retriable errors.
+
+    Chat calls made with use_cache=True are served from `response_cache` when an identical request
+    (model, messages, params) was answered before; use it for deterministic pipeline steps only.
+    Pass `cache_if(reply)` to store only replies it accepts, e.g. ones that parse.
+    The SDK clients come from `provider` (see llm_providers, OpenAI by default) and never retry on
+    their own, so this layer owns the retry policy.
+    Async calls use one async client per event loop, since Streamlit starts a new loop per run.
+    Identical chat requests in flight at the same time share one API call (see SingleFlight); pass
+    coalesce_requests=False to send every call. Wrap a run in `limit_requests(n)` to cap its async requests in flight.
+    """
+
+    def __init__(self, api_key=None, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, max_retries=5, base_delay=1.0, max_delay=60.0, timeout=60.0,
+                 response_cache=None, provider=None, coalesce_requests=True):
+        self.api_key = api_key
+        self.provider = provider or OpenAIProvider(api_key)
+        self.response_cache = response_cache
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.single_flight = SingleFlight(coalesce_requests)
+        self.num_repeated_requests = 0
+        self._sync_client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def sync_client(self):
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = self.provider.create_client(self.timeout)
+            return self._sync_client
+
+    @property
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_clients:
+                self._async_clients[loop] = self.provider.create_async_client(self.timeout)
+            return self._async_clients[loop]
+
+    def chat(self, messages, model="gpt-4o-mini", use_cache=False, cache_if=None, **params):
+        """Sends a chat completion request and returns the message content."""
+        with tracing.span("llm.chat", kind="llm", model=model, cached=False) as call_span:
+            cache_key = self._get_cache_key(use_cache, model, messages, params)
+            if cache_key is not None:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    call_span.set(cached=True)
+                    return cached
+
+            request_key = self._begin_request(model, messages, params, call_span)
+            leader = []
+
+            def lead(flight):
+                leader.append(flight)
+                with self._publishing_errors(flight):
+                    completion = self._call_with_retries(
+                        lambda: self.sync_client.chat.completions.create(model=model, messages=messages, **params),
+                        self._estimate_chat_tokens(messages, params), call_span)
+                content = completion.choices[0].message.content
+                flight.publish(content, done=True)
+                return content
+
+            content = self.single_flight.follow(request_key, True, lead)
+            if not leader:
+                call_span.set(coalesced=True)
+            if cache_key is not None and (cache_if is None or cache_if(content)):
+                self.response_cache.set(cache_key, content)
+            return content
+
+    async def achat(self, messages, model="gpt-4o-mini", use_cache=False, cache_if=None, **params):
+        """Async variant of chat."""
+        with tracing.span("llm.chat", kind="llm", model=model, cached=False) as call_span:
+            cache_key = self._get_cache_key(use_cache, model, messages, params)
+            if cache_key is not None:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    call_span.set(cached=True)
+                    return cached
+
+            request_key = self._begin_request(model, messages, params, call_span)
+            leader = []
+
+            async def lead(flight):
+                leader.append(flight)
+                with self._publishing_errors(flight):
+                    async with _request_slot():
+                        completion = await self._acall_with_retries(
+                            lambda: self.async_client.chat.completions.create(model=model, messages=messages, **params),
+                            self._estimate_chat_tokens(messages, params), call_span)
+                content = completion.choices[0].message.content
+                flight.publish(content, done=True)
+                return content
+
+            content = await self.single_flight.afollow(request_key, lead)
+            if not leader:
+                call_span.set(coalesced=True)
+            if cache_key is not None and (cache_if is None or cache_if(content)):
+                self.response_cache.set(cache_key, content)
+            return content
+
+    def stream_chat(self, messages, model="gpt-4o-mini", use_cache=False, cache_if=None, **params):
+        """Returns a ChatStream; iterate it to receive the completion in incremental text chunks."""
+        return ChatStream(self, messages, model, use_cache, params, cache_if)
+
+    def astream_chat(self, messages, model="gpt-4o-mini", use_cache=False, cache_if=None, **params):
+        """Async variant of stream_chat; iterate the result with `async for`."""
+        return AsyncChatStream(self, messages, model, use_cache, params, cache_if)
+
+    def forget_cached(self, messages, model="gpt-4o-mini", **params):
+        """Drops the cached reply to a request, e.g. one that turned out to be unusable."""
+        cache_key = self._get_cache_key(True, model, messages, params)
+        if cache_key is not None:
+            self.response_cache.delete(cache_key)
+
+    def embed(self, inputs, model="text-embedding-ada-002"):
+        """Embeds a string or a list of strings in one request. Returns one vector per input."""
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        with tracing.span("llm.embed", kind="embedding", model=model, num_inputs=len(inputs)) as call_span:
+            estimated_tokens = sum(prompt_utils.count_tokens_many(inputs))
+            response = self._call_with_retries(
+                lambda: self.sync_client.embeddings.create(input=inputs, model=model), estimated_tokens, call_span)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def coalescing_stats(self):
+        return {"calls_saved": self.single_flight.num_calls_saved, "repeated_requests": self.num_repeated_requests}
+
+    def _begin_request(self, model, messages, params, call_span):
+        """Returns the request's key, flagging a request that repeats one already sent by the previous pipeline step."""
+        request_key = ResponseCache.make_key(model, messages, **params)
+        repeated_step = tracing.notify_request(request_key)
+        if repeated_step is not None:
+            self.num_repeated_requests += 1
+            call_span.set(repeat_of_step=repeated_step)
+            print(f"Warning: This request repeats one already sent by step '{repeated_step}'.")
+        return request_key
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _publishing_errors(flight):
+        # Followers get the leader's API errors; cancellation and other BaseExceptions only abandon the flight
+        try:
+            yield
+        except Exception as e:
+            flight.publish(error=e)
+            raise
+
+    def _get_cache_key(self, use_cache, model, messages, params):
+        if not use_cache or self.response_cache is None or self.response_cache.bypass:
+            return None
+        return ResponseCache.make_key(model, messages, **params)
+
+    def _estimate_chat_tokens(self, messages, params):
+        completion_tokens = params.get("max_tokens") or DEFAULT_COMPLETION_TOKENS_ESTIMATE
+        return prompt_utils.count_tokens_from_conversation_seq(messages) + completion_tokens
+
+    def _record_usage(self, response, estimated_tokens, call_span=None):
+        usage = getattr(response, "usage", None)
+        self.rate_limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+        if call_span is not None:
+            call_span.record_usage(usage)
+
+    def _call_with_retries(self, request, estimated_tokens, call_span=None):
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            try:
+                response = request()
+                self._record_usage(response, estimated_tokens, call_span)
+                return response
+            except Exception as e:
+                if attempt == self.max_retries or not is_retriable_error(e):
+                    raise
+                delay = compute_backoff(attempt, self.base_delay, self.max_delay, get_retry_after(e))
+                print(f"LLM call failed, retrying in {delay:.1f}s... ({e})")
+                if call_span is not None:
+                    call_span.set(retries=attempt + 1)
+                time.sleep(delay)
+
+    async def _acall_with_retries(self, request, estimated_tokens, call_span=None):
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire_async(estimated_tokens)
+            try:
+                response = await request()
+                self._record_usage(response, estimated_tokens, call_span)
+                return response
+            except Exception as e:
+                if attempt == self.max_retries or not is_retriable_error(e):
+                    raise
+                delay = compute_backoff(attempt, self.base_delay, self.max_delay, get_retry_after(e))
+                print(f"LLM call failed, retrying in {delay:.1f}s... ({e})")
+                if call_span is not None:
+                    call_span.set(retries=attempt + 1)
+                await asyncio.sleep(delay)
+
+
+class ChatStream:
+    """Streamed chat completion. Iterating yields text chunks; `text` accumulates them as they arrive.
+
+    Retries and rate limiting apply to opening the stream only, never to a partially received answer.
+    After iteration `time_to_first_token` and `elapsed` hold the call's timings in seconds.
+    A cached response is yielded as a single chunk.
+    """
+
+    def __init__(self, client, messages, model, use_cache, params, cache_if=None):
+        self.client = client
+        self.messages = messages
+        self.model = model
+        self.params = params
+        self.cache_key = client._get_cache_key(use_cache, model, messages, params)
+        self.cache_if = cache_if
+        self.request_key = None
+        self.flight = None
+        self.estimated_tokens = client._estimate_chat_tokens(messages, params)
+        self.text = ""
+        self.cached = False
+        self.time_to_first_token = None
+        self.elapsed = None
+        self.span = None
+        self._started = None
+
+    def _create_kwargs(self):
+        return dict(model=self.model, messages=self.messages, stream=True, stream_options={"include_usage": True}, **self.params)
+
+    def _begin(self, blocking):
+        self._started = time.perf_counter()
+        self.span = tracing.start_span("llm.chat_stream", kind="llm", model=self.model, cached=False)
+        cached = self.client.response_cache.get(self.cache_key) if self.cache_key is not None else None
+        if cached is not None:
+            self.cached = True
+            self.text = cached
+            self.time_to_first_token = self.elapsed = time.perf_counter() - self._started
+            self.span.set(cached=True)
+            return cached
+
+        # A stream always sends its own request, leading concurrent identical chat calls if it is the first
+        self.request_key = self.client._begin_request(self.model, self.messages, self.params, self.span)
+        self.flight, _ = self.client.single_flight.join(self.request_key, blocking, follow=False)
+        return None
+
+    def _on_chunk(self, chunk):
+        if getattr(chunk, "usage", None) is not None:
+            self.client._record_usage(chunk, self.estimated_tokens, self.span)
+        content = chunk.choices[0].delta.content if chunk.choices else None
+        if content:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - self._started
+            self.text += content
+            self.flight.publish(content)
+        return content
+
+    def _finish(self):
+        self.elapsed = time.perf_counter() - self._started
+        self.flight.publish(done=True)
+        if self.cache_key is not None and (self.cache_if is None or self.cache_if(self.text)):
+            self.client.response_cache.set(self.cache_key, self.text)
+
+    def _close_span(self, error=None):
+        # Runs once when the stream completes, fails or is abandoned by the consumer; an abandoned flight is retried
+        if self.flight is not None:
+            if isinstance(error, Exception):
+                self.flight.publish(error=error)
+            self.client.single_flight.leave(self.request_key, self.flight)
+        self.span.set(time_to_first_token=self.time_to_first_token)
+        self.span.finish(error)
+
+    def __iter__(self):
+        cached = self._begin(blocking=True)
+        error = None
+        try:
+            if cached is not None:
+                yield cached
+                return
+            response = self.client._call_with_retries(
+                lambda: self.client.sync_client.chat.completions.create(**self._create_kwargs()), self.estimated_tokens,
+                self.span)
+            for chunk in response:
+                content = self._on_chunk(chunk)
+                if content:
+                    yield content
+            self._finish()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._close_span(error)
+
+
+class AsyncChatStream(ChatStream):
+    """Async variant of ChatStream."""
+
+    def __iter__(self):
+        raise TypeError("Use `async for` to iterate an AsyncChatStream")
+
+    async def __aiter__(self):
+        cached = self._begin(blocking=False)
+        error = None
+        try:
+            if cached is not None:
+                yield cached
+                return
+            async with _request_slot():
+                response = await self.client._acall_with_retries(
+                    lambda: self.client.async_client.chat.completions.create(**self._create_kwargs()),
+                    self.estimated_tokens, self.span)
+                async for chunk in response:
+                    content = self._on_chunk(chunk)
+                    if content:
+                        yield content
+            self._finish()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._close_span(error)
+
+
+_shared_clients = {}
+_shared_response_cache = None
+_shared_clients_lock = threading.Lock()
+
+def get_shared_response_cache():
+    """Returns the process-wide response cache. Set APO_CACHE_BYPASS=1 to skip it."""
+    global _shared_response_cache
+    if _shared_response_cache is None:
+        _shared_response_cache = ResponseCache(bypass=os.environ.get("APO_CACHE_BYPASS", "") not in ("", "0"))
+    return _shared_response_cache
+
+def get_shared_client(api_key=None):
+    """Returns the process-wide LLMClient for an API key, so every caller shares one set of rate limits.
+
+    With APO_LLM_PROVIDER=fake the client talks to an offline FakeProvider and skips the response cache.
+    """
+    with _shared_clients_lock:
+        if api_key not in _shared_clients:
+            provider = get_provider_from_env(api_key)
+            response_cache = get_shared_response_cache() if provider.name == "openai" else None
+            _shared_clients[api_key] = LLMClient(api_key=api_key, response_cache=response_cache, provider=provider)
+        return _shared_clients[api_key]
@@ -0,0 +1,251 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from types import SimpleNamespace
+import openai
+
+# Set APO_LLM_PROVIDER=fake to run every app and tool offline against FakeProvider
+PROVIDER_ENV_VAR = "APO_LLM_PROVIDER"
+
+#%% Provider interface
+# A provider creates the SDK-shaped clients that LLMClient calls: `chat.completions.create(...)` (optionally
+# streaming chunks) and `embeddings.create(...)` with the response shapes of the OpenAI SDK.
+# LLMClient keeps rate limiting, retries and caching on top, so every provider gets them for free.
+
+class OpenAIProvider:
+    name = "openai"
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+
+    def create_client(self, timeout):
+        return openai.OpenAI(api_key=self.api_key, max_retries=0, timeout=timeout)
+
+    def create_async_client(self, timeout):
+        return openai.AsyncOpenAI(api_key=self.api_key, max_retries=0, timeout=timeout)
+
+
+class ProviderError(openai.OpenAIError):
+    """Error raised by a non-OpenAI provider. Retriable if its status code is (see llm_client.is_retriable_error)."""
+
+    def __init__(self, message, status_code=500, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers={"retry-after": str(retry_after)} if retry_after is not None else {})
+
+
+def get_provider_from_env(api_key=None):
+    """Returns the provider selected by APO_LLM_PROVIDER ("openai" by default, or "fake")."""
+    name = os.environ.get(PROVIDER_ENV_VAR, "openai").lower()
+    if name == "fake":
+        return FakeProvider()
+    if name == "openai":
+        return OpenAIProvider(api_key)
+    raise ValueError(f"Unknown {PROVIDER_ENV_VAR} '{name}', expected 'openai' or 'fake'")
+
+#%% Fake provider
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+FAKE_VOCABULARY = ("the", "student", "tutor", "answer", "question", "lesson", "friendly", "explain", "example",
+                   "math", "story", "learn", "today", "great", "try", "again", "remember", "why", "how", "because")
+
+def count_words(text):
+    return len(WORD_PATTERN.findall(text or ""))
+
+def hashed_embedding(text, embedding_dim):
+    """Deterministic bag-of-words embedding: texts sharing words get similar vectors, like a real model."""
+    vector = [0.0] * embedding_dim
+    for word in WORD_PATTERN.findall(text.lower()):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        vector[int.from_bytes(digest[:4], "little") % embedding_dim] += 1.0 if digest[4] & 1 else -1.0
+    norm = sum(x * x for x in vector) ** 0.5
+    if norm == 0:
+        vector[0], norm = 1.0, 1.0
+    return [x / norm for x in vector]
+
+FAKE_METRICS = ("relevance", "persona", "clarity", "engagement")
+
+def schema_instance(schema, rng, name=None):
+    """A random value matching a JSON schema (the subset used for structured outputs)."""
+    kind = schema.get("type")
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    if kind == "object":
+        return {name: schema_instance(property_schema, rng, name)
+                for name, property_schema in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [schema_instance(schema.get("items", {}), rng) for _ in range(rng.randint(3, 5))]
+    if kind in ("number", "integer"):
+        return rng.randint(2, 5)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if name == "metric":
+        return rng.choice(FAKE_METRICS)
+    return " ".join(rng.choice(FAKE_VOCABULARY) for _ in range(rng.randint(2, 8)))
+
+def default_responder(messages, rng, num_words):
+    """Canned plain-text replies. The Questioner and Judger ask for JSON-schema output and get schema instances."""
+    return " ".join(rng.choice(FAKE_VOCABULARY) for _ in range(num_words))
+
+
+class FakeProvider:
+    """Offline provider with configurable latency, errors and token counts, and deterministic output.
+
+    Latency is time to first token (lognormal around `latency_median` seconds) plus `seconds_per_token`
+    per generated token; `time_scale` multiplies all sleeps (0 disables them). A call fails with
+    ProviderError(`error_status`) with probability `error_rate`. Replies are a deterministic function of
+    the request (model, messages, params), so the response cache and replays behave as with a real model.
+    Requests with a JSON-schema `response_format` get a random instance of the schema.
+    `responder(messages, rng, num_words)` can replace the canned replies. `stats()` reports the traffic seen.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency_median=0.3, latency_sigma=0.5, seconds_per_token=0.004, completion_tokens_mean=120,
+                 completion_tokens_std=40, error_rate=0.0, error_status=429, retry_after=None, embedding_dim=1536,
+                 embedding_latency=0.05, time_scale=1.0, seed=0, responder=None):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.seconds_per_token = seconds_per_token
+        self.completion_tokens_mean = completion_tokens_mean
+        self.completion_tokens_std = completion_tokens_std
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.embedding_dim = embedding_dim
+        self.embedding_latency = embedding_latency
+        self.time_scale = time_scale
+        self.seed = seed
+        self.responder = responder
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def create_client(self, timeout):
+        return FakeClient(self, asynchronous=False)
+
+    def create_async_client(self, timeout):
+        return FakeClient(self, asynchronous=True)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {"chat_calls": 0, "embedding_calls": 0, "errors": 0, "prompt_tokens": 0,
+                           "completion_tokens": 0, "embedding_tokens": 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, total_tokens=self._stats["prompt_tokens"] + self._stats["completion_tokens"]
+                        + self._stats["embedding_tokens"])
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self._stats[key] += value
+
+    def _draw(self):
+        """Draws (fails, time to first token) for one call from the shared, seeded generator."""
+        with self._lock:
+            fails = self._rng.random() < self.error_rate
+            time_to_first_token = self._rng.lognormvariate(0, self.latency_sigma) * self.latency_median
+        return fails, time_to_first_token * self.time_scale
+
+    def _complete(self, model, messages, params):
+        """The deterministic reply to a request, split into word chunks, and its usage."""
+        request = json.dumps([model, messages, {k: v for k, v in params.items() if k not in ("stream", "stream_options")}],
+                             sort_keys=True, ensure_ascii=False)
+        rng = random.Random(hashlib.sha256(request.encode("utf-8")).digest())
+        num_words = max(1, int(rng.gauss(self.completion_tokens_mean, self.completion_tokens_std)))
+        if params.get("max_tokens"):
+            num_words = min(num_words, params["max_tokens"])
+        response_format = params.get("response_format") or {}
+        if self.responder is None and response_format.get("type") == "json_schema":
+            text = json.dumps(schema_instance(response_format["json_schema"]["schema"], rng), ensure_ascii=False)
+        else:
+            text = (self.responder or default_responder)(messages, rng, num_words)
+        chunks = re.findall(r"\S+\s*|\s+", text) or [text]
+        usage = SimpleNamespace(prompt_tokens=sum(count_words(message["content"]) for message in messages),
+                                completion_tokens=count_words(text))
+        usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+        self._count(chat_calls=1, prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+        return text, chunks, usage
+
+    def _raise_error(self):
+        self._count(errors=1)
+        raise ProviderError(f"Fake provider error {self.error_status}", self.error_status, self.retry_after)
+
+    def _embed(self, inputs):
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        self._count(embedding_calls=1, embedding_tokens=sum(count_words(text) for text in inputs))
+        data = [SimpleNamespace(index=i, embedding=hashed_embedding(text, self.embedding_dim)) for i, text in enumerate(inputs)]
+        return SimpleNamespace(data=data, usage=SimpleNamespace(total_tokens=sum(count_words(text) for text in inputs)))
+
+
+def _completion_response(text, usage):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+
+def _chunk(content=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class FakeClient:
+    """SDK-shaped client over a FakeProvider, sync or async."""
+
+    def __init__(self, provider, asynchronous):
+        self.provider = provider
+        self.asynchronous = asynchronous
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_async if asynchronous else self._create))
+        self.embeddings = SimpleNamespace(create=self._embed_async if asynchronous else self._embed)
+
+    def _create(self, model, messages, stream=False, **params):
+        fails, time_to_first_token = self.provider._draw()
+        time.sleep(time_to_first_token)
+        if fails:
+            self.provider._raise_error()
+        text, chunks, usage = self.provider._complete(model, messages, params)
+        if not stream:
+            time.sleep(self.provider.seconds_per_token * usage.completion_tokens * self.provider.time_scale)
+            return _completion_response(text, usage)
+        return self._stream(chunks, usage)
+
+    def _stream(self, chunks, usage):
+        for chunk in chunks:
+            yield _chunk(chunk)
+            time.sleep(self.provider.seconds_per_token * self.provider.time_scale)
+        yield _chunk(usage=usage)
+
+    async def _create_async(self, model, messages, stream=False, **params):
+        fails, time_to_first_token = self.provider._draw()
+        await asyncio.sleep(time_to_first_token)
+        if fails:
+            self.provider._raise_error()
+        text, chunks, usage = self.provider._complete(model, messages, params)
+        if not stream:
+            await asyncio.sleep(self.provider.seconds_per_token * usage.completion_tokens * self.provider.time_scale)
+            return _completion_response(text, usage)
+        return self._astream(chunks, usage)
+
+    async def _astream(self, chunks, usage):
+        for chunk in chunks:
+            yield _chunk(chunk)
+            await asyncio.sleep(self.provider.seconds_per_token * self.provider.time_scale)
+        yield _chunk(usage=usage)
+
+    def _embed(self, input, model):
+        fails, _ = self.provider._draw()
+        time.sleep(self.provider.embedding_latency * self.provider.time_scale)
+        if fails:
+            self.provider._raise_error()
+        return self.provider._embed(input)
+
+    async def _embed_async(self, input, model):
+        fails, _ = self.provider._draw()
+        await asyncio.sleep(self.provider.embedding_latency * self.provider.time_scale)
+        if fails:
+            self.provider._raise_error()
+        return self.provider._embed(input)
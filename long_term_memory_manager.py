@@ -1,99 +1,317 @@
 import os
-import numpy as np
 import time
-import pickle
-import openai
+import uuid
+import threading
+import contextlib
 import prompt_utils
+import tracing
+
+# numpy, openai and the store/cache modules are imported on first use, so importing this module stays cheap
 
 
 class LongTermMemoryManager:
-    """Manages long-term memory for the assistant. It can store, retrieve, and analyze previous conversations."""
+    """Manages long-term memory for the assistant. It can store, retrieve, and analyze previous conversations.
+
+    A manager is safe to share between threads: store reads and writes are serialized by a per-manager lock,
+    while embedding requests for queries run outside it. Writes to one conversation are applied in order.
+    """
+
+    STORE_FOLDER_NAME = "_store"
+    EMBEDDING_MODEL = "text-embedding-ada-002"
+    EMBEDDING_BATCH_SIZE = 256
+    EMBEDDING_BATCH_MAX_TOKENS = 250000
+    CHUNK_MESSAGES = 4      # messages per conversation chunk (two user/assistant exchanges)
+    RETRIEVAL_MODES = ("hybrid", "vector", "lexical")
+    RRF_K = 60
 
-    def __init__(self, memories_folder_path, session_start_date_tuple):
+    def __init__(self, memories_folder_path, session_start_date_tuple, embedding_dim=1536, search_backend=None, llm_client=None,
+                 embedding_cache=None, embedding_dtype=None, retrieval_mode="hybrid"):
         self.memories_folder_path = memories_folder_path
+        self._llm_client = llm_client
+        self._embedding_cache = embedding_cache
         self.date_start, self.day_of_week_start, self.time_start = session_start_date_tuple
-        self.memories = []
-        self.memories_embeddings = []
-        self.memories_filepaths = []
-        self.load_memories()
+        self.embedding_dim = embedding_dim
+        self.embedding_dtype = embedding_dtype
+        self.search_backend = search_backend
+        self.retrieval_mode = retrieval_mode
+        self._store = None
+        self._lock = threading.RLock()
+        self._conversation_locks = {}      # conversation id -> [lock, number of ingests using it]
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def store(self):
+        """The memory segment store, opened on first access."""
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self.load_memories()
+        return self._store
+
+    @property
+    def is_loaded(self):
+        return self._store is not None
+
+    @property
+    def estimated_nbytes(self):
+        """Approximate resident size of the loaded store (0 if not loaded), used for memory budgets."""
+        store = self._store
+        return store.estimated_nbytes if store is not None else 0
+
+    @property
+    def llm_client(self):
+        if self._llm_client is None:
+            from llm_client import get_shared_client
+            self._llm_client = get_shared_client()
+        return self._llm_client
+
+    @property
+    def embedding_cache(self):
+        if self._embedding_cache is None:
+            from embedding_cache import get_shared_embedding_cache
+            self._embedding_cache = get_shared_embedding_cache()
+        return self._embedding_cache
+
+    @property
+    def memories_embeddings(self):
+        return self.store.embeddings
 
     def load_memories(self):
-        """Loads stored memory embeddings from disk."""
-        self.memories.clear()
-        self.memories_embeddings.clear()
-        self.memories_filepaths.clear()
-
-        if not os.path.exists(self.memories_folder_path):
-            os.makedirs(self.memories_folder_path, exist_ok=True)
-            print("Memory folder not found. Created a new one.")
-            return
-
-        for entry in os.scandir(self.memories_folder_path):
-            if entry.is_file() and entry.name.endswith(".pkl"):
-                try:
-                    with open(entry.path, "rb") as f:
-                        memory = pickle.load(f)
-                        self.memories.append(memory)
-                        self.memories_embeddings.append(memory["embedding"])
-                        self.memories_filepaths.append(entry.path)
-                except (pickle.UnpicklingError, EOFError, FileNotFoundError) as e:
-                    print(f"Warning: Failed to load memory {entry.name} ({e})")
-
-        self.memories_embeddings = np.array(self.memories_embeddings) if self.memories_embeddings else np.array([])
-        print(f"Loaded {len(self.memories)} memories.")
-
-    def store_conversation_seq_memory(self, conversation_sequence, reload_memories=False):
-        """Stores a conversation sequence in long-term memory."""
-        memory = {
-            "memory_title": self.create_title_to_conversation_seq(conversation_sequence),
-            "memory_string": self.convert_conversation_seq_to_string(conversation_sequence),
-            "datetime": prompt_utils.get_current_time(),
-            "embedding": self.get_embedding_from_conversation_seq(conversation_sequence),
-            "conversation_sequence": conversation_sequence,
-        }
-        memory_filepath = os.path.join(self.memories_folder_path, f"{memory['memory_title']}.pkl")
+        """Opens the memory store. Legacy .pkl memories are not read; convert them with migrate_memories.py."""
+        from memory_store import MemoryStore
+
+        with self._lock:
+            if not os.path.exists(self.memories_folder_path):
+                os.makedirs(self.memories_folder_path, exist_ok=True)
+                print("Memory folder not found. Created a new one.")
+
+            self._store = MemoryStore(os.path.join(self.memories_folder_path, self.STORE_FOLDER_NAME),
+                                      self.embedding_dim, self.search_backend, self.embedding_dtype)
+
+            num_legacy_files = sum(1 for entry in os.scandir(self.memories_folder_path) if entry.is_file() and entry.name.endswith(".pkl"))
+            if num_legacy_files:
+                print(f"Warning: Found {num_legacy_files} legacy .pkl memories that are not loaded. "
+                      f"Run `python migrate_memories.py {self.memories_folder_path}` to convert them.")
+            print(f"Loaded {len(self.store)} memories.")
+
+    def get_memory(self, memory_index):
+        """Loads the full memory record stored at the given store row."""
+        with self._lock:
+            return self.store.get(memory_index)
+
+    def close(self):
+        """Closes the store; it is reopened on next use."""
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def store_conversation_seq_memory(self, conversation_sequence, reload_memories=False, conversation_id=None):
+        """Stores a conversation sequence in long-term memory as chunks and returns its conversation id.
+
+        Pass the returned conversation_id again as the conversation grows, and only its new messages are embedded
+        (see ingest_conversation). The index is updated incrementally, so reload_memories is kept only for
+        backwards compatibility.
+        """
+        conversation_id = conversation_id or uuid.uuid4().hex
+        self.ingest_conversation(conversation_id, conversation_sequence)
+        return conversation_id
 
+    def ingest_conversation(self, conversation_id, conversation_sequence):
+        """Appends the messages of a conversation that are not stored yet, in chunks of CHUNK_MESSAGES messages.
+
+        `conversation_sequence` is the whole conversation so far. Complete chunks are never rewritten; a trailing
+        partial chunk is replaced once more messages arrive, so each call costs O(new messages).
+        New chunks are embedded without holding the store lock, so fetches are not blocked meanwhile; ingests of
+        the same conversation are serialized. Returns the number of chunks written.
+        """
+        with tracing.span("memory_ingest", conversation_id=conversation_id) as ingest_span, \
+                self._conversation_lock(conversation_id):
+            while True:
+                with self._lock:
+                    replaced_id, chunks = self._plan_chunks(conversation_id, conversation_sequence)
+                if not chunks:
+                    return 0
+                ingest_span.set(num_chunks=len(chunks))
+                embeddings = self.get_embeddings_batch([chunk["memory_string"] for chunk in chunks])
+
+                with self._lock:
+                    # Another writer (e.g. delete_memories) may have changed the conversation while embedding
+                    current_id, current_chunks = self._plan_chunks(conversation_id, conversation_sequence)
+                    if current_id != replaced_id or [(c["chunk_id"], c["turn_start"]) for c in current_chunks] != \
+                            [(c["chunk_id"], c["turn_start"]) for c in chunks]:
+                        continue
+                    try:
+                        if replaced_id is not None:
+                            self.store.delete([replaced_id])
+                        self.store.add_many(chunks, embeddings)
+                    except OSError as e:
+                        print(f"Error: Failed to store memory ({e})")
+                        return 0
+                    return len(chunks)
+
+    def _plan_chunks(self, conversation_id, conversation_sequence):
+        # Returns (id of the partial last chunk to replace or None, new chunk records). Call with the store lock held
+        stored_chunks = self.store.conversation_chunks(conversation_id)
+        replaced_id, next_chunk_id, start = None, 0, 0
+        if stored_chunks:
+            _, last = stored_chunks[-1]
+            next_chunk_id, start = last["chunk_id"] + 1, last["turn_end"]
+            if last["turn_end"] - last["turn_start"] < self.CHUNK_MESSAGES and len(conversation_sequence) > last["turn_end"]:
+                # The partial last chunk is rewritten with the new messages
+                replaced_id, next_chunk_id, start = last["id"], last["chunk_id"], last["turn_start"]
+
+        chunks = []
+        for chunk_id, chunk_start in enumerate(range(start, len(conversation_sequence), self.CHUNK_MESSAGES), next_chunk_id):
+            window = conversation_sequence[chunk_start:chunk_start + self.CHUNK_MESSAGES]
+            chunks.append({
+                "memory_title": self.create_title_to_conversation_seq(window),
+                "memory_string": self.convert_conversation_seq_to_string(window),
+                "datetime": prompt_utils.get_current_time(),
+                "conversation_sequence": window,
+                "conversation_id": conversation_id,
+                "chunk_id": chunk_id,
+                "turn_start": chunk_start,
+                "turn_end": chunk_start + len(window),
+            })
+        return replaced_id, chunks
+
+    @contextlib.contextmanager
+    def _conversation_lock(self, conversation_id):
+        # One lock per conversation being ingested, dropped once no ingest uses it
+        with self._lock:
+            entry = self._conversation_locks.setdefault(conversation_id, [threading.Lock(), 0])
+            entry[1] += 1
         try:
-            with open(memory_filepath, "wb") as f:
-                pickle.dump(memory, f)
-        except Exception as e:
-            print(f"Error: Failed to store memory ({e})")
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._conversation_locks[conversation_id]
+
+    def store_many(self, conversation_sequences):
+        """Stores several conversation sequences, embedding them with batched requests."""
+        with tracing.span("memory_store", num_memories=len(conversation_sequences)):
+            memories = [{
+                "memory_title": self.create_title_to_conversation_seq(conversation_sequence),
+                "memory_string": self.convert_conversation_seq_to_string(conversation_sequence),
+                "datetime": prompt_utils.get_current_time(),
+                "conversation_sequence": conversation_sequence,
+            } for conversation_sequence in conversation_sequences]
+            embeddings = self.get_embeddings_batch([memory["memory_string"] for memory in memories])
+
+            try:
+                with self._lock:
+                    self.store.add_many(memories, embeddings)
+            except OSError as e:
+                print(f"Error: Failed to store memory ({e})")
+
+    def delete_memories(self, memory_ids):
+        """Removes memories by id. Disk space is reclaimed by rebuild_index."""
+        with self._lock:
+            self.store.delete(memory_ids)
+
+    def rebuild_index(self, reembed=False):
+        """Compacts the store, dropping deleted memories, and optionally re-embeds every memory in batches."""
+        with self._lock:
+            embeddings = None
+            if reembed:
+                embeddings = self.get_embeddings_batch([self.store.get(row)["memory_string"] for row in self.store.live_rows()])
+            self.store.compact(embeddings)
+            print(f"Rebuilt index with {len(self.store)} memories.")
 
-        if reload_memories:
-            self.load_memories()
+    def fetch_memory_related_to_conversation_seq(self, conversation_sequence_query, num_neighbors=3, min_similarity=0.4, minimal_output=False,
+                                                 max_chunks_per_conversation=None, retrieval_mode=None):
+        """Finds the most relevant past conversation chunks (or whole legacy memories).
 
-    def fetch_memory_related_to_conversation_seq(self, conversation_sequence_query, num_neighbors=3, min_similarity=0.4, minimal_output=False):
-        """Finds the most relevant past conversations based on similarity."""
+        retrieval_mode (default: the manager's) is "vector" (embedding similarity above min_similarity),
+        "lexical" (BM25 over the memory texts, no embedding request) or "hybrid" (both rankings fused with
+        reciprocal-rank fusion, every memory still above min_similarity). If the query cannot be embedded,
+        retrieval falls back to lexical.
+        max_chunks_per_conversation, if set, caps how many chunks of one conversation are returned, so the
+        neighbors cover more conversations. memory_scores in the auxiliary output holds the ranking score of
+        each neighbor; memory_similarities their cosine similarity (None when the query was not embedded, in
+        which case pass memory_scores to prompt_utils.wrap_retrieved_memories instead).
+        """
+        import numpy as np
+        from lexical_index import reciprocal_rank_fusion
+        from vector_search import normalize_embeddings
 
-        if not self.memories:
-            return [] if minimal_output else ([], {"memory_indices": [], "memory_similarities": [], "neighbors_filepaths": []})
+        retrieval_mode = retrieval_mode or self.retrieval_mode
+        if retrieval_mode not in self.RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{retrieval_mode}', expected one of {list(self.RETRIEVAL_MODES)}")
 
-        num_neighbors = min(num_neighbors, len(self.memories))
-        embedding = self.get_embedding_from_conversation_seq(conversation_sequence_query)
+        with tracing.span("memory_fetch", num_neighbors=num_neighbors, retrieval_mode=retrieval_mode) as fetch_span:
+            if len(self.store) == 0:
+                return [] if minimal_output else ([], {"memory_indices": [], "memory_similarities": [], "memory_scores": [],
+                                                       "memory_ids": [], "conversation_ids": []})
 
-        if self.memories_embeddings.size == 0:
-            return [] if minimal_output else ([], {"memory_indices": [], "memory_similarities": [], "neighbors_filepaths": []})
+            # Over-fetch when capping chunks per conversation, since capped chunks are skipped
+            num_candidates = num_neighbors if max_chunks_per_conversation is None else num_neighbors * 4
 
-        # Compute similarities
-        similarities = np.dot(self.memories_embeddings, np.array(embedding)[:, np.newaxis]).flatten()
-        sorted_indices = np.argsort(similarities)[::-1][:num_neighbors]
+            query = None
+            if retrieval_mode != "lexical":
+                embedding = self.get_embedding_from_conversation_seq(conversation_sequence_query)
+                if embedding.any():
+                    query = normalize_embeddings(embedding.reshape(1, -1))[0]
+                else:
+                    # Zero-vector fallback of a failed embedding request: every similarity would be 0
+                    print("Warning: Query embedding unavailable, falling back to lexical memory retrieval.")
+                    retrieval_mode = "lexical"
+                    fetch_span.set(fallback="lexical")
 
-        # Filter by similarity threshold
-        neighbors, memory_indices, memory_similarities, neighbors_filepaths = [], [], [], []
-        for i in sorted_indices:
-            if similarities[i] > min_similarity:
-                neighbors.append(self.memories[i])
-                memory_indices.append(i)
-                memory_similarities.append(similarities[i])
-                neighbors_filepaths.append(self.memories_filepaths[i])
+            # Search and record reads share the store with concurrent writers
+            with self._lock:
+                rankings = []
+                if query is not None:
+                    # Top-k over the pre-normalized embedding matrix (exact or approximate, depending on the backend)
+                    rows, similarities = self.store.search(query, num_candidates)
+                    rankings.append((rows[similarities > min_similarity], similarities[similarities > min_similarity]))
+                if retrieval_mode != "vector":
+                    query_text = " ".join(msg["content"] for msg in conversation_sequence_query)
+                    rows, scores = self.store.search_lexical(query_text, num_candidates)
+                    if query is not None:
+                        # A shared common word ("me", "about") is enough for a BM25 hit, so in hybrid mode lexical
+                        # hits must pass the similarity threshold too; they still lift matches the vector top-k missed
+                        similarities = self.store.embeddings[rows].astype(np.float32) @ query
+                        rows, scores = rows[similarities > min_similarity], scores[similarities > min_similarity]
+                    rankings.append((rows, scores))
 
-        auxiliary_output = {
-            "memory_indices": memory_indices,
-            "memory_similarities": memory_similarities,
-            "neighbors_filepaths": neighbors_filepaths,
-        }
+                if retrieval_mode == "hybrid":
+                    ranked_rows, scores = reciprocal_rank_fusion([rows for rows, _ in rankings], k=self.RRF_K)
+                else:
+                    ranked_rows, scores = rankings[0]
 
-        return neighbors if minimal_output else (neighbors, auxiliary_output)
+                neighbors, memory_indices, memory_similarities, memory_scores, memory_ids, conversation_ids = [], [], [], [], [], []
+                chunks_per_conversation = {}
+                for i, score in zip(ranked_rows, scores):
+                    if len(neighbors) >= num_neighbors:
+                        break
+                    conversation_id = self.store.metadata[i].get("conversation_id")
+                    if max_chunks_per_conversation is not None and conversation_id is not None:
+                        if chunks_per_conversation.get(conversation_id, 0) >= max_chunks_per_conversation:
+                            continue
+                        chunks_per_conversation[conversation_id] = chunks_per_conversation.get(conversation_id, 0) + 1
+                    neighbors.append(self.get_memory(i))
+                    memory_indices.append(int(i))
+                    memory_similarities.append(None if query is None else float(self.store.embeddings[i].astype(np.float32) @ query))
+                    memory_scores.append(float(score))
+                    memory_ids.append(neighbors[-1]["id"])
+                    conversation_ids.append(conversation_id)
+
+                auxiliary_output = {
+                    "memory_indices": memory_indices,
+                    "memory_similarities": memory_similarities,
+                    "memory_scores": memory_scores,
+                    "memory_ids": memory_ids,
+                    "conversation_ids": conversation_ids,
+                }
+
+                return neighbors if minimal_output else (neighbors, auxiliary_output)
 
     def convert_conversation_seq_to_string(self, conversation_sequence):
         """Converts a conversation sequence into a structured string format."""
@@ -108,14 +326,52 @@ class LongTermMemoryManager:
 
     def get_embedding_from_string(self, input_string):
         """Fetches an embedding from OpenAI API with error handling."""
-        try:
-            response = openai.Embedding.create(input=input_string, model="text-embedding-ada-002")
-            return response["data"][0]["embedding"]
-        except openai.error.OpenAIError as e:
-            print(f"Error: Failed to generate embedding ({e})")
-            return np.zeros(1536)  # Fallback to a zero-vector
+        return self.get_embeddings_batch([input_string])[0]
+
+    def get_embeddings_batch(self, input_strings):
+        """Embeds many strings as a float32 array, serving repeats from the embedding cache.
+
+        Distinct uncached strings are grouped into as few requests as the batch limits allow.
+        A failed request falls back to zero-vectors for its strings, which are not cached.
+        """
+        import numpy as np
+        import openai
+        from embedding_cache import EmbeddingCache
+
+        embeddings = np.zeros((len(input_strings), self.embedding_dim), dtype=np.float32)
+        keys = [EmbeddingCache.make_key(input_string, self.EMBEDDING_MODEL) for input_string in input_strings]
+        missing = {}
+        for i, (key, vector) in enumerate(zip(keys, self.embedding_cache.get_many(keys))):
+            if vector is not None and len(vector) == self.embedding_dim:
+                embeddings[i] = vector
+            else:
+                missing.setdefault(key, []).append(i)
+
+        missing_keys = list(missing)
+        token_counts = prompt_utils.count_tokens_many([input_strings[missing[key][0]] for key in missing_keys])
+        for batch_keys in self._split_embedding_batches(missing_keys, token_counts):
+            try:
+                vectors = self.llm_client.embed([input_strings[missing[key][0]] for key in batch_keys], model=self.EMBEDDING_MODEL)
+            except openai.OpenAIError as e:
+                print(f"Error: Failed to generate embedding ({e})")
+                continue  # Fallback to zero-vectors
+            self.embedding_cache.set_many(batch_keys, vectors)
+            for key, vector in zip(batch_keys, vectors):
+                embeddings[missing[key]] = vector
+        return embeddings
 
     def create_title_to_conversation_seq(self, conversation_sequence):
-        """Creates a title for the memory file based on date and message count."""
+        """Creates a title for the memory based on date and message count."""
         curr_date, day_of_week, curr_time = prompt_utils.get_current_time()
         return f"mem__{curr_date.replace('/', '_')}_{day_of_week}_{curr_time[:-3]}__len_{len(conversation_sequence)}"
+
+    def _split_embedding_batches(self, keys, token_counts):
+        batch, batch_tokens = [], 0
+        for key, num_tokens in zip(keys, token_counts):
+            if batch and (len(batch) >= self.EMBEDDING_BATCH_SIZE or batch_tokens + num_tokens > self.EMBEDDING_BATCH_MAX_TOKENS):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(key)
+            batch_tokens += num_tokens
+        if batch:
+            yield batch
@@ -0,0 +1,111 @@
+import os
+import json
+import numpy as np
+from vector_search import ExactSearch, normalize_embeddings
+
+
+class MemoryIndex:
+    """Persistent embedding matrix with a JSONL metadata sidecar, memory-mapped for fast top-k lookup.
+
+    Rows are L2-normalized on insert, so a dot product with a normalized query is the cosine similarity.
+    The metadata line is written after the embedding row and acts as the commit marker for that row.
+    Top-k queries are delegated to a pluggable search backend (see vector_search), exact by default.
+    Rows are stored as float32, or as float16 to halve the footprint at a small cost in precision.
+    """
+
+    EMBEDDINGS_FILENAMES = {"float32": "embeddings.f32", "float16": "embeddings.f16"}
+    METADATA_FILENAME = "metadata.jsonl"
+
+    def __init__(self, index_folder_path, embedding_dim=1536, search_backend=None, embedding_dtype="float32"):
+        if embedding_dtype not in self.EMBEDDINGS_FILENAMES:
+            raise ValueError(f"Unsupported embedding dtype '{embedding_dtype}', expected one of {list(self.EMBEDDINGS_FILENAMES)}")
+        self.index_folder_path = index_folder_path
+        self.embedding_dim = embedding_dim
+        self.dtype = np.dtype(embedding_dtype)
+        self.search_backend = search_backend or ExactSearch()
+        self.embeddings_path = os.path.join(index_folder_path, self.EMBEDDINGS_FILENAMES[embedding_dtype])
+        self.metadata_path = os.path.join(index_folder_path, self.METADATA_FILENAME)
+        self.metadata = []
+        self.embeddings = np.empty((0, embedding_dim), dtype=self.dtype)
+        self.load()
+
+    def __len__(self):
+        return len(self.metadata)
+
+    @property
+    def row_nbytes(self):
+        return self.embedding_dim * self.dtype.itemsize
+
+    def load(self):
+        """Reads the metadata sidecar and memory-maps the embedding matrix, dropping any torn trailing write."""
+        os.makedirs(self.index_folder_path, exist_ok=True)
+
+        self.metadata = []
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break   # the write of this line was cut short, even if what remains parses
+                    try:
+                        self.metadata.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+
+        embeddings_nbytes = os.path.getsize(self.embeddings_path) if os.path.exists(self.embeddings_path) else 0
+        num_rows = min(len(self.metadata), embeddings_nbytes // self.row_nbytes)
+        if num_rows != len(self.metadata) or num_rows * self.row_nbytes != embeddings_nbytes:
+            print(f"Warning: Memory index out of sync, truncating to {num_rows} rows.")
+            self._truncate(num_rows)
+
+        self._remap()
+        self.search_backend.attach(self)
+
+    def add(self, embedding, metadata):
+        """Appends a single embedding and its metadata. Returns the row index."""
+        return self.add_many([embedding], [metadata])[0]
+
+    def add_many(self, embeddings, metadatas):
+        """Appends a batch of embeddings and their metadata without re-reading existing rows."""
+        if len(embeddings) != len(metadatas):
+            raise ValueError("embeddings and metadatas must have the same length")
+        if not metadatas:
+            return []
+
+        vectors = normalize_embeddings(np.asarray(embeddings, dtype=np.float32).reshape(len(metadatas), -1))
+        if vectors.shape[1] != self.embedding_dim:
+            raise ValueError(f"Expected embeddings of dimension {self.embedding_dim}, got {vectors.shape[1]}")
+
+        with open(self.embeddings_path, "ab") as f:
+            f.write(vectors.astype(self.dtype).tobytes())
+        with open(self.metadata_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(metadata) + "\n" for metadata in metadatas)
+
+        first_row = len(self.metadata)
+        self.metadata.extend(metadatas)
+        self._remap()
+        row_ids = list(range(first_row, len(self.metadata)))
+        self.search_backend.on_add(row_ids)
+        return row_ids
+
+    def search(self, query_embedding, num_neighbors):
+        """Returns (row indices, cosine similarities) of the top-k rows, most similar first."""
+        num_neighbors = min(num_neighbors, len(self))
+        if num_neighbors <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        query = normalize_embeddings(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1))[0]
+        return self.search_backend.search(query, num_neighbors)
+
+    def _remap(self):
+        if self.metadata:
+            self.embeddings = np.memmap(self.embeddings_path, dtype=self.dtype, mode="r",
+                                        shape=(len(self.metadata), self.embedding_dim))
+        else:
+            self.embeddings = np.empty((0, self.embedding_dim), dtype=self.dtype)
+
+    def _truncate(self, num_rows):
+        self.metadata = self.metadata[:num_rows]
+        with open(self.metadata_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(metadata) + "\n" for metadata in self.metadata)
+        if os.path.exists(self.embeddings_path):
+            os.truncate(self.embeddings_path, num_rows * self.row_nbytes)
@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import prompt_utils
+from long_term_memory_manager import LongTermMemoryManager
+
+USER_ID_PATTERN = re.compile(r"^[\w-]+$", re.UNICODE)
+
+
+class MemoryManagerPool:
+    """Per-user LongTermMemoryManagers for serving many users from one process.
+
+    A user's memory folder is opened on first use. Loaded stores are kept in LRU order and the least recently
+    used ones are closed once their estimated total size exceeds `memory_budget_bytes`; an evicted user is
+    transparently reloaded on next use. Stores in use (see `lease`) are never evicted. The pool lock only guards
+    the bookkeeping, so loading or querying one user's memory never blocks the others.
+    """
+
+    def __init__(self, root_folder=".", memory_budget_bytes=1 << 30, folder_template="memories_{user_id}", llm_client=None,
+                 embedding_cache=None, **manager_kwargs):
+        self.root_folder = root_folder
+        self.memory_budget_bytes = memory_budget_bytes
+        self.folder_template = folder_template
+        self.llm_client = llm_client
+        self.embedding_cache = embedding_cache
+        self.manager_kwargs = manager_kwargs
+        self._managers = OrderedDict()      # user id -> manager, least recently used first
+        self._leases = {}                   # user id -> number of callers currently using the manager
+        self._lock = threading.Lock()
+        self.num_loads = 0
+        self.num_evictions = 0
+
+    def __len__(self):
+        return len(self._managers)
+
+    def folder_path(self, user_id):
+        if not USER_ID_PATTERN.match(str(user_id)):
+            raise ValueError(f"Invalid user id {user_id!r}: use letters, digits, '_' or '-'")
+        return os.path.join(self.root_folder, self.folder_template.format(user_id=user_id))
+
+    @contextmanager
+    def lease(self, user_id):
+        """Pins the user's manager (loaded) for the duration of the block, so it cannot be evicted meanwhile.
+
+        Do not keep the manager after the block: once evicted, the pool may open a new manager on the same folder.
+        """
+        manager = self._acquire(user_id)
+        try:
+            if not manager.is_loaded:
+                manager.store       # loads outside the pool lock
+                with self._lock:
+                    self.num_loads += 1
+            yield manager
+        finally:
+            self._release(user_id)
+
+    def fetch(self, user_id, conversation_sequence_query, **kwargs):
+        with self.lease(user_id) as manager:
+            return manager.fetch_memory_related_to_conversation_seq(conversation_sequence_query, **kwargs)
+
+    def ingest(self, user_id, conversation_id, conversation_sequence):
+        with self.lease(user_id) as manager:
+            return manager.ingest_conversation(conversation_id, conversation_sequence)
+
+    def resident_nbytes(self):
+        with self._lock:
+            return sum(manager.estimated_nbytes for manager in self._managers.values())
+
+    def stats(self):
+        with self._lock:
+            return {"managers": len(self._managers), "loaded": sum(1 for m in self._managers.values() if m.is_loaded),
+                    "resident_nbytes": sum(m.estimated_nbytes for m in self._managers.values()),
+                    "loads": self.num_loads, "evictions": self.num_evictions}
+
+    def close(self):
+        with self._lock:
+            managers = list(self._managers.values())
+            self._managers.clear()
+        for manager in managers:
+            manager.close()
+
+    def _acquire(self, user_id):
+        user_id = str(user_id)
+        folder_path = self.folder_path(user_id)
+        with self._lock:
+            manager = self._managers.get(user_id)
+            if manager is None:
+                manager = self._managers[user_id] = LongTermMemoryManager(
+                    folder_path, prompt_utils.get_current_time(), llm_client=self.llm_client,
+                    embedding_cache=self.embedding_cache, **self.manager_kwargs)
+            self._managers.move_to_end(user_id)
+            self._leases[user_id] = self._leases.get(user_id, 0) + 1
+        return manager
+
+    def _release(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            self._leases[user_id] -= 1
+            if not self._leases[user_id]:
+                del self._leases[user_id]
+            to_close = self._select_evictions()
+        for manager in to_close:
+            manager.close()
+
+    def _select_evictions(self):
+        # Called with the pool lock held; returns the managers to close once the lock is released
+        total = sum(manager.estimated_nbytes for manager in self._managers.values())
+        evicted = []
+        for user_id in list(self._managers):
+            if total <= self.memory_budget_bytes:
+                break
+            if user_id in self._leases:
+                continue
+            manager = self._managers.pop(user_id)
+            total -= manager.estimated_nbytes
+            evicted.append(manager)
+        self.num_evictions += len(evicted)
+        return evicted
@@ -0,0 +1,275 @@
+import os
+import json
+import uuid
+import zlib
+import shutil
+import struct
+import threading
+import numpy as np
+from memory_index import MemoryIndex
+from lexical_index import BM25Index
+from vector_search import ExactSearch
+
+
+class RecordLog:
+    """Append-only log of JSON records, each framed by a (payload length, crc32) header.
+
+    Records are addressed by (offset, length) as returned by `append_many`, so reading one
+    is a single seek and read. Nothing is ever unpickled.
+    """
+
+    HEADER = struct.Struct("<II")
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reader = None
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def append_many(self, records):
+        """Appends records and returns their (offset, length) pairs, length including the header."""
+        chunks, locations = [], []
+        offset = self.size
+        for record in records:
+            payload = json.dumps(record, ensure_ascii=False).encode("utf-8")
+            chunk = self.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+            chunks.append(chunk)
+            locations.append((offset, len(chunk)))
+            offset += len(chunk)
+        with open(self.path, "ab") as f:
+            f.write(b"".join(chunks))
+        return locations
+
+    def read(self, offset, length):
+        with self._lock:
+            if self._reader is None:
+                self._reader = open(self.path, "rb")
+            self._reader.seek(offset)
+            chunk = self._reader.read(length)
+
+        payload_length, checksum = self.HEADER.unpack_from(chunk)
+        payload = chunk[self.HEADER.size:]
+        if len(payload) != payload_length or zlib.crc32(payload) != checksum:
+            raise ValueError(f"Corrupt record at offset {offset} in {self.path}")
+        return json.loads(payload.decode("utf-8"))
+
+    def truncate(self, size):
+        self.close()
+        if os.path.exists(self.path):
+            os.truncate(self.path, size)
+
+    def close(self):
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+
+class MemoryStore:
+    """Segment-based memory storage: an embedding matrix, a record log and a small JSONL index.
+
+    Every memory gets a unique id. Its embedding is a row of the memory-mapped matrix (see MemoryIndex),
+    its full record (title, text, conversation) lives in the append-only record log, and its index line
+    holds the id, a few searchable fields and the record's location in the log. The index line is written
+    last and commits the memory. Deletions are tombstones until `compact` rewrites the segment without them.
+    Memories ingested in chunks carry a conversation_id and chunk_id, so a conversation's chunks can be found
+    without reading the record log. A BM25 index over each memory_string is kept in step with the embeddings
+    for lexical search.
+    """
+
+    RECORDS_FILENAME = "records.log"
+    TOMBSTONES_FILENAME = "deleted.jsonl"
+    INDEXED_FIELDS = ("id", "memory_title", "datetime", "conversation_id", "chunk_id", "turn_start", "turn_end")
+    METADATA_NBYTES_PER_ROW = 1024      # index dict, id lookups and tombstone bookkeeping per memory
+    POSTING_NBYTES = 72                 # one (row, term frequency) entry of the lexical index as Python ints
+
+    def __init__(self, folder_path, embedding_dim=1536, search_backend=None, embedding_dtype=None):
+        # embedding_dtype=None keeps whatever the segment was written with (float32 for a new one), detected on load
+        self.folder_path = folder_path
+        self.embedding_dim = embedding_dim
+        self.embedding_dtype = embedding_dtype
+        self.search_backend = search_backend
+        self.records = RecordLog(os.path.join(folder_path, self.RECORDS_FILENAME))
+        self.tombstones_path = os.path.join(folder_path, self.TOMBSTONES_FILENAME)
+        self.index = None
+        self.lexical_index = None
+        self.row_by_id = {}
+        self.rows_by_conversation = {}
+        self.deleted_rows = set()
+        self.load()
+
+    def __len__(self):
+        return len(self.index) - len(self.deleted_rows)
+
+    @property
+    def embeddings(self):
+        return self.index.embeddings
+
+    @property
+    def metadata(self):
+        return self.index.metadata
+
+    @property
+    def estimated_nbytes(self):
+        """Rough in-memory footprint: the embedding matrix plus per-row metadata and lexical postings."""
+        return (self.index.embeddings.nbytes + len(self.index) * self.METADATA_NBYTES_PER_ROW
+                + self.lexical_index.num_postings * self.POSTING_NBYTES)
+
+    def load(self):
+        """Opens the segment, finishing an interrupted compaction and dropping any torn trailing write."""
+        self._recover_compaction()
+        # Only once the segment is back in place can its dtype be told from its files
+        self.embedding_dtype = self.embedding_dtype or self._detect_embedding_dtype(self.folder_path)
+        self.records.close()
+        self.index = MemoryIndex(self.folder_path, self.embedding_dim, self.search_backend, self.embedding_dtype)
+        self.row_by_id = {metadata["id"]: row for row, metadata in enumerate(self.metadata)}
+        self.rows_by_conversation = {}
+        self._index_conversations(range(len(self.metadata)))
+
+        # Records appended after the last committed index line belong to a write that never finished
+        committed_size = self.metadata[-1]["offset"] + self.metadata[-1]["length"] if self.metadata else 0
+        if self.records.size > committed_size:
+            self.records.truncate(committed_size)
+        self.lexical_index = BM25Index(self.folder_path)
+        self.lexical_index.load(len(self.index), lambda row: self.get(row).get("memory_string", ""))
+
+        self.deleted_rows = set()
+        if os.path.exists(self.tombstones_path):
+            deleted_ids = []
+            with open(self.tombstones_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        deleted_ids.append(json.loads(line)["id"] if line.endswith("\n") else None)
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        deleted_ids.append(None)
+            if None in deleted_ids:
+                # Drop torn lines, so the next tombstone is not appended to one and lost with it
+                deleted_ids = [memory_id for memory_id in deleted_ids if memory_id is not None]
+                with open(self.tombstones_path, "w", encoding="utf-8") as f:
+                    f.writelines(json.dumps({"id": memory_id}) + "\n" for memory_id in deleted_ids)
+            self.deleted_rows.update(self.row_by_id[memory_id] for memory_id in deleted_ids if memory_id in self.row_by_id)
+
+    def add_many(self, records, embeddings):
+        """Appends records with their embeddings and returns the new rows. Records without an "id" get one."""
+        if len(records) != len(embeddings):
+            raise ValueError("records and embeddings must have the same length")
+        if not records:
+            return []
+
+        records = [record if record.get("id") else {"id": uuid.uuid4().hex, **record} for record in records]
+        locations = self.records.append_many(records)
+        metadatas = [self._create_index_metadata(record, offset, length) for record, (offset, length) in zip(records, locations)]
+        rows = self.index.add_many(embeddings, metadatas)
+        self.row_by_id.update((record["id"], row) for record, row in zip(records, rows))
+        self._index_conversations(rows)
+        self.lexical_index.add_many(rows, [record.get("memory_string", "") for record in records])
+        return rows
+
+    def get(self, row):
+        """Reads the full record stored at an index row."""
+        metadata = self.metadata[row]
+        return self.records.read(metadata["offset"], metadata["length"])
+
+    def get_by_id(self, memory_id):
+        row = self.row_by_id.get(memory_id)
+        if row is None or row in self.deleted_rows:
+            raise KeyError(memory_id)
+        return self.get(row)
+
+    def conversation_chunks(self, conversation_id):
+        """(row, index metadata) of a conversation's live chunks, in chunk order."""
+        rows = [row for row in self.rows_by_conversation.get(conversation_id, []) if row not in self.deleted_rows]
+        return sorted(((row, self.metadata[row]) for row in rows), key=lambda item: item[1]["chunk_id"])
+
+    def live_rows(self):
+        return [row for row in range(len(self.index)) if row not in self.deleted_rows]
+
+    def delete(self, memory_ids):
+        """Tombstones memories by id. Their space is reclaimed by the next `compact`."""
+        rows = [self.row_by_id[memory_id] for memory_id in memory_ids if memory_id in self.row_by_id]
+        with open(self.tombstones_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps({"id": self.metadata[row]["id"]}) + "\n" for row in rows)
+        self.deleted_rows.update(rows)
+
+    def search(self, query_embedding, num_neighbors):
+        """Returns (rows, cosine similarities) of the top-k live memories, most similar first."""
+        rows, similarities = self.index.search(query_embedding, num_neighbors + len(self.deleted_rows))
+        if self.deleted_rows:
+            keep = np.array([row not in self.deleted_rows for row in rows], dtype=bool)
+            rows, similarities = rows[keep], similarities[keep]
+        return rows[:num_neighbors], similarities[:num_neighbors]
+
+    def search_lexical(self, query_text, num_neighbors):
+        """Returns (rows, BM25 scores) of the top-k live memories matching the query's words, best first."""
+        return self.lexical_index.search(query_text, num_neighbors, self.deleted_rows)
+
+    def compact(self, embeddings=None, batch_size=1024):
+        """Rewrites the segment without deleted memories, reclaiming their space. Row numbers change.
+
+        `embeddings`, if given, replaces the stored embedding of each live memory (in `live_rows` order),
+        e.g. after re-embedding with a new model. The new segment is built next to the current one and
+        swapped in with directory renames, so an interrupted compaction never loses data.
+        """
+        live_rows = self.live_rows()
+        if embeddings is not None and len(embeddings) != len(live_rows):
+            raise ValueError("embeddings must have one row per live memory")
+
+        compact_path, old_path = self.folder_path + ".compact", self.folder_path + ".old"
+        shutil.rmtree(compact_path, ignore_errors=True)
+        # The search backend is rebuilt when the compacted segment is reopened
+        target = MemoryStore(compact_path, self.embedding_dim, ExactSearch(), self.embedding_dtype)
+        for start in range(0, len(live_rows), batch_size):
+            batch_rows = live_rows[start:start + batch_size]
+            batch_embeddings = self.embeddings[batch_rows] if embeddings is None else embeddings[start:start + batch_size]
+            target.add_many([self.get(row) for row in batch_rows], batch_embeddings)
+        target.records.close()
+        with open(os.path.join(compact_path, ".complete"), "w"):
+            pass
+
+        self.records.close()
+        self.index = None
+        os.replace(self.folder_path, old_path)
+        os.replace(compact_path, self.folder_path)
+        os.remove(os.path.join(self.folder_path, ".complete"))
+        shutil.rmtree(old_path, ignore_errors=True)
+        self.load()
+        print(f"Compacted memory store to {len(self)} memories.")
+
+    def close(self):
+        self.records.close()
+
+    def _recover_compaction(self):
+        compact_path, old_path = self.folder_path + ".compact", self.folder_path + ".old"
+        if os.path.exists(os.path.join(compact_path, ".complete")) and not os.path.exists(self.folder_path):
+            # Interrupted between the two renames: the finished compacted segment wins
+            os.replace(compact_path, self.folder_path)
+            os.remove(os.path.join(self.folder_path, ".complete"))
+        shutil.rmtree(compact_path, ignore_errors=True)
+        if os.path.exists(self.folder_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+        elif os.path.exists(old_path):
+            os.replace(old_path, self.folder_path)
+        os.makedirs(self.folder_path, exist_ok=True)
+        if os.path.exists(os.path.join(self.folder_path, ".complete")):
+            os.remove(os.path.join(self.folder_path, ".complete"))
+
+    @staticmethod
+    def _detect_embedding_dtype(folder_path):
+        for dtype, filename in MemoryIndex.EMBEDDINGS_FILENAMES.items():
+            if os.path.exists(os.path.join(folder_path, filename)):
+                return dtype
+        return "float32"
+
+    def _index_conversations(self, rows):
+        for row in rows:
+            conversation_id = self.metadata[row].get("conversation_id")
+            if conversation_id is not None:
+                self.rows_by_conversation.setdefault(conversation_id, []).append(row)
+
+    def _create_index_metadata(self, record, offset, length):
+        metadata = {field: record[field] for field in self.INDEXED_FIELDS if field in record}
+        metadata.update(offset=offset, length=length)
+        return metadata
@@ -0,0 +1,89 @@
+import functools
+from dataclasses import dataclass
+from typing import Tuple
+import prompt_utils
+from context_window import ContextWindow, MESSAGE_TOKEN_OVERHEAD
+
+# Provider-side prompt caching matches requests on their longest identical prefix, so everything that does not change
+# between turns (instructions, then the evaluated prompt) comes first, as messages that are built once and reused
+# unchanged; only the conversation window and the new user message vary from turn to turn.
+
+DEFAULT_INSTRUCTIONS_TOKEN_BUDGET = 3584
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    """Static leading messages of every request, with their token count in ContextWindow's accounting.
+
+    Instances are memoized and shared: never mutate `messages`.
+    """
+    messages: Tuple[dict, ...] = ()
+    num_tokens: int = 0
+
+    def new_window(self, token_budget, summarizer=None):
+        """A ContextWindow whose requests start with this prefix, without re-tokenizing it."""
+        return ContextWindow(token_budget, self.messages, summarizer=summarizer, prefix_tokens=self.num_tokens)
+
+
+def _make_prefix(messages):
+    messages = tuple(messages)
+    num_tokens = sum(prompt_utils.count_tokens_from_string(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+                     for message in messages)
+    return PromptPrefix(messages, num_tokens)
+
+
+@functools.lru_cache(maxsize=64)
+def instruction_options(chatbot_name):
+    """The instruction variants formatted for chatbot_name, as (messages, content tokens) pairs, built once per name."""
+    options = []
+    for template, role in ((prompt_utils.sys_prompt_str, 'system'),
+                           (prompt_utils.sys_prompt_as_user_prompt_0, 'user'),
+                           (prompt_utils.sys_prompt_as_user_prompt_1, 'user')):
+        messages = tuple(prompt_utils.wrap_prompt(template.format(chatbot_name=chatbot_name) + prompt_utils.SYSTEM_PROMPT,
+                                                  role=role))
+        options.append((messages, prompt_utils.count_tokens_from_conversation_seq(messages)))
+    return tuple(options)
+
+
+@functools.lru_cache(maxsize=256)
+def instruction_messages(chatbot_name, instructions_token_budget=DEFAULT_INSTRUCTIONS_TOKEN_BUDGET):
+    """The longest instruction variant that fits the budget (the first one if none fits)."""
+    options = instruction_options(chatbot_name)
+    best_index = max((i for i, (_, num_tokens) in enumerate(options) if num_tokens <= instructions_token_budget),
+                     key=lambda i: options[i][1], default=0)
+    return options[best_index][0]
+
+
+@functools.lru_cache(maxsize=256)
+def build_prefix(system_prompt=None, chatbot_name=None, instructions_token_budget=DEFAULT_INSTRUCTIONS_TOKEN_BUDGET):
+    """The request prefix: chatbot_name's instructions (if given), then system_prompt as a system message (if given)."""
+    messages = list(instruction_messages(chatbot_name, instructions_token_budget)) if chatbot_name else []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    return _make_prefix(messages)
+
+
+def new_history(token_budget, system_prompt=None, chatbot_name=None, summarizer=None):
+    """A conversation window for dialogues run under system_prompt; its prefix is shared across dialogues and turns."""
+    return build_prefix(system_prompt, chatbot_name).new_window(token_budget, summarizer)
+
+
+def extend_prefix(prefix_messages, system_prompt=None):
+    """prefix_messages followed by system_prompt as a system message (unless they already end with it)."""
+    prefix_messages = tuple(prefix_messages)
+    system_prefix = build_prefix(system_prompt)
+    if not prefix_messages:
+        return system_prefix
+    if not system_prefix.messages or prefix_messages[-1] == system_prefix.messages[-1]:
+        return _make_prefix(prefix_messages)
+    return _make_prefix(prefix_messages + system_prefix.messages)
+
+
+def derive_history(history, system_prompt=None):
+    """A per-dialogue copy of history whose requests run under system_prompt, after history's own prefix.
+
+    The original window, and its prefix, are left unchanged.
+    """
+    prefix = extend_prefix(history.prefix_messages, system_prompt)
+    return history.with_prefix(prefix.messages, prefix.num_tokens)
+
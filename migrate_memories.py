@@ -0,0 +1,100 @@
+"""One-shot migration of a legacy memory folder (one .pkl file per memory) into the segment store.
+
+Each pickle becomes a record in `<folder>/_store`, with its embedding appended to the embedding matrix.
+Pickles are loaded in parallel and integrity-checked (see legacy_loader.py); corrupt files and unusable
+embeddings are reported and left in place.
+Migrated pickles are moved to `<folder>/_legacy_pickles` (or deleted with --delete). The migration can be
+re-run safely: memory ids are derived from the pickle filename, so already migrated files are skipped.
+Only run it on folders you created yourself, since unpickling untrusted files can execute code.
+
+Usage:
+    python migrate_memories.py memories_20250215
+    python migrate_memories.py memories_20250215 --float16 --delete
+"""
+import os
+import time
+import shutil
+import hashlib
+import argparse
+import numpy as np
+from memory_store import MemoryStore
+from legacy_loader import list_legacy_files, load_legacy_folder
+from long_term_memory_manager import LongTermMemoryManager
+
+LEGACY_FOLDER_NAME = "_legacy_pickles"
+
+
+def legacy_memory_id(filename):
+    return hashlib.sha1(filename.encode("utf-8")).hexdigest()[:32]
+
+
+def folder_nbytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def migrate_folder(memories_folder_path, embedding_dtype=None, delete=False, batch_size=1024, num_workers=None):
+    """Migrates every .pkl memory in a folder. Returns the number of memories added to the store.
+
+    Pickles are loaded in parallel (see legacy_loader); files that fail its integrity checks are reported and left in place.
+    """
+    pickle_paths = list_legacy_files(memories_folder_path)
+    if not pickle_paths:
+        print("No .pkl memories to migrate.")
+        return 0
+
+    store = MemoryStore(os.path.join(memories_folder_path, LongTermMemoryManager.STORE_FOLDER_NAME),
+                        embedding_dtype=embedding_dtype)
+    legacy_folder_path = os.path.join(memories_folder_path, LEGACY_FOLDER_NAME)
+    legacy_nbytes = folder_nbytes(pickle_paths)
+    started = time.perf_counter()
+
+    # Files migrated by an earlier, interrupted run are only moved aside
+    already_migrated = [path for path in pickle_paths if legacy_memory_id(os.path.basename(path)) in store.row_by_id]
+    pending = [path for path in pickle_paths if legacy_memory_id(os.path.basename(path)) not in store.row_by_id]
+    legacy = load_legacy_folder(paths=pending, embedding_dim=store.embedding_dim, num_workers=num_workers)
+    print(legacy.report.summary())
+    for problem in legacy.report.corrupt + legacy.report.wrong_dimension:
+        print(f"Warning: Skipping memory {problem['file']} ({problem.get('error') or 'dimension ' + str(problem['dimension'])})")
+    for name in legacy.report.zero_vectors + legacy.report.non_finite_vectors:
+        print(f"Warning: Skipping memory {name} with an unusable (zero or non-finite) embedding")
+
+    num_added = 0
+    valid_rows = np.flatnonzero(legacy.valid)
+    move_aside(already_migrated, legacy_folder_path, delete)
+    for start in range(0, len(valid_rows), batch_size):
+        batch_rows = valid_rows[start:start + batch_size]
+        records = [{"id": legacy_memory_id(os.path.basename(legacy.paths[row])), **legacy.records[row]} for row in batch_rows]
+        store.add_many(records, legacy.embeddings[batch_rows])
+        num_added += len(records)
+        # Only move pickles once their batch is committed to the store
+        move_aside([legacy.paths[row] for row in batch_rows], legacy_folder_path, delete)
+
+    store_nbytes = folder_nbytes(os.path.join(store.folder_path, name) for name in os.listdir(store.folder_path))
+    store.close()
+    print(f"Migrated {num_added} memories in {time.perf_counter() - started:.1f}s ({legacy.report.num_problems} failed). "
+          f"{legacy_nbytes / 1e6:.1f} MB of pickles -> {store_nbytes / 1e6:.1f} MB store.")
+    return num_added
+
+
+def move_aside(paths, legacy_folder_path, delete):
+    for path in paths:
+        if delete:
+            os.remove(path)
+        else:
+            os.makedirs(legacy_folder_path, exist_ok=True)
+            shutil.move(path, os.path.join(legacy_folder_path, os.path.basename(path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("memories_folder", help="memory folder containing .pkl files")
+    parser.add_argument("--float16", action="store_true", help="store embeddings as float16 to halve their size")
+    parser.add_argument("--delete", action="store_true", help="delete migrated pickles instead of moving them aside")
+    parser.add_argument("--workers", type=int, default=None, help="loader processes (default: one per core)")
+    args = parser.parse_args()
+
+    migrate_folder(args.memories_folder, "float16" if args.float16 else None, args.delete, num_workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import time
+import asyncio
+import contextvars
+import tracing
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Tuple
+
+
+@dataclass
+class PipelineStep:
+    name: str
+    func: Callable      # async callable receiving the results of `deps` positionally
+    deps: Tuple[str, ...] = ()
+
+
+@dataclass
+class StepResult:
+    name: str
+    status: str         # "done", "failed" or "skipped"
+    value: Any = None
+    error: Optional[BaseException] = None
+    elapsed: float = 0.0
+
+
+class Pipeline:
+    """Runs a DAG of async steps, starting each step as soon as its dependencies have finished.
+
+    Independent branches run concurrently, bounded by `max_concurrency` steps in flight. A step may send many
+    LLM requests at once (e.g. one per simulated dialogue), so `max_requests` separately caps the async LLM
+    requests in flight across all steps of a run (see llm_client.limit_requests).
+    A step whose dependency failed or was skipped is skipped. `on_step_done` is called with each
+    StepResult on the event loop thread as soon as the step finishes, so it can update the UI.
+    Each run is traced as a "pipeline" span with one child span per executed step.
+    LLM requests are recorded per step; a step that resends a request one of its dependencies already made
+    is listed in `repeated_requests` (step -> dependency), a sign that the step could reuse that result.
+    """
+
+    def __init__(self, max_concurrency=4, max_requests=None):
+        self.max_concurrency = max_concurrency
+        self.max_requests = max_requests
+        self.steps = {}
+        self.repeated_requests = {}
+        self._request_keys = {}     # step name -> keys of the LLM requests it sent
+
+    def add_step(self, name, func, deps=()):
+        if name in self.steps:
+            raise ValueError(f"Duplicate pipeline step '{name}'")
+        missing = [dep for dep in deps if dep not in self.steps]
+        if missing:
+            raise ValueError(f"Step '{name}' depends on unknown steps {missing}; add dependencies first")
+        self.steps[name] = PipelineStep(name, func, tuple(deps))
+        return self
+
+    async def run(self, on_step_done=None):
+        """Runs every step and returns a dict of StepResult by step name."""
+        from llm_client import limit_requests
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.repeated_requests, self._request_keys = {}, {}
+        results = {}
+        tasks = {}
+
+        async def run_step(step):
+            if step.deps:
+                await asyncio.gather(*(tasks[dep] for dep in step.deps))
+            unfinished = [dep for dep in step.deps if results[dep].status != "done"]
+
+            if unfinished:
+                result = StepResult(step.name, "skipped")
+            else:
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        with tracing.span(step.name), \
+                                tracing.observe_requests(lambda key: self._record_request(step, key)):
+                            value = await step.func(*(results[dep].value for dep in step.deps))
+                        result = StepResult(step.name, "done", value, elapsed=time.perf_counter() - started)
+                    except Exception as e:
+                        result = StepResult(step.name, "failed", error=e, elapsed=time.perf_counter() - started)
+
+            results[step.name] = result
+            if on_step_done:
+                on_step_done(result)
+
+        # Steps are registered after their dependencies, so insertion order is a topological order.
+        # Tasks copy the current context when created, so every step span nests under the pipeline span.
+        with tracing.span("pipeline"), limit_requests(self.max_requests):
+            for step in self.steps.values():
+                tasks[step.name] = asyncio.ensure_future(run_step(step))
+            await asyncio.gather(*tasks.values())
+        return results
+
+    def _record_request(self, step, request_key):
+        # Runs in the step's context, possibly on a worker thread; returns the dependency that sent the same request
+        self._request_keys.setdefault(step.name, set()).add(request_key)
+        for dep in step.deps:
+            if request_key in self._request_keys.get(dep, ()):
+                self.repeated_requests[step.name] = dep
+                return dep
+        return None
+
+
+async def iterate_in_thread(make_iterator):
+    """Consumes a blocking iterator in a worker thread, yielding its items on the event loop as they arrive."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    finished = object()
+
+    def produce():
+        try:
+            for item in make_iterator():
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, finished)
+
+    # Run in a copy of the current context so that spans opened by the iterator nest under the caller's
+    producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+    while (item := await queue.get()) is not finished:
+        yield item
+    await producer  # re-raises an exception from the iterator
@@ -1,5 +1,9 @@
+import os
 import re
+import hashlib
 import datetime
+import threading
+from collections import OrderedDict
 import tiktoken
 
 #%% Various Prompt Strings
@@ -111,39 +115,221 @@ Pika: That was so much fun! Tớ rất thích nói chuyện với cậu. Next ti
 
 """
 
+#%% Token Counting State
+
+DEFAULT_TOKENIZER_MODEL = "gpt-3.5-turbo"
+TOKEN_COUNT_CACHE_SIZE = 65536
+
+_encoders = {}      # model name -> tiktoken encoder (or ApproximateEncoder), built once per process
+_encoders_lock = threading.Lock()
+_token_count_cache = OrderedDict()      # (encoding name, content hash) -> token count, LRU ordered
+_token_count_cache_lock = threading.Lock()
+
 #%% Helper Functions
 
 def get_current_time():
     now = datetime.datetime.now()
     return now.strftime("%d/%m/%Y"), now.strftime("%A"), now.strftime("%H:%M:%S")
 
-def count_tokens_from_string(input_string):
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    return len(encoding.encode(input_string))
+class ApproximateEncoder:
+    """Offline stand-in for a tiktoken encoding: one token per word or punctuation mark, with its leading spaces.
 
-def count_tokens_from_conversation_seq(conversation_seq):
-    return sum(count_tokens_from_string(turn['content']) for turn in conversation_seq)
+    Used when the fake provider is selected or tiktoken cannot load its vocabulary (it downloads it on first use).
+    Counts are close to cl100k_base for English text, and decoding a token prefix gives back the text's prefix.
+    """
+    name = "approximate"
+    TOKEN_PATTERN = re.compile(r"\s*(?:\w+|[^\w\s])", re.UNICODE)
 
-def wrap_prompt(prompt_string, role='user'):
-    return [{"role": role, "content": prompt_string}]
+    def encode(self, text, **kwargs):
+        return self.TOKEN_PATTERN.findall(text)
 
-def wrap_retrieved_memories(retrieved_memories, retrieved_token_budget=1536):
-    user_prefix = 'Reminder about past conversations we had:\n'
-    assistant_ack = 'Got it. If relevant, I will reference these conversations in future responses.'
-    budget_remaining = retrieved_token_budget - count_tokens_from_string(user_prefix + assistant_ack)
+    def encode_batch(self, texts, num_threads=8, **kwargs):
+        return [self.encode(text) for text in texts]
 
-    retrieval_message = user_prefix
-    for memory in retrieved_memories:
+    def decode(self, tokens):
+        return "".join(tokens)
+
+def _load_encoder(model):
+    # Same switch as llm_providers.PROVIDER_ENV_VAR: offline runs must not download tiktoken vocabularies
+    if os.environ.get("APO_LLM_PROVIDER", "").lower() == "fake":
+        return ApproximateEncoder()
+    try:
         try:
-            memory_string = '---\n' + memory['memory_string']
-            if budget_remaining > count_tokens_from_string(memory_string):
-                retrieval_message += memory_string
-                budget_remaining -= count_tokens_from_string(memory_string)
-        except:
-            pass
-    retrieval_message += '---\n'
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"Warning: Could not load the tokenizer for {model} ({e}), token counts are approximate.")
+        return ApproximateEncoder()
+
+def get_encoder(model=DEFAULT_TOKENIZER_MODEL):
+    encoder = _encoders.get(model)
+    if encoder is None:
+        with _encoders_lock:
+            encoder = _encoders.get(model)
+            if encoder is None:
+                encoder = _encoders[model] = _load_encoder(model)
+    return encoder
+
+def _token_count_cache_key(encoder, input_string):
+    return encoder.name, hashlib.blake2b(input_string.encode("utf-8"), digest_size=16).digest()
+
+def _cache_token_counts(keys, counts):
+    with _token_count_cache_lock:
+        for key, count in zip(keys, counts):
+            _token_count_cache[key] = count
+            _token_count_cache.move_to_end(key)
+        while len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+
+def _get_cached_token_count(key):
+    with _token_count_cache_lock:
+        count = _token_count_cache.get(key)
+        if count is not None:
+            _token_count_cache.move_to_end(key)
+        return count
+
+def count_tokens_from_string(input_string, model=DEFAULT_TOKENIZER_MODEL):
+    encoder = get_encoder(model)
+    key = _token_count_cache_key(encoder, input_string)
+    count = _get_cached_token_count(key)
+    if count is None:
+        count = len(encoder.encode(input_string, disallowed_special=()))
+        _cache_token_counts([key], [count])
+    return count
+
+def count_tokens_many(input_strings, model=DEFAULT_TOKENIZER_MODEL, num_threads=8):
+    encoder = get_encoder(model)
+    keys = [_token_count_cache_key(encoder, s) for s in input_strings]
+    counts = [_get_cached_token_count(key) for key in keys]
+
+    # Encode each distinct uncached string once, spread across tiktoken's thread pool
+    missing = {key: s for key, s, count in zip(keys, input_strings, counts) if count is None}
+    if missing:
+        missing_keys = list(missing)
+        missing_counts = [len(tokens) for tokens in encoder.encode_batch([missing[key] for key in missing_keys],
+                                                                         num_threads=num_threads, disallowed_special=())]
+        _cache_token_counts(missing_keys, missing_counts)
+        missing = dict(zip(missing_keys, missing_counts))
+        counts = [missing[key] if count is None else count for key, count in zip(keys, counts)]
+    return counts
+
+def truncate_to_tokens(input_string, max_tokens, model=DEFAULT_TOKENIZER_MODEL):
+    """The longest prefix of input_string that is at most max_tokens tokens long."""
+    if max_tokens <= 0:
+        return ""
+    encoder = get_encoder(model)
+    tokens = encoder.encode(input_string, disallowed_special=())
+    return input_string if len(tokens) <= max_tokens else encoder.decode(tokens[:max_tokens])
+
+def count_tokens_from_conversation_seq(conversation_seq, model=DEFAULT_TOKENIZER_MODEL):
+    return sum(count_tokens_many([turn['content'] for turn in conversation_seq], model))
+
+def wrap_prompt(prompt_string, role='user'):
+    return [{"role": role, "content": prompt_string}]
 
-    return wrap_prompt(retrieval_message, role='user') + wrap_prompt(assistant_ack, role='assistant')
+#%% Retrieved Memory Packing
+
+RETRIEVAL_USER_PREFIX = 'Reminder about past conversations we had:\n'
+RETRIEVAL_ASSISTANT_ACK = 'Got it. If relevant, I will reference these conversations in future responses.'
+MEMORY_SEPARATOR = '---\n'
+OMITTED_TURNS_MARKER = '[...]'
+PACKING_CAPACITY_STEPS = 256    # the knapsack works in budget / 256 token units, so packing stays O(memories * turns * 256)
+
+def _memory_header_and_turns(memory):
+    """Splits a memory record into its header and one line per turn, or (None, None) if it cannot be truncated."""
+    conversation_sequence = memory.get('conversation_sequence')
+    header, separator, _ = memory['memory_string'].partition('\n\n')
+    if not conversation_sequence or not separator:
+        return None, None
+    return header, [f"{msg['role']}: {msg['content']}" for msg in conversation_sequence]
+
+def _turn_relevance(turn_lines, query_string):
+    # Lexical overlap with the query, so ranking turns costs no embedding calls; later turns win ties
+    query_words = set(re.findall(r'\w+', (query_string or '').lower()))
+    return [(len(query_words & set(re.findall(r'\w+', line.lower()))), i) for i, line in enumerate(turn_lines)]
+
+def _memory_packing_options(memory, similarity, query_string, max_tokens):
+    """Candidate renderings of one memory as (tokens, value, text): the full memory, then truncations that keep its
+    most relevant turns. A truncation's value is the similarity scaled by the share of turn relevance it keeps."""
+    full_text = MEMORY_SEPARATOR + memory['memory_string'].rstrip('\n') + '\n'
+    full_tokens = count_tokens_from_string(full_text)
+    options = [(full_tokens, similarity, full_text)]
+
+    header, turn_lines = _memory_header_and_turns(memory)
+    if header is None or len(turn_lines) < 2 or full_tokens <= max_tokens // 2:
+        return options
+
+    header_tokens, marker_tokens, *turn_tokens = count_tokens_many(
+        [MEMORY_SEPARATOR + header + '\n\n', OMITTED_TURNS_MARKER + '\n'] + [line + '\n' for line in turn_lines])
+    relevance = _turn_relevance(turn_lines, query_string)
+    weights = [1 + overlap for overlap, _ in relevance]
+    kept, kept_tokens, kept_weight = [], header_tokens, 0
+    for _, i in sorted(relevance, reverse=True)[:-1]:
+        kept.append(i)
+        kept_tokens += turn_tokens[i] + marker_tokens
+        kept_weight += weights[i]
+        if kept_tokens > max_tokens:
+            break
+        lines, previous = [], -1
+        for j in sorted(kept):
+            if j != previous + 1:
+                lines.append(OMITTED_TURNS_MARKER)
+            lines.append(turn_lines[j])
+            previous = j
+        if previous != len(turn_lines) - 1:
+            lines.append(OMITTED_TURNS_MARKER)
+        options.append((kept_tokens, similarity * kept_weight / sum(weights),
+                        MEMORY_SEPARATOR + header + '\n\n' + '\n'.join(lines) + '\n'))
+    return options
+
+def pack_retrieved_memories(retrieved_memories, token_budget, similarities=None, query_string=None):
+    """Chooses at most one rendering per memory (full or truncated) maximizing summed similarity within token_budget.
+
+    This is a multiple-choice knapsack solved by dynamic programming over the budget, using cached token counts.
+    Similarities default to the retrieval order (first is best), also when some are None (e.g. lexical retrieval,
+    which has no similarities; pass its ranking scores instead). Returns the chosen texts in retrieval order.
+    """
+    if similarities is not None and any(similarity is None for similarity in similarities):
+        similarities = None
+    memories = [(memory, similarities[i] if similarities is not None else len(retrieved_memories) - i)
+                for i, memory in enumerate(retrieved_memories)
+                if isinstance(memory, dict) and isinstance(memory.get('memory_string'), str)]
+    if not memories or token_budget <= 0:
+        return []
+
+    unit = max(1, -(-token_budget // PACKING_CAPACITY_STEPS))
+    capacity = token_budget // unit
+    # best[c] = (value, choices) using at most c units; choices maps memory position -> option
+    best = [(0.0, ())] * (capacity + 1)
+    all_options = []
+    for position, (memory, similarity) in enumerate(memories):
+        options = [option for option in _memory_packing_options(memory, max(float(similarity), 0.0), query_string, token_budget)
+                   if option[0] <= token_budget]
+        all_options.append(options)
+        new_best = list(best)
+        for option_index, (tokens, value, _) in enumerate(options):
+            cost = -(-tokens // unit)
+            for c in range(capacity, cost - 1, -1):
+                candidate_value = best[c - cost][0] + value
+                if candidate_value > new_best[c][0]:
+                    new_best[c] = (candidate_value, best[c - cost][1] + ((position, option_index),))
+        best = new_best
+
+    return [all_options[position][option_index][2] for position, option_index in sorted(best[capacity][1])]
+
+def wrap_retrieved_memories(retrieved_memories, retrieved_token_budget=1536, similarities=None, query_string=None):
+    """Wraps retrieved memories into a reminder exchange that fits retrieved_token_budget.
+
+    Pass the retrieval `similarities` (aligned with the memories) and the `query_string` the memories were retrieved
+    for: memories that do not fit whole are cut down to the turns that best match the query instead of being dropped.
+    """
+    budget_remaining = retrieved_token_budget - count_tokens_from_string(RETRIEVAL_USER_PREFIX + RETRIEVAL_ASSISTANT_ACK) \
+        - count_tokens_from_string(MEMORY_SEPARATOR)
+    memory_strings = pack_retrieved_memories(retrieved_memories, budget_remaining, similarities, query_string)
+    retrieval_message = RETRIEVAL_USER_PREFIX + ''.join(memory_strings) + MEMORY_SEPARATOR
+
+    return wrap_prompt(retrieval_message, role='user') + wrap_prompt(RETRIEVAL_ASSISTANT_ACK, role='assistant')
 
 def parse_chatgpt_response(chatgpt_response):
     response_content = chatgpt_response['content']
@@ -151,21 +337,9 @@ def parse_chatgpt_response(chatgpt_response):
     return internal_thoughts.strip(), response_string.strip()
 
 def get_instructions_prompts_seq(chatbot_name='Integral', instructions_token_budget=3584):
-    # formatted_prompts = [
-    #     wrap_prompt(sys_prompt_str.format(chatbot_name=chatbot_name) + sys_requirements, role='system'),
-    #     wrap_prompt(sys_prompt_as_user_prompt_0.format(chatbot_name=chatbot_name) + sys_requirements, role='user'),
-    #     wrap_prompt(sys_prompt_as_user_prompt_1.format(chatbot_name=chatbot_name) + sys_requirements, role='user')
-    # ]
-
-    formatted_prompts = [
-        wrap_prompt(sys_prompt_str.format(chatbot_name=chatbot_name) + SYSTEM_PROMPT, role='system'),
-        wrap_prompt(sys_prompt_as_user_prompt_0.format(chatbot_name=chatbot_name) + SYSTEM_PROMPT, role='user'),
-        wrap_prompt(sys_prompt_as_user_prompt_1.format(chatbot_name=chatbot_name) + SYSTEM_PROMPT, role='user')
-    ]
-    
-    best_prompt = max((p for p in formatted_prompts if count_tokens_from_conversation_seq(p) <= instructions_token_budget),
-                      key=count_tokens_from_conversation_seq, default=formatted_prompts[0])
-    return best_prompt
+    # The longest instruction variant that fits the budget; variants are formatted and counted once per chatbot_name
+    import message_assembly
+    return [dict(message) for message in message_assembly.instruction_messages(chatbot_name, instructions_token_budget)]
 
 def pad_format_reminder_to_user_prompt(user_prompt_string):
     return wrap_prompt(user_prompt_string + '\n\nRemember to use the [Mood, Intent, Expectation, Memory, Response] format.', role='user')
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(".apo_cache", "responses.sqlite3")
+
+
+class ResponseCache:
+    """Persistent SQLite cache of LLM responses keyed by a hash of model, messages and sampling params.
+
+    Entries older than `ttl_seconds` are treated as misses and purged; beyond `max_entries` (or
+    `max_bytes` of stored text) the least recently used entries are evicted. Set `bypass` to
+    disable reads and writes without dropping the stored entries.
+    """
+
+    EVICT_EVERY_N_WRITES = 64
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_entries=20000, max_bytes=None, ttl_seconds=7 * 24 * 3600, bypass=False):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_evict = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.evict()
+
+    @staticmethod
+    def make_key(model, messages, **params):
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached response or None, counting the lookup as a hit or a miss."""
+        if self.bypass:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        if self.bypass or value is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now))
+            self._writes_since_evict += 1
+            should_evict = self._writes_since_evict >= self.EVICT_EVERY_N_WRITES
+        if should_evict:
+            self.evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def evict(self):
+        """Drops expired entries, then least recently used ones until the size limits hold."""
+        with self._lock:
+            self._writes_since_evict = 0
+            if self.ttl_seconds is not None:
+                self._connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            if self.max_entries is not None:
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+            if self.max_bytes is not None:
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM ("
+                    "SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC) AS running_size FROM responses"
+                    ") WHERE running_size > ?)", (self.max_bytes,))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self._lock:
+            entries, total_bytes = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total_bytes}
@@ -0,0 +1,155 @@
+import re
+import json
+import threading
+import tracing
+
+#%% JSON-schema responses
+# Steps whose replies are machine-read ask for `response_format={"type": "json_schema", ...}`, so the model
+# returns JSON matching the schema. Replies are still validated: a reply that cannot be used is sent back once
+# with the error (a repair request for that step alone) instead of failing the whole run.
+
+JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.S)
+
+REPAIR_PROMPT = ("Your previous reply could not be used: {error}\n"
+                 "Reply again with only the JSON object, following the required schema exactly.")
+
+
+class StructuredOutputError(ValueError):
+    """A reply that does not match its schema (or the step's own checks)."""
+
+
+def json_schema_format(name, schema):
+    """The response_format for strict JSON-schema output."""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def validate(data, schema, path="$"):
+    """Checks data against the subset of JSON schema used here (type, properties, required, additionalProperties,
+    items, enum). Raises StructuredOutputError naming the first offending path."""
+    expected = schema.get("type")
+    checks = {"object": lambda v: isinstance(v, dict), "array": lambda v: isinstance(v, list),
+              "string": lambda v: isinstance(v, str), "boolean": lambda v: isinstance(v, bool),
+              "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+              "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)}
+    if expected in checks and not checks[expected](data):
+        raise StructuredOutputError(f"{path} should be of type {expected}")
+    if "enum" in schema and data not in schema["enum"]:
+        raise StructuredOutputError(f"{path} should be one of {schema['enum']}")
+
+    if expected == "object":
+        properties = schema.get("properties", {})
+        missing = [name for name in schema.get("required", ()) if name not in data]
+        if missing:
+            raise StructuredOutputError(f"{path} is missing {missing}")
+        if schema.get("additionalProperties") is False and (extra := sorted(set(data) - set(properties))):
+            raise StructuredOutputError(f"{path} has unexpected keys {extra}")
+        for name, value in data.items():
+            if name in properties:
+                validate(value, properties[name], f"{path}.{name}")
+    elif expected == "array" and "items" in schema:
+        for i, item in enumerate(data):
+            validate(item, schema["items"], f"{path}[{i}]")
+    return data
+
+
+def parse_json_reply(text, schema):
+    """Loads and validates a JSON reply. The whole reply is tried first; failing that, the outermost {...} in it
+    (models without schema support wrap JSON in code fences or prose)."""
+    if not text:
+        raise StructuredOutputError("the reply is empty")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        match = JSON_OBJECT_PATTERN.search(text)
+        try:
+            data = json.loads(match.group(0)) if match else None
+        except ValueError as e:
+            raise StructuredOutputError(f"the reply is not valid JSON ({e})")
+        if data is None:
+            raise StructuredOutputError("the reply contains no JSON object")
+    return validate(data, schema)
+
+#%% Parse metrics
+
+class ParseMetrics:
+    """Per-step counts of structured replies: parsed first time, repaired, failed, and repair requests sent."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, step, outcome, num_repairs=0):
+        with self._lock:
+            counts = self._counts.setdefault(step, {"replies": 0, "first_try": 0, "repaired": 0, "failed": 0,
+                                                    "repair_calls": 0})
+            counts["replies"] += 1
+            counts[outcome] += 1
+            counts["repair_calls"] += num_repairs
+
+    def stats(self):
+        with self._lock:
+            return {step: dict(counts) for step, counts in self._counts.items()}
+
+    def stats_since(self, snapshot):
+        """Per-step counts recorded after `snapshot` (an earlier `stats()`), for steps with new replies."""
+        return {step: {name: count - snapshot.get(step, {}).get(name, 0) for name, count in counts.items()}
+                for step, counts in self.stats().items() if counts["replies"] > snapshot.get(step, {}).get("replies", 0)}
+
+    def num_failures(self, stats=None):
+        """Replies that needed a repair or could not be used at all, in `stats` if given."""
+        stats = self.stats() if stats is None else stats
+        return sum(counts["repaired"] + counts["failed"] for counts in stats.values())
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+parse_metrics = ParseMetrics()
+
+#%% Structured completion
+
+async def complete_structured(client, messages, model, step, response_format, parse, max_repairs=1, on_stream=None,
+                              **params):
+    """Requests a JSON-schema reply and returns parse(reply text), re-asking up to max_repairs times with the error.
+
+    `parse` raises StructuredOutputError for an unusable reply. The first request is served from the response cache
+    like any other step, but only a reply that parses is stored there; repair requests are never cached. Raises
+    StructuredOutputError if every attempt fails. Outcomes are counted in `parse_metrics` under `step`.
+    """
+    messages = list(messages)
+    params = dict(params, response_format=response_format)
+
+    def parses(reply):
+        try:
+            parse(reply)
+        except StructuredOutputError:
+            return False
+        return True
+
+    for attempt in range(max_repairs + 1):
+        use_cache = attempt == 0
+        if on_stream is None:
+            reply = await client.achat(messages, model=model, use_cache=use_cache, cache_if=parses, **params)
+        else:
+            stream = client.astream_chat(messages, model=model, use_cache=use_cache, cache_if=parses, **params)
+            async for _ in stream:
+                on_stream(stream.text, stream.time_to_first_token)
+            reply = stream.text
+        try:
+            result = parse(reply)
+        except StructuredOutputError as e:
+            print(f"Warning: {step} reply could not be parsed ({e}).")
+            if use_cache:
+                # Also drops an unusable reply cached before replies were checked, so a rerun asks again
+                client.forget_cached(messages, model=model, **params)
+            if (current := tracing.current_span()) is not None:
+                current.set(parse_error=str(e))
+            messages += [{"role": "assistant", "content": reply or ""},
+                         {"role": "user", "content": REPAIR_PROMPT.format(error=e)}]
+            error = e
+            continue
+        parse_metrics.record(step, "repaired" if attempt else "first_try", attempt)
+        return result
+    parse_metrics.record(step, "failed", max_repairs)
+    raise StructuredOutputError(f"{step} returned no usable reply after {max_repairs} repairs: {error}")
@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prompt_utils
+from llm_providers import FakeProvider
+from llm_client import LLMClient
+
+
+@pytest.fixture(autouse=True)
+def offline_tokens(monkeypatch):
+    # Tests run offline like APO_LLM_PROVIDER=fake runs, so token counts come from prompt_utils.ApproximateEncoder
+    monkeypatch.setenv("APO_LLM_PROVIDER", "fake")
+    monkeypatch.setattr(prompt_utils, "_encoders", {})
+
+
+@pytest.fixture(autouse=True)
+def no_trace_export(monkeypatch):
+    import tracing
+    monkeypatch.setattr(tracing.tracer, "jsonl_path", "")
+
+
+@pytest.fixture
+def fake_provider():
+    return FakeProvider(latency_median=0.001, latency_sigma=0.1, time_scale=0.0)
+
+
+@pytest.fixture
+def client(fake_provider):
+    return LLMClient(provider=fake_provider)
@@ -0,0 +1,71 @@
+import asyncio
+import structured_output
+from llm_client import LLMClient
+from llm_providers import FakeProvider
+from apo_models import quote_prompt, build_optimization_pipeline
+
+
+def test_pipeline_runs_end_to_end_on_the_fake_provider(client, fake_provider):
+    parse_stats_before = structured_output.parse_metrics.stats()
+    pipeline = build_optimization_pipeline(quote_prompt("You are a friendly math tutor for children."), client,
+                                           num_dialogues=2)
+    results = asyncio.run(pipeline.run())
+
+    assert {name: result.status for name, result in results.items()} == dict.fromkeys(results, "done")
+    assert results["rephrase"].value and results["cot"].value
+    for name in ("original_questions", "new_questions"):
+        assert len(results[name].value) == 2
+        assert all(questions and all(isinstance(q, str) and q for q in questions) for questions in results[name].value)
+    for name in ("original_chat", "new_chat"):
+        assert len(results[name].value) == 2 and all(transcript.turns for transcript in results[name].value)
+
+    judging = results["judge"].value
+    assert judging.original.n >= 2 and judging.new.n >= 2
+    assert judging.original.num_failed == judging.new.num_failed == 0
+    assert structured_output.parse_metrics.num_failures(structured_output.parse_metrics.stats_since(parse_stats_before)) == 0
+    assert fake_provider.stats()["chat_calls"] > 0
+
+
+def track_requests_in_flight(monkeypatch):
+    """Records the most provider chat requests (a stream counts until its last chunk) in flight at once."""
+    import llm_providers
+    in_flight = {"now": 0, "max": 0}
+    create = llm_providers.FakeClient._create_async
+
+    async def tracked_stream(stream):
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            in_flight["now"] -= 1
+
+    async def tracked_create(self, model, messages, stream=False, **params):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        try:
+            response = await create(self, model, messages, stream=stream, **params)
+        except BaseException:
+            in_flight["now"] -= 1
+            raise
+        if not stream:
+            in_flight["now"] -= 1
+            return response
+        return tracked_stream(response)
+
+    monkeypatch.setattr(llm_providers.FakeClient, "_create_async", tracked_create)
+    return in_flight
+
+
+def test_max_requests_caps_llm_requests_across_steps(monkeypatch):
+    in_flight = track_requests_in_flight(monkeypatch)
+    provider = FakeProvider(latency_median=0.005, latency_sigma=0.1, seconds_per_token=0.0005, completion_tokens_mean=20)
+    client = LLMClient(provider=provider)
+    prompt = quote_prompt("You are a patient science tutor.")
+
+    results = asyncio.run(build_optimization_pipeline(prompt, client, num_dialogues=4, max_requests=2).run())
+    assert all(result.status == "done" for result in results.values())
+    assert in_flight["max"] == 2
+
+    uncapped = asyncio.run(build_optimization_pipeline(prompt + " ", client, num_dialogues=4).run())
+    assert all(result.status == "done" for result in uncapped.values())
+    assert in_flight["max"] > 4
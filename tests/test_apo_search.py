@@ -0,0 +1,18 @@
+import asyncio
+from apo_search import APOSearch, Candidate
+
+
+def test_ucb_stops_pulling_a_candidate_whose_pulls_fail(client):
+    search = APOSearch(client, strategy="ucb", pulls_per_candidate=4, max_concurrency=1)
+    pool = [Candidate(i, f"prompt {i}", round=1) for i in range(3)]
+
+    async def pull(candidate, on_event):
+        candidate.num_pulls += 1
+        return candidate, None if candidate.id == 0 else '{"clarity": 4}'
+
+    search._pull = pull
+    asyncio.run(search._ucb(pool, lambda kind, payload: None))
+
+    assert sum(candidate.num_pulls for candidate in pool) == 12
+    assert pool[0].num_pulls <= 2 and pool[0].summary.num_failed == pool[0].num_pulls
+    assert search._rank(pool)[-1] is pool[0]
@@ -0,0 +1,41 @@
+from context_window import ContextWindow, MESSAGE_TOKEN_OVERHEAD
+
+PREFIX = [{"role": "system", "content": "be brief"}]
+
+
+def turn(role, num_words):
+    return {"role": role, "content": " ".join([role] * num_words)}
+
+
+def verbose_summarizer(evicted, previous_summary):
+    return " ".join(["summary"] * 200)
+
+
+def test_query_fits_budget_when_summary_alone_is_too_long():
+    window = ContextWindow(100, PREFIX, summarizer=verbose_summarizer)
+    window.extend([turn("user", 30), turn("assistant", 30), turn("user", 30), turn("assistant", 30)])
+
+    query = window.build_query(turn("user", 10))
+    assert len(window) == 0
+    assert window.total_tokens + 10 + MESSAGE_TOKEN_OVERHEAD <= 100
+    assert sum(len(message["content"].split()) + MESSAGE_TOKEN_OVERHEAD for message in query) <= 100
+    assert query[1]["content"].startswith("summary")
+
+
+def test_summary_is_dropped_when_nothing_fits_beside_the_prefix():
+    window = ContextWindow(100, PREFIX, summarizer=verbose_summarizer)
+    window.extend([turn("user", 30), turn("assistant", 30)])
+    window.build_query(turn("user", 60))
+    window.build_query(turn("user", 88))
+
+    assert window.summary_message is None and window.summary_tokens == 0
+    assert window.messages == PREFIX
+
+
+def test_window_without_summarizer_evicts_whole_turns():
+    window = ContextWindow(100, PREFIX)
+    window.extend([turn("user", 30), turn("assistant", 30), turn("user", 20), turn("assistant", 20)])
+    query = window.build_query(turn("user", 10))
+
+    assert [message["role"] for message in query] == ["system", "user", "assistant", "user"]
+    assert window.num_evicted == 2
@@ -0,0 +1,31 @@
+import asyncio
+import apo_models
+from judging import JudgingEngine, parse_score_dict
+
+
+def test_parse_score_dict_accepts_fenced_and_fractional_scores():
+    assert parse_score_dict('```json\n{"clarity": "4/5", "persona": {"score": 8, "max": 10}}\n```') == {"clarity": 4.0}
+    assert parse_score_dict("Clarity: 3, Engagement: 8/10") == {"Clarity": 3.0, "Engagement": 4.0}
+
+
+def test_every_context_is_judged(client, monkeypatch):
+    judged = []
+    judger = apo_models.Judger
+
+    async def recording_judger(context, *args, **kwargs):
+        judged.append(context)
+        return await judger(context, *args, **kwargs)
+
+    monkeypatch.setattr(apo_models, "Judger", recording_judger)
+    original = [f"original {i}" for i in range(12)]
+    new = [f"new {i}" for i in range(12)]
+    result = asyncio.run(JudgingEngine(client).compare(original, new))
+
+    assert set(judged) == set(original + new)
+    assert result.num_calls % 24 == 0
+    assert result.original.n + result.original.num_failed == result.num_calls // 2
+
+
+def test_single_context_keeps_sample_budget(client):
+    result = asyncio.run(JudgingEngine(client, min_samples=3, max_samples=5).compare("original", "new"))
+    assert 6 <= result.num_calls <= 10
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import threading
+import pytest
+from llm_client import LLMClient
+from llm_providers import FakeProvider, ProviderError
+
+MESSAGES = [{"role": "user", "content": "Recommend a movie"}]
+
+
+def slow_client(**provider_kwargs):
+    provider = FakeProvider(latency_median=0.2, latency_sigma=0.01, seconds_per_token=0.001, **provider_kwargs)
+    return provider, LLMClient(provider=provider, max_retries=0)
+
+
+def test_concurrent_identical_calls_share_one_request():
+    provider, client = slow_client()
+
+    async def main():
+        return await asyncio.gather(*(client.achat(MESSAGES) for _ in range(5)))
+
+    replies = asyncio.run(main())
+    assert len(set(replies)) == 1 and replies[0]
+    assert provider.stats()["chat_calls"] == 1
+    assert client.coalescing_stats()["calls_saved"] == 4
+
+
+def test_threads_follow_a_streaming_leader():
+    provider, client = slow_client()
+    replies = []
+    stream = client.stream_chat(MESSAGES)
+    followers = [threading.Thread(target=lambda: replies.append(client.chat(MESSAGES))) for _ in range(3)]
+    chunks = iter(stream)
+    leader = threading.Thread(target=lambda: replies.append("".join(chunks)))
+    leader.start()
+    time.sleep(0.05)
+    for follower in followers:
+        follower.start()
+    for thread in [leader] + followers:
+        thread.join()
+    assert len(replies) == 4 and len(set(replies)) == 1
+    assert provider.stats()["chat_calls"] == 1
+
+
+def test_leader_api_error_reaches_followers():
+    provider, client = slow_client(error_rate=1.0, error_status=400)
+
+    async def main():
+        return await asyncio.gather(*(client.achat(MESSAGES) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ProviderError) for result in results)
+    assert provider.stats()["errors"] == 1
+
+
+@pytest.mark.parametrize("streamed_async", [False, True])
+def test_failed_stream_closes_its_span_once(monkeypatch, streamed_async):
+    import llm_client
+    closed = []
+    close_span = llm_client.ChatStream._close_span
+    monkeypatch.setattr(llm_client.ChatStream, "_close_span",
+                        lambda stream, error=None: (closed.append(error), close_span(stream, error)))
+    provider, client = slow_client(error_rate=1.0, error_status=400)
+
+    async def consume():
+        return [chunk async for chunk in client.astream_chat(MESSAGES)]
+
+    with pytest.raises(ProviderError):
+        asyncio.run(consume()) if streamed_async else list(client.stream_chat(MESSAGES))
+    assert len(closed) == 1 and isinstance(closed[0], ProviderError)
+    assert not client.single_flight._flights
+
+
+def test_cancelled_leader_hands_over_to_a_follower():
+    provider, client = slow_client()
+
+    async def main():
+        leader = asyncio.ensure_future(client.achat(MESSAGES))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(client.achat(MESSAGES))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main())
+    assert client.coalescing_stats()["calls_saved"] == 0
+
+
+def test_abandoned_stream_hands_over_to_a_follower():
+    provider, client = slow_client()
+
+    async def main():
+        chunks = client.astream_chat(MESSAGES).__aiter__()
+        first_chunk = asyncio.ensure_future(chunks.__anext__())
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(client.achat(MESSAGES))
+        await first_chunk
+        await chunks.aclose()
+        return await follower
+
+    assert asyncio.run(main())
+    assert provider.stats()["chat_calls"] == 2
+
+
+def test_coalescing_can_be_disabled():
+    provider = FakeProvider(latency_median=0.05, latency_sigma=0.01)
+    client = LLMClient(provider=provider, coalesce_requests=False)
+
+    async def main():
+        return await asyncio.gather(*(client.achat(MESSAGES) for _ in range(3)))
+
+    asyncio.run(main())
+    assert provider.stats()["chat_calls"] == 3
@@ -0,0 +1,116 @@
+import prompt_utils
+from long_term_memory_manager import LongTermMemoryManager
+
+CONVERSATIONS = [
+    [{"role": "user", "content": "I loved the movie Inception and its dream heist"},
+     {"role": "assistant", "content": "Inception is a great pick, you may also like Tenet"}],
+    [{"role": "user", "content": "My cat is called Mochi"},
+     {"role": "assistant", "content": "Mochi is a lovely name for a cat"}],
+]
+
+
+def make_manager(tmp_path, client, **kwargs):
+    manager = LongTermMemoryManager(str(tmp_path / "memories"), prompt_utils.get_current_time(), llm_client=client, **kwargs)
+    for conversation in CONVERSATIONS:
+        manager.store_conversation_seq_memory(conversation)
+    return manager
+
+
+def test_lexical_fetch_output_can_be_packed(tmp_path, client):
+    manager = make_manager(tmp_path, client)
+    query = [{"role": "user", "content": "Tell me about Inception again"}]
+    memories, aux = manager.fetch_memory_related_to_conversation_seq(query, num_neighbors=2, retrieval_mode="lexical")
+
+    assert memories and aux["memory_similarities"][0] is None
+    for similarities in (aux["memory_similarities"], aux["memory_scores"]):
+        reminder = prompt_utils.wrap_retrieved_memories(memories, 512, similarities=similarities,
+                                                        query_string=query[0]["content"])
+        assert "Inception" in reminder[0]["content"]
+
+
+def test_hybrid_fetch_ranks_exact_title_first(tmp_path, client):
+    manager = make_manager(tmp_path, client)
+    memories, aux = manager.fetch_memory_related_to_conversation_seq(
+        [{"role": "user", "content": "What did I say about my cat Mochi?"}], num_neighbors=1, min_similarity=-1.0)
+    assert "Mochi" in memories[0]["memory_string"]
+    assert aux["memory_similarities"][0] is not None
+
+
+def test_chat_turns_are_sent_with_packed_memories(tmp_path, client, monkeypatch):
+    import chat_memgpt
+    requests = []
+    stream_chat = client.stream_chat
+
+    def recording_stream_chat(messages, **kwargs):
+        requests.append(messages)
+        return stream_chat(messages, **kwargs)
+
+    monkeypatch.setattr(client, "stream_chat", recording_stream_chat)
+    monkeypatch.setattr(chat_memgpt, "get_llm_client", lambda: client)
+    manager = make_manager(tmp_path, client)
+    history = chat_memgpt.new_conversation_history()
+    chat_memgpt.chat_loop_v2(["Any movie like Inception?"], conversation_history=history, memory_manager=manager)
+
+    reminder, acknowledgement, question = requests[0][-3:]
+    assert reminder["content"].startswith(prompt_utils.RETRIEVAL_USER_PREFIX) and "Inception" in reminder["content"]
+    assert acknowledgement["role"] == "assistant"
+    assert question["content"] == "Any movie like Inception?"
+    assert all(message["content"] != reminder["content"] for message in history.messages)
+
+
+def test_fetch_is_not_blocked_by_ingest_embedding(tmp_path, client, monkeypatch):
+    import threading
+    manager = make_manager(tmp_path, client)
+    embedding_started, release_embedding = threading.Event(), threading.Event()
+    get_embeddings_batch = manager.get_embeddings_batch
+
+    def slow_embeddings(texts):
+        embedding_started.set()
+        assert release_embedding.wait(5)
+        return get_embeddings_batch(texts)
+
+    monkeypatch.setattr(manager, "get_embeddings_batch", slow_embeddings)
+    conversation = [{"role": "user", "content": f"message {i} about Inception"} for i in range(6)]
+    ingest = threading.Thread(target=manager.ingest_conversation, args=("c1", conversation))
+    ingest.start()
+    assert embedding_started.wait(5)
+
+    fetched = []
+    fetch = threading.Thread(target=lambda: fetched.append(manager.fetch_memory_related_to_conversation_seq(
+        [{"role": "user", "content": "Mochi"}], num_neighbors=1, retrieval_mode="lexical")))
+    fetch.start()
+    fetch.join(2)
+    release_embedding.set()
+    ingest.join(5)
+    assert fetched, "fetch waited for the ingest's embedding request"
+    assert [meta["turn_start"] for _, meta in manager.store.conversation_chunks("c1")] == [0, 4]
+
+
+def test_concurrent_ingests_of_one_conversation_leave_no_gaps(tmp_path, client):
+    import threading
+    manager = make_manager(tmp_path, client)
+    conversation = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"} for i in range(21)]
+    threads = [threading.Thread(target=manager.ingest_conversation, args=("c1", conversation[:n]))
+               for n in range(1, 22)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manager.ingest_conversation("c1", conversation)
+
+    chunks = [meta for _, meta in manager.store.conversation_chunks("c1")]
+    assert [(meta["turn_start"], meta["turn_end"]) for meta in chunks] == \
+        [(start, min(start + 4, 21)) for start in range(0, 21, 4)]
+
+
+def test_hybrid_fetch_ignores_common_word_matches(tmp_path, client, monkeypatch):
+    monkeypatch.setattr(prompt_utils, "get_current_time", lambda: ("01/01/2025", "Wednesday", "10:00:00"))
+    manager = make_manager(tmp_path, client)
+    query = [{"role": "user", "content": "What is the weather like for my commute to work"}]
+    # The fake embeddings share the date header, so set the threshold just above every chunk's similarity
+    _, aux = manager.fetch_memory_related_to_conversation_seq(query, min_similarity=-1.0, retrieval_mode="vector")
+    min_similarity = max(aux["memory_similarities"]) + 0.01
+    assert manager.fetch_memory_related_to_conversation_seq(query, retrieval_mode="lexical")[0]
+
+    memories, aux = manager.fetch_memory_related_to_conversation_seq(query, min_similarity=min_similarity)
+    assert memories == [] and aux["memory_scores"] == []
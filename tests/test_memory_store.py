@@ -0,0 +1,207 @@
+import os
+import json
+import shutil
+import numpy as np
+import pytest
+from memory_store import MemoryStore, RecordLog
+from memory_index import MemoryIndex
+from lexical_index import BM25Index
+
+DIM = 8
+TEXTS = ["the dream heist in Inception", "my cat is called Mochi", "we planned a trip to Hanoi",
+         "pho is my favourite breakfast"]
+
+
+def make_store(tmp_path, texts=TEXTS, **kwargs):
+    store = MemoryStore(str(tmp_path / "store"), embedding_dim=DIM, **kwargs)
+    embeddings = np.random.default_rng(0).standard_normal((len(texts), DIM))
+    store.add_many([{"memory_title": text.split()[-1], "memory_string": text} for text in texts], embeddings)
+    return store
+
+
+def reopen(store, **kwargs):
+    store.close()
+    return MemoryStore(store.folder_path, embedding_dim=DIM, **kwargs)
+
+
+def live_texts(store):
+    return [store.get(row)["memory_string"] for row in store.live_rows()]
+
+
+def append_bytes(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+def drop_last_line(path):
+    with open(path, "rb") as f:
+        lines = f.readlines()
+    with open(path, "wb") as f:
+        f.writelines(lines[:-1])
+
+
+def test_reopen_keeps_every_memory(tmp_path):
+    store = reopen(make_store(tmp_path))
+    assert live_texts(store) == TEXTS
+    assert store.get_by_id(store.metadata[1]["id"])["memory_title"] == "Mochi"
+    rows, _ = store.search_lexical("Mochi", 1)
+    assert list(rows) == [1]
+
+
+def test_record_log_detects_corruption(tmp_path):
+    log = RecordLog(str(tmp_path / "records.log"))
+    (offset, length), = log.append_many([{"memory_string": "hello"}])
+    assert log.read(offset, length) == {"memory_string": "hello"}
+    log.close()
+    with open(log.path, "r+b") as f:
+        f.seek(offset + length - 2)
+        f.write(b"XX")
+    with pytest.raises(ValueError):
+        log.read(offset, length)
+    with pytest.raises(ValueError):
+        log.read(offset, length - 1)
+
+
+def test_torn_record_write_is_dropped(tmp_path):
+    store = make_store(tmp_path)
+    committed_size = store.records.size
+    append_bytes(store.records.path, RecordLog.HEADER.pack(100, 0) + b'{"memory_str')
+
+    store = reopen(store)
+    assert store.records.size == committed_size
+    assert live_texts(store) == TEXTS
+    store.add_many([{"memory_string": "a new memory"}], np.ones((1, DIM)))
+    assert live_texts(reopen(store)) == TEXTS + ["a new memory"]
+
+
+@pytest.mark.parametrize("torn_line", [None, b'{"id": "abc", "off', b'{"id": "abc", "offset": 0, "length": 1}'])
+def test_uncommitted_memory_is_dropped(tmp_path, torn_line):
+    # Crash after the record and embedding were written, with the index line missing or torn
+    store = make_store(tmp_path)
+    store.add_many([{"memory_string": "never committed"}], np.ones((1, DIM)))
+    metadata_path = os.path.join(store.folder_path, MemoryIndex.METADATA_FILENAME)
+    drop_last_line(metadata_path)
+    if torn_line is not None:
+        append_bytes(metadata_path, torn_line)
+
+    store = reopen(store)
+    assert live_texts(store) == TEXTS
+    assert store.embeddings.shape == (len(TEXTS), DIM)
+    store.add_many([{"memory_string": "a new memory"}], np.ones((1, DIM)))
+    store = reopen(store)
+    assert live_texts(store) == TEXTS + ["a new memory"]
+    rows, _ = store.search_lexical("new memory", 1)
+    assert list(rows) == [len(TEXTS)]
+
+
+def test_tombstones_survive_reopen_and_torn_lines(tmp_path):
+    store = make_store(tmp_path)
+    store.delete([store.metadata[0]["id"]])
+    append_bytes(store.tombstones_path, b'{"id": "1')
+
+    store = reopen(store)
+    assert live_texts(store) == TEXTS[1:]
+    store.delete([store.metadata[2]["id"]])
+    store = reopen(store)
+    assert live_texts(store) == [TEXTS[1], TEXTS[3]]
+    with pytest.raises(KeyError):
+        store.get_by_id(store.metadata[2]["id"])
+    rows, _ = store.search_lexical("Inception Hanoi", 4)
+    assert len(rows) == 0
+
+
+@pytest.mark.parametrize("damage", ["missing", "torn", "unterminated", "truncated"])
+def test_lexical_sidecar_is_resynced(tmp_path, damage):
+    store = make_store(tmp_path)
+    terms_path = os.path.join(store.folder_path, BM25Index.TERMS_FILENAME)
+    if damage == "missing":
+        os.remove(terms_path)
+    else:
+        drop_last_line(terms_path)
+        if damage == "torn":
+            append_bytes(terms_path, b'{"pho": 1, "is')
+        elif damage == "unterminated":
+            append_bytes(terms_path, b'{"pho": 1}')
+
+    store = reopen(store)
+    assert len(store.lexical_index) == len(TEXTS)
+    rows, _ = store.search_lexical("pho breakfast", 1)
+    assert list(rows) == [3]
+    with open(terms_path, "r", encoding="utf-8") as f:
+        assert len([json.loads(line) for line in f]) == len(TEXTS)
+
+
+def test_compact_drops_deleted_memories(tmp_path):
+    store = make_store(tmp_path)
+    store.delete([store.metadata[1]["id"]])
+    kept_ids = [store.metadata[row]["id"] for row in store.live_rows()]
+    store.compact()
+
+    assert live_texts(store) == [TEXTS[0]] + TEXTS[2:]
+    store = reopen(store)
+    assert [metadata["id"] for metadata in store.metadata] == kept_ids
+    assert not os.path.exists(store.tombstones_path)
+    assert not os.path.exists(store.folder_path + ".compact")
+    assert not os.path.exists(store.folder_path + ".old")
+    rows, _ = store.search_lexical("Hanoi", 1)
+    assert store.get(rows[0])["memory_string"] == TEXTS[2]
+
+
+def make_compacted_copy(store):
+    """A finished `.compact` segment of store without its first memory, as compact() leaves it before swapping."""
+    compact_path = store.folder_path + ".compact"
+    target = MemoryStore(compact_path, DIM, embedding_dtype=store.embedding_dtype)
+    rows = store.live_rows()[1:]
+    target.add_many([store.get(row) for row in rows], store.embeddings[rows])
+    target.close()
+    open(os.path.join(compact_path, ".complete"), "w").close()
+    return compact_path
+
+
+def test_unfinished_compaction_is_discarded(tmp_path):
+    store = make_store(tmp_path)
+    compact_path = make_compacted_copy(store)
+    os.remove(os.path.join(compact_path, ".complete"))
+
+    store = reopen(store)
+    assert live_texts(store) == TEXTS
+    assert not os.path.exists(compact_path)
+
+
+def test_compaction_interrupted_between_renames_keeps_compacted_segment(tmp_path):
+    store = make_store(tmp_path)
+    compact_path = make_compacted_copy(store)
+    store.close()
+    os.replace(store.folder_path, store.folder_path + ".old")
+
+    store = reopen(store)
+    assert live_texts(store) == TEXTS[1:]
+    assert not os.path.exists(compact_path) and not os.path.exists(store.folder_path + ".old")
+    assert not os.path.exists(os.path.join(store.folder_path, ".complete"))
+
+
+@pytest.mark.parametrize("embedding_dtype", ["float32", "float16"])
+def test_old_segment_is_restored_when_folder_is_missing(tmp_path, embedding_dtype):
+    # Crash after the first rename with the compacted segment unfinished
+    store = make_store(tmp_path, embedding_dtype=embedding_dtype)
+    store.close()
+    shutil.copytree(store.folder_path, store.folder_path + ".compact")
+    os.replace(store.folder_path, store.folder_path + ".old")
+
+    store = MemoryStore(store.folder_path, embedding_dim=DIM)
+    assert store.embedding_dtype == embedding_dtype
+    assert live_texts(store) == TEXTS
+    assert not os.path.exists(store.folder_path + ".old")
+
+
+def test_leftover_old_segment_is_removed(tmp_path):
+    # Crash after the second rename, before the old segment was deleted
+    store = make_store(tmp_path)
+    store.close()
+    shutil.copytree(store.folder_path, store.folder_path + ".old")
+    open(os.path.join(store.folder_path, ".complete"), "w").close()
+
+    store = reopen(store)
+    assert live_texts(store) == TEXTS
+    assert not os.path.exists(store.folder_path + ".old")
+    assert not os.path.exists(os.path.join(store.folder_path, ".complete"))
@@ -0,0 +1,52 @@
+import chat_memgpt
+import message_assembly
+from context_window import ContextWindow
+
+INSTRUCTIONS = {"role": "system", "content": "Always answer in English."}
+
+
+def record_requests(monkeypatch, client):
+    requests = []
+    stream_chat = client.stream_chat
+
+    def recording_stream_chat(messages, **kwargs):
+        requests.append([dict(message) for message in messages])
+        return stream_chat(messages, **kwargs)
+
+    monkeypatch.setattr(client, "stream_chat", recording_stream_chat)
+    monkeypatch.setattr(chat_memgpt, "get_llm_client", lambda: client)
+    return requests
+
+
+def test_prefix_is_shared_and_counted_once():
+    prefix = message_assembly.build_prefix("PROMPT A")
+    assert message_assembly.build_prefix("PROMPT A") is prefix
+    window = prefix.new_window(1000)
+    assert window.prefix_tokens == ContextWindow(1000, prefix.messages).prefix_tokens
+
+
+def test_custom_prompt_keeps_history_prefix(monkeypatch, client):
+    requests = record_requests(monkeypatch, client)
+    history = chat_memgpt.new_conversation_history(prefix_messages=[INSTRUCTIONS])
+    chat_memgpt.chat_loop_v2(["q1", "q2"], custom_prompt="PROMPT A", conversation_history=history)
+
+    expected_prefix = [INSTRUCTIONS, {"role": "system", "content": "PROMPT A"}]
+    assert [request[:2] for request in requests] == [expected_prefix, expected_prefix]
+    assert requests[1][-1] == {"role": "user", "content": "q2"}
+    assert history.prefix_messages == [INSTRUCTIONS]
+
+
+def test_custom_prompt_does_not_outlive_the_call(monkeypatch, client):
+    requests = record_requests(monkeypatch, client)
+    monkeypatch.setattr(chat_memgpt, "curr_conversation_history", chat_memgpt.new_conversation_history())
+    chat_memgpt.chat_loop_v2(["q1"], custom_prompt="PROMPT A")
+    chat_memgpt.chat_loop_v2(["q2"])
+
+    assert requests[0][0] == {"role": "system", "content": "PROMPT A"}
+    assert all(message["content"] != "PROMPT A" for message in requests[1])
+
+
+def test_system_prompt_is_not_repeated():
+    history = chat_memgpt.new_conversation_history(prefix_messages=[INSTRUCTIONS], system_prompt="PROMPT A")
+    derived = message_assembly.derive_history(history, "PROMPT A")
+    assert derived.prefix_messages == history.prefix_messages
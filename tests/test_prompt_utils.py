@@ -0,0 +1,49 @@
+import prompt_utils
+
+
+def make_memory(topic, num_turns, filler_words=30):
+    filler = " ".join(["something"] * filler_words)
+    conversation = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} {filler}"}
+                    for i in range(num_turns)]
+    conversation[num_turns // 2]["content"] = f"I really want to watch {topic} tonight"
+    header = "Conversation start: (01/01/2025, Wednesday, 10:00:00)\nConversation end: (01/01/2025, Wednesday, 10:30:00)"
+    memory_string = header + "\n\n" + "\n".join(f"{msg['role']}: {msg['content']}" for msg in conversation)
+    return {"memory_string": memory_string, "conversation_sequence": conversation}
+
+
+def test_packed_reminder_fits_budget():
+    memories = [make_memory(topic, 12) for topic in ("Inception", "Frozen", "Alien")]
+    for budget in (200, 400, 800, 4000):
+        reminder = prompt_utils.wrap_retrieved_memories(memories, budget, similarities=[0.9, 0.8, 0.7],
+                                                        query_string="Inception")
+        assert prompt_utils.count_tokens_from_conversation_seq(reminder) <= budget
+
+
+def test_truncation_keeps_turns_matching_the_query():
+    memory = make_memory("Inception", 12)
+    full_tokens = prompt_utils.count_tokens_from_string(memory["memory_string"])
+    packed = prompt_utils.pack_retrieved_memories([memory], full_tokens // 2, similarities=[0.9],
+                                                  query_string="Can we watch Inception?")
+    assert len(packed) == 1
+    assert "I really want to watch Inception tonight" in packed[0]
+    assert prompt_utils.OMITTED_TURNS_MARKER in packed[0]
+    assert prompt_utils.count_tokens_from_string(packed[0]) <= full_tokens // 2
+
+
+def test_more_similar_memory_wins_a_tight_budget():
+    memories = [make_memory("Frozen", 2, filler_words=5), make_memory("Inception", 2, filler_words=5)]
+    one_memory = prompt_utils.count_tokens_from_string(prompt_utils.MEMORY_SEPARATOR + memories[0]["memory_string"] + "\n")
+    packed = prompt_utils.pack_retrieved_memories(memories, one_memory + 5, similarities=[0.3, 0.9])
+    assert len(packed) == 1 and "Inception" in packed[0]
+
+
+def test_tokenizer_falls_back_offline_when_the_vocabulary_cannot_load(monkeypatch):
+    def unreachable(*args, **kwargs):
+        raise ConnectionError("no network")
+    monkeypatch.delenv("APO_LLM_PROVIDER")
+    monkeypatch.setattr(prompt_utils.tiktoken, "encoding_for_model", unreachable)
+    monkeypatch.setattr(prompt_utils.tiktoken, "get_encoding", unreachable)
+
+    assert isinstance(prompt_utils.get_encoder(), prompt_utils.ApproximateEncoder)
+    assert prompt_utils.count_tokens_from_string("Hello, world!") == 4
+    assert prompt_utils.truncate_to_tokens("Hello, world! How are you?", 3) == "Hello, world"
@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+from llm_client import LLMClient
+from llm_providers import FakeProvider
+from response_cache import ResponseCache
+from structured_output import (ParseMetrics, StructuredOutputError, complete_structured, json_schema_format,
+                               parse_json_reply)
+
+SCORES_SCHEMA = {"type": "object", "properties": {"clarity": {"type": "integer"}}, "required": ["clarity"],
+                 "additionalProperties": False}
+
+
+def test_stats_since_counts_only_later_replies():
+    metrics = ParseMetrics()
+    metrics.record("judge", "failed", 1)
+    metrics.record("cot", "first_try")
+    snapshot = metrics.stats()
+    metrics.record("judge", "repaired", 1)
+    metrics.record("questions", "first_try")
+
+    stats = metrics.stats_since(snapshot)
+    assert stats == {"judge": {"replies": 1, "first_try": 0, "repaired": 1, "failed": 0, "repair_calls": 1},
+                     "questions": {"replies": 1, "first_try": 1, "repaired": 0, "failed": 0, "repair_calls": 0}}
+    assert metrics.num_failures(stats) == 1
+    assert metrics.num_failures() == 2
+
+
+def make_cached_client(tmp_path, responder):
+    provider = FakeProvider(latency_median=0.001, time_scale=0.0, responder=responder)
+    return LLMClient(provider=provider, response_cache=ResponseCache(str(tmp_path / "responses.sqlite3"))), provider
+
+
+def complete_scores(client, on_stream=None):
+    return asyncio.run(complete_structured(client, [{"role": "user", "content": "Score this"}], "gpt-4o-mini", "judger",
+                                           json_schema_format("scores", SCORES_SCHEMA),
+                                           lambda reply: parse_json_reply(reply, SCORES_SCHEMA), on_stream=on_stream))
+
+
+@pytest.mark.parametrize("streamed", [False, True])
+def test_unparseable_replies_are_not_cached(tmp_path, streamed):
+    client, provider = make_cached_client(tmp_path, lambda messages, rng, num_words: "not json")
+    on_stream = (lambda text, time_to_first_token: None) if streamed else None
+    for _ in range(2):
+        with pytest.raises(StructuredOutputError):
+            complete_scores(client, on_stream)
+
+    assert provider.stats()["chat_calls"] == 4
+    assert client.response_cache.stats()["hits"] == 0 and client.response_cache.stats()["entries"] == 0
+
+
+def test_only_the_parsed_first_reply_is_cached(tmp_path):
+    def responder(messages, rng, num_words):
+        return '{"clarity": 4}' if len(messages) > 1 or responder.fixed else "not json"
+    responder.fixed = False
+    client, provider = make_cached_client(tmp_path, responder)
+
+    assert complete_scores(client) == {"clarity": 4}
+    assert client.response_cache.stats()["entries"] == 0
+    responder.fixed = True
+    assert complete_scores(client) == {"clarity": 4}
+    assert complete_scores(client) == {"clarity": 4}
+    assert provider.stats()["chat_calls"] == 3
+    assert client.response_cache.stats()["hits"] == 1
+
+
+def test_unusable_reply_cached_earlier_is_dropped(tmp_path):
+    client, provider = make_cached_client(tmp_path, lambda messages, rng, num_words: '{"clarity": 4}')
+    key = ResponseCache.make_key("gpt-4o-mini", [{"role": "user", "content": "Score this"}],
+                                 response_format=json_schema_format("scores", SCORES_SCHEMA))
+    client.response_cache.set(key, "not json")
+
+    assert complete_scores(client) == {"clarity": 4}    # served "not json" from the cache, then repaired
+    assert complete_scores(client) == {"clarity": 4}
+    assert provider.stats()["chat_calls"] == 2
+    assert client.response_cache.stats()["hits"] == 1
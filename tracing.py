@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Finished traces are appended here as JSONL (one span per line). Set APO_TRACE_PATH="" to disable.
+DEFAULT_TRACE_PATH = os.path.join(".apo_cache", "traces.jsonl")
+MAX_BUFFERED_SPANS = 20000
+
+# USD per million (prompt, completion) tokens; models are matched by prefix, longest first
+MODEL_PRICES_PER_MILLION = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_request_observer = contextvars.ContextVar("request_observer", default=None)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens=0):
+    """Estimated USD cost of a call, or None for an unknown model."""
+    for name in sorted(MODEL_PRICES_PER_MILLION, key=len, reverse=True):
+        if model and model.startswith(name):
+            prompt_price, completion_price = MODEL_PRICES_PER_MILLION[name]
+            return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+    return None
+
+
+@dataclass
+class Span:
+    name: str
+    kind: str                     # "stage", "llm" or "embedding"
+    trace_id: str
+    parent_id: Optional[str] = None
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    start_time: float = field(default_factory=time.time)
+    duration: Optional[float] = None
+    attributes: dict = field(default_factory=dict)
+    _started: float = field(default_factory=time.perf_counter, repr=False)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_usage(self, usage):
+        """Copies token counts from an API `usage` object and adds the estimated cost of the span's model."""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        self.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                 cost_usd=estimate_cost(self.attributes.get("model"), prompt_tokens, completion_tokens))
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.attributes["error"] = repr(error)
+        tracer.on_finish(self)
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "kind": self.kind, "start_time": self.start_time, "duration": self.duration, **self.attributes}
+
+
+class Tracer:
+    """Collects finished spans in memory and appends each finished trace to a JSONL file.
+
+    A trace is written once its root span finishes, so the file is touched once per run and not per call.
+    """
+
+    def __init__(self, jsonl_path=DEFAULT_TRACE_PATH, max_buffered_spans=MAX_BUFFERED_SPANS):
+        self.jsonl_path = jsonl_path
+        self.spans = deque(maxlen=max_buffered_spans)
+        self._pending = {}        # trace_id -> finished spans not yet exported
+        self._lock = threading.Lock()
+
+    def on_finish(self, span):
+        with self._lock:
+            self.spans.append(span)
+            self._pending.setdefault(span.trace_id, []).append(span)
+            finished_trace = self._pending.pop(span.trace_id) if span.parent_id is None else None
+        if finished_trace and self.jsonl_path:
+            self.export_jsonl(finished_trace, self.jsonl_path)
+
+    def get_trace(self, trace_id):
+        with self._lock:
+            return sorted((span for span in self.spans if span.trace_id == trace_id), key=lambda span: span.start_time)
+
+    @staticmethod
+    def export_jsonl(spans, path):
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(span.to_dict(), ensure_ascii=False) + "\n" for span in spans)
+        except OSError as e:
+            print(f"Warning: Failed to export trace ({e})")
+
+
+tracer = Tracer(os.environ.get("APO_TRACE_PATH", DEFAULT_TRACE_PATH))
+
+
+def current_span():
+    return _current_span.get()
+
+def start_span(name, kind="stage", **attributes):
+    """Starts a child of the current span without making it current. Call `finish()` on it when done."""
+    parent = _current_span.get()
+    trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+    return Span(name, kind, trace_id, parent.span_id if parent else None, attributes=attributes)
+
+@contextmanager
+def span(name, kind="stage", **attributes):
+    """Times the enclosed block as a child of the current span; spans started inside it nest under it.
+
+    The current span lives in a context variable, so nesting follows asyncio tasks and to_thread calls.
+    """
+    new_span = start_span(name, kind, **attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.finish(error=e)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.finish()
+
+@contextmanager
+def observe_requests(observer):
+    """Calls observer(request_key) for every LLM request made in the enclosed block (see notify_request)."""
+    token = _request_observer.set(observer)
+    try:
+        yield
+    finally:
+        _request_observer.reset(token)
+
+def notify_request(request_key):
+    """Reports a request to the active observer. Returns the observer's verdict (e.g. the step it repeats) or None."""
+    observer = _request_observer.get()
+    return observer(request_key) if observer is not None else None
+
+#%% Reporting
+
+def summarize_trace(spans):
+    """Totals over the LLM and embedding calls of a trace."""
+    calls = [span for span in spans if span.kind in ("llm", "embedding")]
+    return {
+        "calls": len(calls),
+        "cached_calls": sum(1 for span in calls if span.attributes.get("cached")),
+        "retries": sum(span.attributes.get("retries", 0) for span in calls),
+        "errors": sum(1 for span in calls if "error" in span.attributes),
+        "prompt_tokens": sum(span.attributes.get("prompt_tokens", 0) for span in calls),
+        "completion_tokens": sum(span.attributes.get("completion_tokens", 0) for span in calls),
+        "cost_usd": sum(span.attributes.get("cost_usd") or 0.0 for span in calls),
+    }
+
+def waterfall_rows(spans):
+    """One row per span, depth-first in start order, with start/end in ms relative to the trace start."""
+    if not spans:
+        return []
+    children = {}
+    for s in sorted(spans, key=lambda s: s.start_time):
+        children.setdefault(s.parent_id, []).append(s)
+    span_ids = {s.span_id for s in spans}
+    roots = [s for s in spans if s.parent_id not in span_ids]
+    trace_start = min(s.start_time for s in spans)
+
+    rows = []
+    def visit(s, depth):
+        start_ms = (s.start_time - trace_start) * 1000
+        rows.append({"row": f"{len(rows):03d} {'· ' * depth}{s.name}", "name": s.name, "kind": s.kind,
+                     "start_ms": start_ms, "end_ms": start_ms + (s.duration or 0.0) * 1000,
+                     "duration_ms": (s.duration or 0.0) * 1000, "model": s.attributes.get("model"),
+                     "cached": s.attributes.get("cached"), "retries": s.attributes.get("retries"),
+                     "tokens": s.attributes.get("prompt_tokens", 0) + s.attributes.get("completion_tokens", 0),
+                     "cost_usd": s.attributes.get("cost_usd"), "error": s.attributes.get("error")})
+        for child in children.get(s.span_id, []):
+            visit(child, depth + 1)
+    for root in sorted(roots, key=lambda s: s.start_time):
+        visit(root, 0)
+    return rows
@@ -0,0 +1,196 @@
+import os
+import numpy as np
+
+
+class ExactSearch:
+    """Reference search backend: brute-force cosine scan over the full embedding matrix."""
+
+    def __init__(self):
+        self.memory_index = None
+
+    def attach(self, memory_index):
+        """Binds the backend to a loaded MemoryIndex."""
+        self.memory_index = memory_index
+
+    def on_add(self, row_ids):
+        """Called after rows have been appended to the attached index."""
+        pass
+
+    def search(self, query, num_neighbors):
+        """Returns (row indices, cosine similarities) for a normalized query, most similar first."""
+        return top_k(self.memory_index.embeddings @ query, num_neighbors)
+
+
+class IVFSearch(ExactSearch):
+    """Approximate search backend: spherical k-means coarse quantizer with inverted lists.
+
+    Only the rows in the `nprobe` lists closest to the query are scored, so `nprobe` trades recall for latency.
+    Centroids and per-row list assignments are persisted next to the index, new rows are assigned incrementally,
+    and the quantizer is retrained once the index grows by `retrain_growth_factor` since the last training.
+    Below `min_train_size` rows the backend falls back to an exact scan.
+    """
+
+    CENTROIDS_FILENAME = "ivf_centroids.npy"
+    ASSIGNMENTS_FILENAME = "ivf_assignments.i32"
+
+    def __init__(self, nlist=None, nprobe=16, min_train_size=2048, max_train_size=50000,
+                 kmeans_iterations=20, retrain_growth_factor=4.0, seed=0):
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.max_train_size = max_train_size
+        self.kmeans_iterations = kmeans_iterations
+        self.retrain_growth_factor = retrain_growth_factor
+        self.seed = seed
+        self.centroids = None
+        self.trained_size = 0
+        self._lists = []
+        self._pending = []
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def attach(self, memory_index):
+        """Loads the persisted quantizer (training it if needed) and assigns rows added since the last run."""
+        super().attach(memory_index)
+        self.centroids = None
+        self.trained_size = 0
+
+        centroids_path = self._path(self.CENTROIDS_FILENAME)
+        if os.path.exists(centroids_path):
+            centroids = np.load(centroids_path)
+            if centroids.ndim == 2 and centroids.shape[1] == memory_index.embedding_dim:
+                self.centroids = centroids.astype(np.float32)
+
+        if self.centroids is None:
+            self._maybe_train()
+            return
+
+        assignments_path = self._path(self.ASSIGNMENTS_FILENAME)
+        assignments = np.fromfile(assignments_path, dtype=np.int32) if os.path.exists(assignments_path) else np.empty(0, np.int32)
+        if len(assignments) > len(memory_index):
+            assignments = assignments[:len(memory_index)]
+            os.truncate(assignments_path, assignments.nbytes)
+        self.trained_size = len(assignments)
+        self._build_lists(assignments)
+        self.on_add(range(len(assignments), len(memory_index)))
+
+    def on_add(self, row_ids):
+        """Assigns new rows to their nearest inverted list, or (re)trains when the index has grown enough."""
+        row_ids = np.asarray(list(row_ids), dtype=np.int64)
+        if not self.is_trained or len(self.memory_index) >= self.retrain_growth_factor * max(self.trained_size, 1):
+            self._maybe_train()
+            return
+        if len(row_ids) == 0:
+            return
+
+        assignments = self._assign(self.memory_index.embeddings[row_ids])
+        with open(self._path(self.ASSIGNMENTS_FILENAME), "ab") as f:
+            f.write(assignments.astype(np.int32).tobytes())
+        for row_id, list_id in zip(row_ids, assignments):
+            self._pending[list_id].append(row_id)
+
+    def search(self, query, num_neighbors):
+        """Scores only the rows of the `nprobe` closest inverted lists."""
+        if not self.is_trained:
+            return super().search(query, num_neighbors)
+
+        probed_lists, _ = top_k(self.centroids @ query, self.nprobe)
+        candidates = np.concatenate([self._get_list(list_id) for list_id in probed_lists])
+        if len(candidates) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        candidates.sort()  # sequential reads from the memory map
+        indices, similarities = top_k(self.memory_index.embeddings[candidates] @ query, num_neighbors)
+        return candidates[indices], similarities
+
+    def _maybe_train(self):
+        num_rows = len(self.memory_index)
+        if num_rows < self.min_train_size:
+            self.centroids = None
+            self._lists, self._pending = [], []
+            return
+
+        embeddings = self.memory_index.embeddings
+        nlist = self.nlist or int(4 * np.sqrt(num_rows))
+        rng = np.random.default_rng(self.seed)
+        sample_ids = np.sort(rng.choice(num_rows, size=min(num_rows, self.max_train_size), replace=False))
+        self.centroids = spherical_kmeans(np.asarray(embeddings[sample_ids]), min(nlist, len(sample_ids)),
+                                          self.kmeans_iterations, rng)
+
+        assignments = self._assign(embeddings)
+        np.save(self._path(self.CENTROIDS_FILENAME), self.centroids)
+        assignments.astype(np.int32).tofile(self._path(self.ASSIGNMENTS_FILENAME))
+        self.trained_size = num_rows
+        self._build_lists(assignments)
+
+    def _assign(self, vectors, batch_size=8192):
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.asarray(vectors[start:start + batch_size])
+            assignments[start:start + batch_size] = np.argmax(batch @ self.centroids.T, axis=1)
+        return assignments
+
+    def _build_lists(self, assignments):
+        order = np.argsort(assignments, kind="stable")
+        boundaries = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self._lists = [order[boundaries[i]:boundaries[i + 1]].astype(np.int64) for i in range(len(self.centroids))]
+        self._pending = [[] for _ in range(len(self.centroids))]
+
+    def _get_list(self, list_id):
+        if self._pending[list_id]:
+            self._lists[list_id] = np.concatenate([self._lists[list_id], np.asarray(self._pending[list_id], dtype=np.int64)])
+            self._pending[list_id] = []
+        return self._lists[list_id]
+
+    def _path(self, filename):
+        return os.path.join(self.memory_index.index_folder_path, filename)
+
+
+def spherical_kmeans(vectors, num_clusters, num_iterations, rng, batch_size=8192):
+    """Clusters L2-normalized vectors by cosine similarity. Returns normalized float32 centroids."""
+    centroids = vectors[rng.choice(len(vectors), size=num_clusters, replace=False)].astype(np.float32)
+    for _ in range(num_iterations):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(num_clusters, dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = vectors[start:start + batch_size]
+            assignments = np.argmax(batch @ centroids.T, axis=1)
+            np.add.at(sums, assignments, batch)
+            counts += np.bincount(assignments, minlength=num_clusters)
+
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+        centroids = normalize_embeddings(sums)
+    return centroids
+
+
+def make_search_backend(name="exact", **kwargs):
+    """Creates a search backend by name ("exact" or "ivf")."""
+    backends = {"exact": ExactSearch, "ivf": IVFSearch}
+    if name not in backends:
+        raise ValueError(f"Unknown search backend '{name}', expected one of {sorted(backends)}")
+    return backends[name](**kwargs)
+
+
+def normalize_embeddings(vectors):
+    """L2-normalizes each row, leaving all-zero rows (failed embeddings) as zeros."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def top_k(similarities, k):
+    """Returns (indices, values) of the k largest similarities in descending order using argpartition."""
+    k = min(k, len(similarities))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=similarities.dtype)
+    if k < len(similarities):
+        candidates = np.argpartition(-similarities, k - 1)[:k]
+    else:
+        candidates = np.arange(len(similarities))
+    order = np.argsort(-similarities[candidates], kind="stable")
+    indices = candidates[order]
+    return indices, similarities[indices]